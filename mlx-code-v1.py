@@ -9,19 +9,78 @@ import textwrap
 import difflib
 import json
 import shutil
+import shlex
 import threading
 import time
 import glob
+import functools
+import hashlib
+import importlib.util
+import inspect
+import sqlite3
+import atexit
+import base64
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Tuple, Optional, Dict
 from pathlib import Path
 
-try:
-    from mlx_lm import load, generate
-except ImportError:
+if importlib.util.find_spec("mlx_lm") is None:
     print("ERROR: mlx-lm not found. Install with: pip install mlx-lm")
     sys.exit(1)
 
+# mlx-lm takes seconds to import, so _import_mlx() binds these on first use
+load = generate = stream_generate = mx = None
+make_prompt_cache = can_trim_prompt_cache = trim_prompt_cache = None
+save_prompt_cache = load_prompt_cache = None
+HAS_PROMPT_CACHE = False
+
+
+@functools.lru_cache(maxsize=None)
+def _import_mlx():
+    """Import mlx / mlx-lm into the module globals (once)."""
+    global load, generate, stream_generate, mx, HAS_PROMPT_CACHE
+    global make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache
+    global save_prompt_cache, load_prompt_cache
+
+    from mlx_lm import load, generate
+
+    try:
+        from mlx_lm import stream_generate
+    except ImportError:
+        stream_generate = None  # Older mlx-lm: fall back to blocking generate()
+
+    try:
+        import mlx.core as mx
+        from mlx_lm.models.cache import (
+            make_prompt_cache,
+            can_trim_prompt_cache,
+            trim_prompt_cache,
+            save_prompt_cache,
+            load_prompt_cache,
+        )
+        HAS_PROMPT_CACHE = True
+    except ImportError:
+        HAS_PROMPT_CACHE = False
+
+try:
+    # C implementation of SequenceMatcher; difflib.unified_diff picks it up
+    from cdifflib import CSequenceMatcher
+    difflib.SequenceMatcher = CSequenceMatcher
+except ImportError:
+    pass
+
+try:
+    import readline
+except ImportError:
+    readline = None  # e.g. Windows: plain input() without history or completion
+
+try:
+    import pathspec
+except ImportError:
+    pathspec = None  # .gitignore is not honored without it; SKIP_DIRS still applies
+
 # ---------------------------------------------------------------------------
 # CONFIG
 # ---------------------------------------------------------------------------
@@ -31,6 +90,10 @@ LOG_DIR = os.path.expanduser("~/.mlx-code")
 BACKUP_DIR = os.path.join(LOG_DIR, "backups")
 HISTORY_FILE = os.path.join(LOG_DIR, "history.log")
 CONFIG_FILE = os.path.join(LOG_DIR, "config.json")
+KV_CACHE_FILE = os.path.join(LOG_DIR, "kv_cache.safetensors")
+RESPONSE_CACHE_FILE = os.path.join(LOG_DIR, "responses.sqlite3")
+REPL_HISTORY_FILE = os.path.join(LOG_DIR, "repl_history")
+RESPONSE_CACHE_SIZE = 500  # Entries kept before least recently used are evicted
 
 DEFAULT_MODEL = "mlx-community/qwen2.5-coder-7b-instruct-4bit"
 
@@ -43,13 +106,29 @@ MODEL_ALIASES = {
 DEFAULT_MAX_TOKENS = 1024
 DEFAULT_CTX_CHARS = 20000
 
-ALLOWED_EXTENSIONS = {
+# Speculative decoding: set "draft_model" in config.json (e.g. "q1.5b") to have a
+# small model of the same family propose tokens that the main model verifies
+NUM_DRAFT_TOKENS = 4
+
+# How create_backup stores copies ("backup_mode" in config.json):
+#   reflink  - copy-on-write clone where the filesystem supports it, else full copy
+#   hardlink - reflink, else hardlink (files are unlinked before being rewritten)
+#   copy     - always a full copy
+BACKUP_MODES = ("reflink", "hardlink", "copy")
+BACKUP_MODE = "reflink"
+
+ALLOWED_EXTENSIONS = frozenset({
     '.py', '.js', '.jsx', '.ts', '.tsx', '.java', '.cpp', '.c', '.h', '.hpp',
     '.cs', '.go', '.rs', '.rb', '.php', '.swift', '.kt', '.scala', '.r',
     '.html', '.css', '.scss', '.sass', '.less', '.vue', '.svelte',
     '.json', '.yaml', '.yml', '.toml', '.xml', '.md', '.txt', '.sh', '.bash',
     '.sql', '.graphql', '.proto', '.dockerfile', '.makefile', '.cmake'
-}
+})
+
+# Build output, dependency and cache directories that are never worth walking
+SKIP_DIRS = frozenset({
+    'node_modules', 'venv', '__pycache__', 'target', 'dist', 'build',
+})
 
 TEMPLATES = {
     "test": "Create comprehensive unit tests for the following code. Use appropriate testing framework and include edge cases:\n\n",
@@ -92,6 +171,7 @@ class Spinner:
         self.message = message
         self.running = False
         self.thread = None
+        self._stopped = threading.Event()
 
     def _spin(self):
         chars = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
@@ -100,18 +180,21 @@ class Spinner:
             sys.stdout.write(f"\r{FG_CYAN}{chars[idx]} {self.message}...{RESET}")
             sys.stdout.flush()
             idx = (idx + 1) % len(chars)
-            time.sleep(0.1)
+            # Unlike sleep(), wakes as soon as stop() is called
+            self._stopped.wait(0.1)
         sys.stdout.write("\r" + " " * (len(self.message) + 10) + "\r")
         sys.stdout.flush()
 
     def start(self):
         self.running = True
+        self._stopped.clear()
         self.thread = threading.Thread(target=self._spin)
         self.thread.daemon = True
         self.thread.start()
 
     def stop(self):
         self.running = False
+        self._stopped.set()
         if self.thread:
             self.thread.join()
 
@@ -120,19 +203,31 @@ class Spinner:
 # LOGGING & CONFIG
 # ---------------------------------------------------------------------------
 
+_LOG_FH = None  # History log, opened once and kept open for the session
+
+
 def ensure_directories():
     """Create necessary directories."""
     os.makedirs(ROOT_DIR, exist_ok=True)
     os.makedirs(LOG_DIR, exist_ok=True)
     os.makedirs(BACKUP_DIR, exist_ok=True)
+    _open_log()
+
+
+def _open_log():
+    """Open HISTORY_FILE for appending (line-buffered) and close it at exit."""
+    global _LOG_FH
+    if _LOG_FH is None:
+        _LOG_FH = open(HISTORY_FILE, "a", encoding="utf-8", buffering=1)
+        atexit.register(_LOG_FH.close)
+    return _LOG_FH
 
 
 def log_operation(operation: str, details: str):
     """Log operations to history file."""
     try:
         timestamp = datetime.now().isoformat()
-        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[{timestamp}] {operation}: {details}\n")
+        _open_log().write(f"[{timestamp}] {operation}: {details}\n")
     except Exception as e:
         print(f"{FG_YELLOW}Warning: Could not write to log: {e}{RESET}")
 
@@ -151,25 +246,52 @@ def load_config() -> Dict:
 def save_config(config: Dict):
     """Save user configuration."""
     try:
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2)
+        # Write beside the target and swap it in, so a crash never leaves half a file
+        tmp_path = CONFIG_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(config, indent=2))
+        os.replace(tmp_path, CONFIG_FILE)
     except Exception as e:
         print(f"{FG_YELLOW}Warning: Could not save config: {e}{RESET}")
 
 
+def default_model() -> str:
+    """Pick the largest model tier that fits comfortably in unified memory."""
+    try:
+        ram_gb = round(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**30)
+    except (ValueError, OSError, AttributeError):
+        return DEFAULT_MODEL
+    # Same tiers as the README: 7B from 16GB, 3B on 8GB machines
+    if ram_gb >= 16:
+        return DEFAULT_MODEL
+    if ram_gb >= 8:
+        return MODEL_ALIASES["q3b"]
+    return MODEL_ALIASES["q1.5b"]
+
+
 # ---------------------------------------------------------------------------
 # UTILS: SAFE PATHS
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
+def _real_root() -> str:
+    """Resolved ROOT_DIR, computed once after the sandbox exists."""
+    return os.path.realpath(ROOT_DIR)
+
+
 def is_safe_path(path: str) -> bool:
     """True if path is inside ROOT_DIR."""
-    root = os.path.realpath(ROOT_DIR)
-    target = os.path.realpath(path)
-    return target == root or target.startswith(root + os.sep)
+    return in_sandbox(os.path.realpath(path))
+
+
+def in_sandbox(real_path: str) -> bool:
+    """is_safe_path() for a path that is already resolved (as resolve_path returns)."""
+    root = _real_root()
+    return real_path == root or real_path.startswith(root + os.sep)
 
 
 def resolve_path(user_path: str, current_dir: str) -> str:
-    """Resolve a user path (relative or absolute) within ROOT_DIR."""
+    """Resolve a user path (relative or absolute); check it with in_sandbox()."""
     if not user_path:
         return os.path.realpath(current_dir)
     if os.path.isabs(user_path):
@@ -180,31 +302,83 @@ def resolve_path(user_path: str, current_dir: str) -> str:
     return real
 
 
+def tildify(path: str) -> str:
+    """Show a sandbox path with ROOT_DIR abbreviated to ~."""
+    if path == ROOT_DIR or path.startswith(ROOT_DIR + os.sep):
+        return "~" + path[len(ROOT_DIR):]
+    return path
+
+
 def is_allowed_file(path: str) -> bool:
     """Check if file extension is allowed for modification."""
     ext = os.path.splitext(path)[1].lower()
     return ext in ALLOWED_EXTENSIONS or ext == ''
 
 
+def read_text(path: str) -> str:
+    """Read a UTF-8 file with one read and one decode (newlines normalized like open())."""
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def read_text_cached(path: str) -> str:
+    """read_text() memoized on (path, mtime, size) for files that are read repeatedly."""
+    st = os.stat(path)
+    return _read_text_at(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_text_at(path: str, mtime_ns: int, size: int) -> str:
+    return read_text(path)
+
+
+def write_text(path: str, text: str):
+    """Encode once and write the whole file in a single call."""
+    with open(path, "wb") as f:
+        f.write(text.encode("utf-8"))
+    _read_text_at.cache_clear()
+
+
 # ---------------------------------------------------------------------------
 # PROJECT DETECTION
 # ---------------------------------------------------------------------------
 
+PROJECT_MARKERS = {
+    "python": ["requirements.txt", "setup.py", "pyproject.toml", "Pipfile"],
+    "nodejs": ["package.json", "yarn.lock", "pnpm-lock.yaml"],
+    "rust": ["Cargo.toml"],
+    "go": ["go.mod"],
+    "java": ["pom.xml", "build.gradle"],
+    "ruby": ["Gemfile"],
+    "php": ["composer.json"],
+}
+
+
 def detect_project_type(cwd: str) -> Optional[str]:
     """Detect project type based on files present."""
-    markers = {
-        "python": ["requirements.txt", "setup.py", "pyproject.toml", "Pipfile"],
-        "nodejs": ["package.json", "yarn.lock", "pnpm-lock.yaml"],
-        "rust": ["Cargo.toml"],
-        "go": ["go.mod"],
-        "java": ["pom.xml", "build.gradle"],
-        "ruby": ["Gemfile"],
-        "php": ["composer.json"],
-    }
+    try:
+        # Adding or removing a marker file bumps the directory mtime
+        mtime = os.stat(cwd).st_mtime_ns
+    except OSError:
+        return None
+    return _detect_project_type(cwd, mtime)
+
 
-    for project_type, files in markers.items():
+@functools.lru_cache(maxsize=64)
+def _detect_project_type(cwd: str, mtime: int) -> Optional[str]:
+    """One directory listing instead of an exists() probe per marker."""
+    try:
+        with os.scandir(cwd) as it:
+            names = {entry.name for entry in it}
+    except OSError:
+        return None
+
+    for project_type, files in PROJECT_MARKERS.items():
         for marker in files:
-            if os.path.exists(os.path.join(cwd, marker)):
+            if marker in names:
                 return project_type
     return None
 
@@ -213,6 +387,46 @@ def detect_project_type(cwd: str) -> Optional[str]:
 # BACKUP SYSTEM
 # ---------------------------------------------------------------------------
 
+def _reflink(src: str, dst: str) -> bool:
+    """Clone src to dst copy-on-write (APFS clonefile / Linux FICLONE)."""
+    try:
+        if sys.platform == "darwin":
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+        if sys.platform.startswith("linux"):
+            import fcntl
+            FICLONE = 0x40049409
+            with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                except OSError:
+                    cloned = False
+            if not cloned:
+                os.remove(dst)  # Don't leave an empty file behind
+                return False
+            shutil.copystat(src, dst)
+            return True
+    except Exception:
+        pass
+    return False
+
+
+def _detach_hardlink(path: str):
+    """Give path a fresh inode so rewriting it can't alter a hardlinked backup."""
+    if BACKUP_MODE != "hardlink":
+        return
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if st.st_nlink > 1:
+        os.unlink(path)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, st.st_mode & 0o7777))
+
+
 def create_backup(file_path: str) -> Optional[str]:
     """Create a timestamped backup of a file before modification."""
     if not os.path.exists(file_path):
@@ -225,6 +439,14 @@ def create_backup(file_path: str) -> Optional[str]:
         backup_path = os.path.join(BACKUP_DIR, backup_name)
 
         os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+        if BACKUP_MODE != "copy" and _reflink(file_path, backup_path):
+            return backup_path
+        if BACKUP_MODE == "hardlink":
+            try:
+                os.link(file_path, backup_path)
+                return backup_path
+            except OSError:
+                pass
         shutil.copy2(file_path, backup_path)
         return backup_path
     except Exception as e:
@@ -235,11 +457,15 @@ def create_backup(file_path: str) -> Optional[str]:
 def list_backups(file_path: str = None) -> List[str]:
     """List available backups for a file or all backups."""
     try:
-        backups = sorted(os.listdir(BACKUP_DIR), reverse=True)
+        prefix = ""
         if file_path:
             rel_path = os.path.relpath(file_path, ROOT_DIR)
             prefix = rel_path.replace(os.sep, '_')
-            backups = [b for b in backups if b.startswith(prefix)]
+        with os.scandir(BACKUP_DIR) as it:
+            backups = [e.name for e in it if e.name.startswith(prefix)]
+        # Newest first by the _YYYYmmdd_HHMMSS suffix; no stat needed (and copy2
+        # keeps the source's mtime, so st_mtime wouldn't be the backup time anyway)
+        backups.sort(key=lambda name: (name[-15:], name), reverse=True)
         return backups
     except Exception:
         return []
@@ -251,7 +477,10 @@ def restore_backup(backup_name: str, target_path: str) -> bool:
         backup_path = os.path.join(BACKUP_DIR, backup_name)
         if not os.path.exists(backup_path):
             return False
+        _detach_hardlink(target_path)
         shutil.copy2(backup_path, target_path)
+        # copy2 restores the backup's mtime, which a cached read could mistake for current
+        _read_text_at.cache_clear()
         return True
     except Exception as e:
         print(f"{FG_RED}Error restoring backup: {e}{RESET}")
@@ -262,76 +491,298 @@ def restore_backup(backup_name: str, target_path: str) -> bool:
 # FILE TREE
 # ---------------------------------------------------------------------------
 
-def print_tree(directory: str, prefix: str = "", max_depth: int = 3, current_depth: int = 0):
+def print_tree(directory: str, prefix: str = "", max_depth: int = 3, current_depth: int = 0,
+               ignores: tuple = (), out: List[str] = None):
     """Print directory tree structure."""
     if current_depth >= max_depth:
         return
 
+    # The outermost call collects every line and writes the tree at once
+    if out is None:
+        out = []
+        print_tree(directory, prefix, max_depth, current_depth, ignores, out)
+        if out:
+            out.append("")
+        sys.stdout.write("\n".join(out))
+        return
+
     try:
-        entries = sorted(os.listdir(directory))
-        entries = [e for e in entries if not e.startswith('.')]
+        # DirEntry caches the file type from the directory read (no extra stat)
+        with os.scandir(directory) as it:
+            entries = list(it)
+        if any(e.name == ".gitignore" for e in entries):
+            ignores = with_gitignore(directory, ignores)
+        entries = sorted(
+            (e for e in entries if not is_ignored(e.path, e.is_dir(), ignores)),
+            key=lambda e: e.name,
+        )
 
         for i, entry in enumerate(entries):
-            path = os.path.join(directory, entry)
             is_last = i == len(entries) - 1
 
             connector = "└── " if is_last else "├── "
-            if os.path.isdir(path):
-                print(f"{prefix}{connector}{FG_BLUE}{entry}/{RESET}")
+            if entry.is_dir():
+                out.append(f"{prefix}{connector}{FG_BLUE}{entry.name}/{RESET}")
                 extension = "    " if is_last else "│   "
-                print_tree(path, prefix + extension, max_depth, current_depth + 1)
+                print_tree(entry.path, prefix + extension, max_depth, current_depth + 1, ignores, out)
             else:
-                print(f"{prefix}{connector}{entry}")
+                out.append(f"{prefix}{connector}{entry.name}")
     except PermissionError:
-        print(f"{prefix}{FG_RED}[Permission Denied]{RESET}")
+        out.append(f"{prefix}{FG_RED}[Permission Denied]{RESET}")
+
+
+def load_gitignore(directory: str):
+    """Parse directory/.gitignore into a PathSpec, or None if unavailable."""
+    if pathspec is None:
+        return None
+    try:
+        with open(os.path.join(directory, ".gitignore"), "r", encoding="utf-8", errors="ignore") as f:
+            return pathspec.PathSpec.from_lines("gitwildmatch", f)
+    except OSError:
+        return None
+
+
+def with_gitignore(directory: str, ignores: tuple) -> tuple:
+    """ignores plus (directory, spec) for directory/.gitignore, which applies below it."""
+    spec = load_gitignore(directory)
+    return ignores + ((directory, spec),) if spec is not None else ignores
+
+
+def is_ignored(path: str, is_dir: bool, ignores: tuple = ()) -> bool:
+    """True if a walker should skip path (hidden, in SKIP_DIRS or .gitignore'd).
+
+    ignores holds the (directory, PathSpec) pairs of every .gitignore above path.
+    """
+    name = os.path.basename(path)
+    if name.startswith('.'):
+        return True
+    if is_dir and name in SKIP_DIRS:
+        return True
+    for base, spec in ignores:
+        rel = os.path.relpath(path, base).replace(os.sep, "/")
+        if spec.match_file(rel + "/" if is_dir else rel):
+            return True
+    return False
 
 
 # ---------------------------------------------------------------------------
 # GREP FUNCTIONALITY
 # ---------------------------------------------------------------------------
 
+LINE_START_RE = re.compile(r"^", re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=None)
+def _io_pool() -> ThreadPoolExecutor:
+    """Shared worker threads for file scanning, started once and reused by every /grep."""
+    return ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2))
+
+
 def grep_files(pattern: str, directory: str, extensions: set = None) -> List[Tuple[str, int, str]]:
     """Search for pattern in files. Returns list of (file, line_num, line_content)."""
+    rg = shutil.which("rg")
+    if rg:
+        results = _grep_ripgrep(rg, pattern, directory, extensions)
+        if results is not None:
+            return results
+
     results = []
     try:
         regex = re.compile(pattern, re.IGNORECASE)
+        # Whole-text prefilter: ^/$ must also match at line boundaries.
+        # \A and \Z only make sense per line, so visit every line for those.
+        if "\\A" in pattern or "\\Z" in pattern:
+            scan = LINE_START_RE
+        else:
+            scan = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+
+        # Collect candidates first, then scan them concurrently (file I/O releases the GIL)
+        allowed = frozenset(extensions) if extensions else None
+        ignores_by_dir = {}  # Directory -> .gitignore specs that apply in it
+        paths = []
+        add_path = paths.append
+        join = os.path.join
         for root, dirs, files in os.walk(directory):
-            # Skip hidden directories
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            ignores = ignores_by_dir.pop(root, ())
+            if ".gitignore" in files:
+                ignores = with_gitignore(root, ignores)
+
+            # Prune hidden, build and .gitignore'd directories before descending
+            dirs[:] = [d for d in dirs if not is_ignored(join(root, d), True, ignores)]
+            for d in dirs:
+                ignores_by_dir[join(root, d)] = ignores
 
             for file in files:
                 if file.startswith('.'):
                     continue
 
-                file_path = os.path.join(root, file)
-                ext = os.path.splitext(file)[1]
+                # Check the extension before building the full path
+                if allowed is not None:
+                    dot = file.rfind('.')
+                    if dot < 0 or file[dot:] not in allowed:
+                        continue
 
-                if extensions and ext not in extensions:
+                file_path = join(root, file)
+                if ignores and is_ignored(file_path, False, ignores):
                     continue
 
-                try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        for line_num, line in enumerate(f, 1):
-                            if regex.search(line):
-                                results.append((file_path, line_num, line.rstrip()))
-                except Exception:
-                    continue
+                add_path(file_path)
+
+        for matches in _io_pool().map(lambda p: _grep_file(p, regex, scan), paths):
+            results.extend(matches)
     except Exception as e:
         print(f"{FG_RED}Error during search: {e}{RESET}")
 
     return results
 
 
+def _grep_file(file_path: str, regex, scan) -> List[Tuple[str, int, str]]:
+    """Search one file without iterating it line by line.
+
+    The whole text is searched at once with scan; each hit is then confirmed
+    against its own line with regex so results match a per-line grep exactly.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except Exception:
+        return []
+    # Skip binary files, as ripgrep does: a NUL near the start means not text
+    if b"\0" in data[:8192]:
+        return []
+    text = data.decode('utf-8', errors='ignore')
+    if "\r" in text:
+        # Same universal-newline handling as text-mode open()
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    results = []
+    search = regex.search
+    scan_search = scan.search
+    size = len(text)
+    pos = 0
+    line_num = 1
+    counted = 0
+    while pos < size:
+        m = scan_search(text, pos)
+        if not m:
+            break
+        start = text.rfind("\n", 0, m.start()) + 1
+        if start >= size:
+            break  # Empty match after the final newline is not a line
+        end = text.find("\n", m.start())
+        if end < 0:
+            end = size
+        line = text[start:end + 1]
+        # A match may span several lines; only count it if the line matches alone
+        if search(line):
+            line_num += text.count("\n", counted, start)
+            counted = start
+            results.append((file_path, line_num, line.rstrip()))
+        pos = end + 1
+    return results
+
+
+def _grep_ripgrep(rg: str, pattern: str, directory: str, extensions: set = None) -> Optional[List[Tuple[str, int, str]]]:
+    """Search with ripgrep. Returns None if rg failed (e.g. unsupported regex syntax)."""
+    # rg honors .gitignore itself; --no-require-git matches load_gitignore outside repos.
+    # Only the .gitignore files inside the tree count, as in the Python fallback.
+    cmd = [rg, "--json", "--no-require-git", "--no-ignore-parent", "--no-ignore-global",
+           "--no-ignore-exclude", "--no-ignore-dot", "-i", "-e", pattern]
+    for ext in sorted(extensions or ()):
+        cmd.append(f"--glob=*{ext}")
+    for name in sorted(SKIP_DIRS):
+        cmd.append(f"--glob=!{name}/")
+    cmd += ["--", directory]
+
+    results = []
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for raw in proc.stdout:
+            record = json.loads(raw)
+            if record.get("type") != "match":
+                continue
+            data = record["data"]
+            path = _rg_text(data["path"])
+            line = _rg_text(data["lines"])
+            results.append((path, data["line_number"], line.rstrip()))
+        proc.wait()
+    except Exception:
+        return None
+
+    # Exit code 2 means an error; trust partial output only if rg found something
+    if proc.returncode == 2 and not results:
+        return None
+
+    results.sort(key=lambda r: (r[0], r[1]))
+    return results
+
+
+def _rg_text(field: Dict) -> str:
+    """Decode a ripgrep JSON text field ({"text": ...} or base64 {"bytes": ...})."""
+    if "text" in field:
+        return field["text"]
+    return base64.b64decode(field["bytes"]).decode('utf-8', errors='ignore')
+
+
+# ---------------------------------------------------------------------------
+# RESPONSE CACHE
+# ---------------------------------------------------------------------------
+
+class ResponseCache:
+    """On-disk LRU of finished responses, keyed by the full prompt.
+
+    Decoding is greedy, so the same prompt on the same model yields the same
+    answer; a hit skips generation entirely.
+    """
+
+    def __init__(self, path: str, max_entries: int = RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.commit()
+        atexit.register(self.db.close)
+
+    @staticmethod
+    def make_key(prompt: str, model_name: str, max_tokens: int) -> str:
+        payload = json.dumps([model_name, max_tokens, prompt])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return row[0]
+
+    def put(self, key: str, response: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, used) VALUES (?, ?, ?)",
+            (key, response, time.time()),
+        )
+        self.db.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.db.commit()
+
+
 # ---------------------------------------------------------------------------
 # PROMPT / CHAT SESSION
 # ---------------------------------------------------------------------------
 
 class ChatSession:
-    def __init__(self, model_name: str, max_tokens: int, ctx_chars: int):
+    def __init__(self, model_name: str, max_tokens: int, ctx_chars: int,
+                 draft_model_name: Optional[str] = None, preload: bool = True):
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.ctx_chars = ctx_chars
         self.history: List[Tuple[str, str]] = []
+        self.history_chars = 0  # Running len() total of history texts; see add_message()
         self.opened_files: List[str] = []
         self.last_query: str = ""
         self.last_modified_files: List[str] = []
@@ -341,18 +792,192 @@ class ChatSession:
             "tokens_generated": 0,
         }
 
+        # Loaded by _ensure_loaded(), at construction or on the first ask()
+        self.model = None
+        self.tokenizer = None
+        self.draft_model = None
+        self.draft_model_name = None
+        self._requested_draft = draft_model_name
+
+        self.system_prompt = self._build_system_prompt()
+
+        # KV cache reused across turns; _cache_tokens mirrors what it holds
+        self.prompt_cache = None
+        self._main_cache_len = 0  # Layers in prompt_cache that belong to the main model
+        self._cache_tokens: List[int] = []
+        self._system_tokens: List[int] = []
+        # Tokenized history entries, keyed by id() so each message is encoded once
+        self._segment_tokens: Dict[int, Tuple[Tuple[str, str], List[int]]] = {}
+
+        try:
+            self.response_cache = ResponseCache(RESPONSE_CACHE_FILE)
+        except sqlite3.Error as e:
+            print(f"{FG_YELLOW}Warning: Response cache disabled: {e}{RESET}")
+            self.response_cache = None
+        self._interrupted = False
+
+        if preload and not self._ensure_loaded(warmup=True):
+            sys.exit(1)
+
+    def _ensure_loaded(self, warmup: bool = False) -> bool:
+        """Import mlx-lm and load the model(s) if not done yet. False if loading failed."""
+        if self.model is not None:
+            return True
+
         spinner = Spinner("Loading model")
         spinner.start()
         try:
-            self.model, self.tokenizer = load(model_name)
+            _import_mlx()
+            self.model, self.tokenizer = load(self.model_name)
             spinner.stop()
             print(f"{FG_GREEN}✓ Model loaded successfully{RESET}")
         except Exception as e:
             spinner.stop()
             print(f"{FG_RED}✗ Failed to load model: {e}{RESET}")
-            sys.exit(1)
+            return False
 
-        self.system_prompt = self._build_system_prompt()
+        if self._requested_draft and self._requested_draft != self.model_name:
+            self._load_draft_model(self._requested_draft)
+
+        self._init_prompt_cache()
+        # Only worth it when the load happens ahead of the first query
+        if warmup:
+            self._warmup()
+        return True
+
+    def _warmup(self):
+        """Run one throwaway decode step so Metal kernels are built before the first query."""
+        if not HAS_PROMPT_CACHE:
+            return
+
+        try:
+            token = self.tokenizer.encode("Hi")[-1]
+            cache = make_prompt_cache(self.model)
+            mx.eval(self.model(mx.array([[token]]), cache=cache))
+        except Exception as e:
+            # Not fatal: the first query just pays the kernel build cost instead
+            print(f"{FG_YELLOW}Warning: Model warmup skipped: {e}{RESET}")
+
+    def _load_draft_model(self, draft_model_name: str):
+        """Load the speculative decoding draft model; on any problem run without it."""
+        if stream_generate is None or "draft_model" not in inspect.signature(stream_generate).parameters:
+            print(f"{FG_YELLOW}Warning: This mlx-lm has no speculative decoding; draft model ignored{RESET}")
+            return
+
+        spinner = Spinner("Loading draft model")
+        spinner.start()
+        try:
+            draft_model, draft_tokenizer = load(draft_model_name)
+        except Exception as e:
+            spinner.stop()
+            print(f"{FG_YELLOW}Warning: Draft model not loaded: {e}{RESET}")
+            return
+        spinner.stop()
+
+        # Draft tokens are verified by id, so both models must share a vocabulary
+        if getattr(draft_tokenizer, "vocab_size", None) != getattr(self.tokenizer, "vocab_size", None):
+            print(f"{FG_YELLOW}Warning: Draft model {draft_model_name} has a different vocabulary; ignored{RESET}")
+            return
+
+        self.draft_model = draft_model
+        self.draft_model_name = draft_model_name
+        print(f"{FG_GREEN}✓ Draft model loaded ({draft_model_name.split('/')[-1]}){RESET}")
+
+    def _make_prompt_cache(self) -> List:
+        """Fresh KV cache; with a draft model, its layers follow the main model's."""
+        cache = make_prompt_cache(self.model)
+        self._main_cache_len = len(cache)
+        if self.draft_model is not None:
+            cache += make_prompt_cache(self.draft_model)
+        return cache
+
+    def _init_prompt_cache(self):
+        """Prefill the system prompt once so later turns only prefill the delta."""
+        if not HAS_PROMPT_CACHE or stream_generate is None:
+            return
+
+        try:
+            tokens = list(self.tokenizer.encode(self.system_prompt))
+            self._system_tokens = tokens
+            metadata = {
+                "model": self.model_name,
+                "draft_model": self.draft_model_name or "",
+                "tokens": json.dumps(tokens),
+            }
+
+            # Reuse the prefix persisted by a previous run if it still matches
+            if os.path.exists(KV_CACHE_FILE):
+                try:
+                    cache, saved = load_prompt_cache(KV_CACHE_FILE, return_metadata=True)
+                    if saved == metadata:
+                        self.prompt_cache = cache
+                        self._main_cache_len = len(make_prompt_cache(self.model))
+                        self._cache_tokens = tokens
+                        return
+                except Exception:
+                    pass
+
+            self.prompt_cache = self._make_prompt_cache()
+            self._prefill(tokens)
+            self._cache_tokens = tokens
+            save_prompt_cache(KV_CACHE_FILE, self.prompt_cache, metadata)
+        except Exception as e:
+            print(f"{FG_YELLOW}Warning: Prompt cache disabled: {e}{RESET}")
+            self.prompt_cache = None
+            self._cache_tokens = []
+
+    def _prefill(self, tokens: List[int], step: int = 512):
+        """Run tokens through the model(s) to populate self.prompt_cache."""
+        split = self._main_cache_len
+        models = [(self.model, self.prompt_cache[:split])]
+        if self.draft_model is not None:
+            models.append((self.draft_model, self.prompt_cache[split:]))
+        for model, cache in models:
+            for i in range(0, len(tokens), step):
+                model(mx.array(tokens[i:i + step])[None], cache=cache)
+                mx.eval([c.state for c in cache])
+
+    def _reuse_prompt_cache(self, tokens: List[int]) -> List[int]:
+        """Trim the cache to the prefix shared with tokens and return the rest.
+
+        History trimming or /clear changes earlier parts of the prompt; in that
+        case the cache is rolled back to the common prefix (or rebuilt).
+        """
+        common = 0
+        for cached, new in zip(self._cache_tokens, tokens):
+            if cached != new:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)  # always feed at least one token
+
+        stale = len(self._cache_tokens) - common
+        if stale > 0:
+            if can_trim_prompt_cache(self.prompt_cache):
+                trim_prompt_cache(self.prompt_cache, stale)
+            else:
+                self.prompt_cache = self._make_prompt_cache()
+                common = 0
+
+        self._cache_tokens = tokens[:common]
+        return tokens[common:]
+
+    def _align_draft_cache(self, offset: int) -> Optional[int]:
+        """Trim main and draft caches to the same length after speculative decoding.
+
+        The draft cache can end a few tokens ahead of or behind the main one;
+        returns the shared offset, or None if the caches can't be trimmed.
+        """
+        split = self._main_cache_len
+        main, draft = self.prompt_cache[:split], self.prompt_cache[split:]
+        draft_offset = getattr(draft[0], "offset", None)
+        if draft_offset is None or not can_trim_prompt_cache(self.prompt_cache):
+            return None
+        common = min(offset, draft_offset)
+        if offset > common:
+            trim_prompt_cache(main, offset - common)
+        if draft_offset > common:
+            trim_prompt_cache(draft, draft_offset - common)
+        return common
 
     def _build_system_prompt(self) -> str:
         return textwrap.dedent(
@@ -400,8 +1025,8 @@ class ChatSession:
             """
         ).strip()
 
-    def _build_prompt(self, user_message: str, current_dir: str, project_type: Optional[str]) -> str:
-        """Build full prompt including system + history + context."""
+    def _build_user_turn(self, user_message: str, current_dir: str, project_type: Optional[str]) -> str:
+        """Current user message prefixed with working-directory context."""
         context_parts = [f"Current working directory: {current_dir}"]
 
         if project_type:
@@ -411,18 +1036,46 @@ class ChatSession:
             context_parts.append(f"Files in context: {', '.join(self.opened_files)}")
 
         context = "\n".join(context_parts)
-        user_with_ctx = f"{context}\n\n{user_message}"
+        return f"User: {context}\n\n{user_message}"
 
+    def _build_prompt(self, user_message: str, current_dir: str, project_type: Optional[str]) -> str:
+        """Build full prompt including system + history + context."""
         parts: List[str] = [self.system_prompt, ""]
 
         # Add prioritized history
         for role, txt in self._get_prioritized_history():
             parts.append(f"{role.capitalize()}: {txt}")
 
-        parts.append(f"User: {user_with_ctx}")
+        parts.append(self._build_user_turn(user_message, current_dir, project_type))
         parts.append("Assistant:")
         return "\n\n".join(parts)
 
+    def _build_prompt_tokens(self, user_message: str, current_dir: str, project_type: Optional[str]) -> List[int]:
+        """Token-level equivalent of _build_prompt.
+
+        The system prompt and every history message are tokenized once and
+        reused, so each turn only encodes the new user message.
+        """
+        tokens = self._system_tokens + self._encode_segment("\n\n\n\n")
+
+        segments = {}
+        for entry in self._get_prioritized_history():
+            cached = self._segment_tokens.get(id(entry))
+            if cached is None or cached[0] is not entry:
+                role, txt = entry
+                cached = (entry, self._encode_segment(f"{role.capitalize()}: {txt}\n\n"))
+            segments[id(entry)] = cached
+            tokens += cached[1]
+        self._segment_tokens = segments  # drop messages no longer in the prompt
+
+        user_turn = self._build_user_turn(user_message, current_dir, project_type)
+        tokens += self._encode_segment(f"{user_turn}\n\nAssistant:")
+        return tokens
+
+    def _encode_segment(self, text: str) -> List[int]:
+        """Tokenize a piece of the prompt without BOS/special tokens."""
+        return list(self.tokenizer.encode(text, add_special_tokens=False))
+
     def _get_prioritized_history(self) -> List[Tuple[str, str]]:
         """Get history with intelligent prioritization."""
         if not self.history:
@@ -431,26 +1084,27 @@ class ChatSession:
         # Always keep last 3 exchanges
         recent = self.history[-6:] if len(self.history) >= 6 else self.history
 
-        # Add file context messages
+        # Add file context messages (older than recent, so never duplicated)
         file_messages = [
             (r, t) for r, t in self.history[:-6]
             if "Opened file" in t or "```file:" in t
         ]
 
-        # Combine and ensure uniqueness
-        combined = file_messages + recent
-        seen = set()
-        result = []
-        for r, t in combined:
-            if t not in seen:
-                result.append((r, t))
-                seen.add(t)
+        return file_messages + recent
 
-        return result
+    def add_message(self, role: str, txt: str):
+        """Append to history, keeping history_chars in step."""
+        self.history.append((role, txt))
+        self.history_chars += len(txt)
+
+    def clear_history(self):
+        """Drop every message (and the character count with it)."""
+        self.history.clear()
+        self.history_chars = 0
 
     def _trim_history(self):
         """Smart context control by character budget."""
-        total = sum(len(t) for _, t in self.history)
+        total = self.history_chars
         if total <= self.ctx_chars:
             return
 
@@ -470,16 +1124,64 @@ class ChatSession:
                 role, txt = self.history.pop(0)
                 total -= len(txt)
 
+        self.history_chars = total
+
     def ask(self, user_message: str, current_dir: str, project_type: Optional[str] = None) -> str:
-        """Send a query to the model."""
+        """Send a query to the model, printing the response as it is generated."""
         self.last_query = user_message
         self.stats["queries"] += 1
 
-        prompt = self._build_prompt(user_message, current_dir, project_type)
+        cache_key = None
+        if self.response_cache is not None:
+            prompt = self._build_prompt(user_message, current_dir, project_type)
+            cache_key = ResponseCache.make_key(prompt, self.model_name, self.max_tokens)
+            try:
+                response = self.response_cache.get(cache_key)
+            except sqlite3.Error:
+                response = None
+            if response is not None:
+                print_colored_response(response)
+                print(f"{DIM}(cached response){RESET}")
+                self.add_message("user", user_message)
+                self.add_message("assistant", response)
+                self._trim_history()
+                return response
+
+        if not self._ensure_loaded():
+            return "Error generating response: model not loaded"
+
+        self._interrupted = False
+        try:
+            if stream_generate is None:
+                prompt = self._build_prompt(user_message, current_dir, project_type)
+                response = self._generate_blocking(prompt)
+            elif self.prompt_cache is None:
+                prompt = self._build_prompt(user_message, current_dir, project_type)
+                response = self._generate_streaming(prompt)
+            else:
+                prompt = self._build_prompt_tokens(user_message, current_dir, project_type)
+                response = self._generate_streaming(prompt)
+        except Exception as e:
+            return f"Error generating response: {e}"
+
+        # Only complete answers are worth replaying
+        if cache_key is not None and not self._interrupted:
+            try:
+                self.response_cache.put(cache_key, response)
+            except sqlite3.Error:
+                pass
+
+        # Update history
+        self.add_message("user", user_message)
+        self.add_message("assistant", response)
+        self._trim_history()
+
+        return response
 
+    def _generate_blocking(self, prompt: str) -> str:
+        """Generate the full response at once (mlx-lm without stream_generate)."""
         spinner = Spinner("Generating response")
         spinner.start()
-
         try:
             response = generate(
                 self.model,
@@ -488,80 +1190,143 @@ class ChatSession:
                 max_tokens=self.max_tokens,
                 verbose=False,
             )
+        finally:
             spinner.stop()
-        except Exception as e:
-            spinner.stop()
-            return f"Error generating response: {e}"
 
         if not isinstance(response, str):
             response = str(response)
 
-        # Update statistics
         self.stats["tokens_generated"] += len(response.split())
+        print_colored_response(response)
+        return response
 
-        # Update history
-        self.history.append(("user", user_message))
-        self.history.append(("assistant", response))
-        self._trim_history()
+    def _generate_streaming(self, prompt) -> str:
+        """Stream tokens to the terminal as they are decoded. Ctrl-C stops early.
 
-        return response
+        prompt is a string, or a token list when the prompt cache is active.
+        """
+        spinner = Spinner("Generating response")
+        spinner.start()
+
+        response_parts: List[str] = []
+        pending = ""
+        in_code = False
+        token_count = 0
+
+        kwargs = {}
+        if self.prompt_cache is not None:
+            prompt = self._reuse_prompt_cache(prompt)
+            kwargs["prompt_cache"] = self.prompt_cache
+        if self.draft_model is not None:
+            kwargs["draft_model"] = self.draft_model
+            kwargs["num_draft_tokens"] = NUM_DRAFT_TOKENS
+        generated: List[int] = []
+
+        try:
+            for chunk in stream_generate(
+                self.model,
+                self.tokenizer,
+                prompt=prompt,
+                max_tokens=self.max_tokens,
+                **kwargs,
+            ):
+                if token_count == 0:
+                    spinner.stop()
+                token_count += 1
+                generated.append(chunk.token)
+                response_parts.append(chunk.text)
+
+                # Color complete lines as soon as they arrive
+                pending += chunk.text
+                while "\n" in pending:
+                    line, pending = pending.split("\n", 1)
+                    colored, in_code = _color_line(line, in_code)
+                    print(colored, flush=True)
+        except KeyboardInterrupt:
+            spinner.stop()
+            self._interrupted = True
+            print(f"\n{FG_YELLOW}(generation interrupted){RESET}")
+        finally:
+            spinner.stop()
+            if self.prompt_cache is not None:
+                # The cache now also holds the generated tokens
+                offset = getattr(self.prompt_cache[0], "offset", None)
+                if offset is not None and self.draft_model is not None:
+                    offset = self._align_draft_cache(offset)
+                if offset is None:
+                    self.prompt_cache = None  # Not a positional KV cache; can't reuse
+                else:
+                    self._cache_tokens = (self._cache_tokens + prompt + generated)[:offset]
+
+        if pending:
+            colored, in_code = _color_line(pending, in_code)
+            print(colored, flush=True)
+
+        self.stats["tokens_generated"] += token_count
+        return "".join(response_parts)
 
 
 # ---------------------------------------------------------------------------
 # PARSING ASSISTANT OUTPUT
 # ---------------------------------------------------------------------------
 
-FILE_BLOCK_RE = re.compile(
-    r"```file:(?P<path>[^\n\r]+)\n(?P<content>.*?)(?:```|\Z)",
-    re.DOTALL,
-)
-
-CODE_BLOCK_RE = re.compile(
-    r"```(?P<lang>[^\n\r]*)\n(?P<content>.*?)(?:```|\Z)",
-    re.DOTALL,
-)
+# Prefer RE2 (linear-time, no backtracking) for scanning long responses
+try:
+    import re2
 
+    CODE_BLOCK_RE = re2.compile(
+        r"(?s)```(?P<lang>[^\n\r]*)\n(?P<content>.*?)(?:```|\z)"
+    )
+except ImportError:
+    CODE_BLOCK_RE = re.compile(
+        r"```(?P<lang>[^\n\r]*)\n(?P<content>.*?)(?:```|\Z)",
+        re.DOTALL,
+    )
 
-def extract_file_blocks(text: str):
-    """Return list of dicts with path/content from ```file:...``` blocks."""
-    blocks = []
-    for m in FILE_BLOCK_RE.finditer(text):
-        path = m.group("path").strip()
-        content = m.group("content")
-        blocks.append({"path": path, "content": content})
-    return blocks
 
+def extract_blocks(text: str) -> Tuple[List[Dict], List[Dict]]:
+    """Split fenced blocks in one pass.
 
-def extract_code_blocks(text: str):
-    """Return list of generic fenced code blocks (not file: blocks)."""
-    blocks = []
+    Returns (file_blocks, code_blocks): dicts with path/content for
+    ```file:...``` blocks and lang/content for every other fence.
+    """
+    file_blocks = []
+    code_blocks = []
     for m in CODE_BLOCK_RE.finditer(text):
-        if m.group("lang").strip().startswith("file:"):
-            continue
         lang = m.group("lang").strip()
-        content = m.group("content")
-        blocks.append({"lang": lang, "content": content})
-    return blocks
+        if lang.startswith("file:"):
+            path = lang[5:].strip()
+            if path:
+                file_blocks.append({"path": path, "content": m.group("content")})
+            continue
+        code_blocks.append({"lang": lang, "content": m.group("content")})
+    return file_blocks, code_blocks
+
+
+def _color_line(line: str, in_code: bool) -> Tuple[str, bool]:
+    """Color a single line of assistant output. Returns (colored_line, in_code)."""
+    # f-strings join in one allocation; chained + builds a temporary per operator
+    if line.lstrip().startswith("```"):
+        return f"{FG_YELLOW}{line}{RESET}", not in_code
+
+    if in_code:
+        return f"{FG_MAGENTA}{line}{RESET}", in_code
+    # Bold for headers
+    if line.startswith("#"):
+        return f"{BOLD}{FG_CYAN}{line}{RESET}", in_code
+    return f"{FG_CYAN}{line}{RESET}", in_code
 
 
 def print_colored_response(text: str):
     """Markdown-aware coloring for assistant output."""
-    lines = text.splitlines()
     in_code = False
-    for line in lines:
-        if line.strip().startswith("```"):
-            print(FG_YELLOW + line + RESET)
-            in_code = not in_code
-            continue
-
-        if in_code:
-            print(FG_MAGENTA + line + RESET)
-        else:
-            # Bold for headers
-            if line.startswith("#"):
-                print(BOLD + FG_CYAN + line + RESET)
-            else:
-                print(FG_CYAN + line + RESET)
+    out = []
+    for line in text.splitlines():
+        colored, in_code = _color_line(line, in_code)
+        out.append(colored)
+    # One write for the whole response instead of one per line
+    out.append("")
+    sys.stdout.write("\n".join(out))
 
 
 def print_diff(old: str, new: str, path_display: str):
@@ -578,16 +1343,20 @@ def print_diff(old: str, new: str, path_display: str):
         lineterm="",
     )
 
+    # Color every line first, then emit the whole diff in one write
+    out = []
+    append = out.append
     for line in diff:
         if line.startswith("+") and not line.startswith("+++"):
-            print(FG_GREEN + line + RESET)
+            append(f"{FG_GREEN}{line}{RESET}")
         elif line.startswith("-") and not line.startswith("---"):
-            print(FG_RED + line + RESET)
+            append(f"{FG_RED}{line}{RESET}")
         elif line.startswith("@@"):
-            print(FG_YELLOW + line + RESET)
+            append(f"{FG_YELLOW}{line}{RESET}")
         else:
-            print(DIM + line + RESET)
-    print(f"{FG_WHITE}{BOLD}{'─' * 60}{RESET}\n")
+            append(f"{DIM}{line}{RESET}")
+    out.append(f"{FG_WHITE}{BOLD}{'─' * 60}{RESET}\n\n")
+    sys.stdout.write("\n".join(out))
 
 
 def apply_file_changes(blocks, current_dir: str, session: ChatSession):
@@ -604,7 +1373,7 @@ def apply_file_changes(blocks, current_dir: str, session: ChatSession):
         abs_path = resolve_path(rel_path, current_dir)
 
         # Safety checks
-        if not is_safe_path(abs_path):
+        if not in_sandbox(abs_path):
             print(f"{BG_RED}{FG_WHITE} BLOCKED {RESET} {FG_RED}Path outside sandbox: {abs_path}{RESET}")
             log_operation("BLOCKED_WRITE", abs_path)
             continue
@@ -621,8 +1390,7 @@ def apply_file_changes(blocks, current_dir: str, session: ChatSession):
         old_content = ""
         if os.path.exists(abs_path):
             try:
-                with open(abs_path, "r", encoding="utf-8") as f:
-                    old_content = f.read()
+                old_content = read_text(abs_path)
             except Exception as e:
                 print(f"{FG_RED}Cannot read existing file {abs_path}: {e}{RESET}")
                 continue
@@ -687,8 +1455,8 @@ def _write_file(change: Dict, session: ChatSession):
 
         # Write new content
         os.makedirs(os.path.dirname(change["path"]), exist_ok=True)
-        with open(change["path"], "w", encoding="utf-8") as f:
-            f.write(change["new"])
+        _detach_hardlink(change["path"])
+        write_text(change["path"], change["new"])
 
         print(f"{FG_GREEN}  ✓ Wrote {change['display']}{RESET}")
 
@@ -702,9 +1470,8 @@ def _write_file(change: Dict, session: ChatSession):
         log_operation("FILE_WRITE_ERROR", f"{change['path']}: {e}")
 
 
-def maybe_save_code_block(text: str, current_dir: str, session: ChatSession):
+def maybe_save_code_block(blocks: List[Dict], current_dir: str, session: ChatSession):
     """Offer to save code blocks that aren't in file: format."""
-    blocks = extract_code_blocks(text)
     if not blocks:
         return
 
@@ -733,15 +1500,14 @@ def maybe_save_code_block(text: str, current_dir: str, session: ChatSession):
         print(f"{FG_CYAN}Using filename: {ans}{RESET}")
 
     abs_path = resolve_path(ans, current_dir)
-    if not is_safe_path(abs_path):
+    if not in_sandbox(abs_path):
         print(f"{FG_RED}Cannot save outside sandbox {ROOT_DIR}{RESET}")
         return
 
     old_content = ""
     if os.path.exists(abs_path):
         try:
-            with open(abs_path, "r", encoding="utf-8") as f:
-                old_content = f.read()
+            old_content = read_text(abs_path)
         except Exception as e:
             print(f"{FG_RED}Error reading existing file: {e}{RESET}")
 
@@ -771,11 +1537,11 @@ def maybe_save_code_block(text: str, current_dir: str, session: ChatSession):
 def handle_tree(parts: List[str], cwd: str):
     """Handle /tree command."""
     if len(parts) > 1:
-        target = resolve_path(" ".join(parts[1:]), cwd)
+        target = resolve_path(parts[1], cwd)
     else:
         target = cwd
 
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot access outside sandbox{RESET}")
         return
 
@@ -797,11 +1563,11 @@ def handle_grep(parts: List[str], cwd: str):
 
     pattern = parts[1]
     if len(parts) > 2:
-        target = resolve_path(" ".join(parts[2:]), cwd)
+        target = resolve_path(parts[2], cwd)
     else:
         target = cwd
 
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot search outside sandbox{RESET}")
         return
 
@@ -812,13 +1578,18 @@ def handle_grep(parts: List[str], cwd: str):
         print(f"{FG_YELLOW}No matches found.{RESET}")
         return
 
-    print(f"\n{FG_GREEN}Found {len(results)} match(es):{RESET}\n")
+    out = [f"\n{FG_GREEN}Found {len(results)} match(es):{RESET}\n"]
+    rel_paths = {}  # Hits cluster by file; compute each relpath once
     for file_path, line_num, line_content in results[:50]:  # Limit to 50 results
-        rel_path = os.path.relpath(file_path, ROOT_DIR)
-        print(f"{FG_BLUE}{rel_path}{RESET}:{FG_YELLOW}{line_num}{RESET}: {line_content}")
+        rel_path = rel_paths.get(file_path)
+        if rel_path is None:
+            rel_path = rel_paths[file_path] = os.path.relpath(file_path, ROOT_DIR)
+        out.append(f"{FG_BLUE}{rel_path}{RESET}:{FG_YELLOW}{line_num}{RESET}: {line_content}")
 
     if len(results) > 50:
-        print(f"\n{FG_YELLOW}... and {len(results) - 50} more matches{RESET}")
+        out.append(f"\n{FG_YELLOW}... and {len(results) - 50} more matches{RESET}")
+    out.append("")
+    sys.stdout.write("\n".join(out))
 
 
 def handle_diff(parts: List[str], cwd: str):
@@ -830,15 +1601,13 @@ def handle_diff(parts: List[str], cwd: str):
     file1 = resolve_path(parts[1], cwd)
     file2 = resolve_path(parts[2], cwd)
 
-    if not is_safe_path(file1) or not is_safe_path(file2):
+    if not in_sandbox(file1) or not in_sandbox(file2):
         print(f"{FG_RED}Cannot access files outside sandbox{RESET}")
         return
 
     try:
-        with open(file1, 'r', encoding='utf-8') as f:
-            content1 = f.read()
-        with open(file2, 'r', encoding='utf-8') as f:
-            content2 = f.read()
+        content1 = read_text(file1)
+        content2 = read_text(file2)
 
         rel1 = os.path.relpath(file1, ROOT_DIR)
         rel2 = os.path.relpath(file2, ROOT_DIR)
@@ -866,13 +1635,12 @@ def handle_template(parts: List[str], cwd: str, session: ChatSession) -> Optiona
         return None
 
     file_path = resolve_path(parts[2], cwd)
-    if not is_safe_path(file_path) or not os.path.isfile(file_path):
+    if not in_sandbox(file_path) or not os.path.isfile(file_path):
         print(f"{FG_RED}Invalid file: {file_path}{RESET}")
         return None
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = read_text_cached(file_path)
 
         return TEMPLATES[template_name] + f"```\n{content}\n```"
     except Exception as e:
@@ -883,7 +1651,7 @@ def handle_template(parts: List[str], cwd: str, session: ChatSession) -> Optiona
 def handle_backups(parts: List[str], cwd: str):
     """Handle /backups command."""
     if len(parts) > 1:
-        file_path = resolve_path(" ".join(parts[1:]), cwd)
+        file_path = resolve_path(parts[1], cwd)
         backups = list_backups(file_path)
     else:
         backups = list_backups()
@@ -892,12 +1660,13 @@ def handle_backups(parts: List[str], cwd: str):
         print(f"{FG_YELLOW}No backups found.{RESET}")
         return
 
-    print(f"\n{FG_CYAN}Available backups ({len(backups)}):{RESET}\n")
-    for backup in backups[:20]:  # Show last 20
-        print(f"  {backup}")
+    out = [f"\n{FG_CYAN}Available backups ({len(backups)}):{RESET}\n"]
+    out.extend(f"  {backup}" for backup in backups[:20])  # Show last 20
 
     if len(backups) > 20:
-        print(f"\n{FG_YELLOW}... and {len(backups) - 20} more{RESET}")
+        out.append(f"\n{FG_YELLOW}... and {len(backups) - 20} more{RESET}")
+    out.append("")
+    sys.stdout.write("\n".join(out))
 
 
 def handle_restore(parts: List[str], cwd: str):
@@ -909,7 +1678,7 @@ def handle_restore(parts: List[str], cwd: str):
     backup_name = parts[1]
     target_path = resolve_path(parts[2], cwd)
 
-    if not is_safe_path(target_path):
+    if not in_sandbox(target_path):
         print(f"{FG_RED}Cannot restore outside sandbox{RESET}")
         return
 
@@ -939,8 +1708,7 @@ def handle_stats(session: ChatSession):
 # UI
 # ---------------------------------------------------------------------------
 
-def print_banner():
-    logo = r"""
+_BANNER = FG_MAGENTA + r"""
 ███╗   ███╗██╗     ██╗  ██╗      ██████╗  ██████╗ ██████╗ ███████╗
 ████╗ ████║██║     ██║ ██╔╝     ██╔════╝ ██╔═══██╗██╔══██╗██╔════╝
 ██╔████╔██║██║     █████╔╝   ███╗██║  ███╗██║   ██║██████╔╝█████╗
@@ -949,78 +1717,424 @@ def print_banner():
 ╚═╝     ╚═╝╚══════╝╚═╝  ╚═╝       ╚═════╝  ╚═════╝ ╚═╝  ╚═╝╚══════╝
 
           🚀 Enhanced Local Coding Assistant 🚀
-"""
-    print(FG_MAGENTA + logo + RESET)
+""" + RESET + "\n"
+
+# Everything in /help that doesn't depend on the session, built once
+_HELP_BODY = "\n".join([
+    "",
+    "CORE COMMANDS:",
+    f"  {FG_GREEN}/help{RESET}              Show this help",
+    f"  {FG_GREEN}/exit{RESET}              Quit the assistant",
+    f"  {FG_GREEN}/clear{RESET}             Clear chat history",
+    "",
+    "MODEL CONFIGURATION:",
+    f"  {FG_GREEN}/model <id>{RESET}         Switch model (HuggingFace ID)",
+    f"  {FG_GREEN}/q7b{RESET}               Quick: Qwen2.5 Coder 7B 4bit",
+    f"  {FG_GREEN}/q3b{RESET}               Quick: Qwen2.5 Coder 3B 4bit",
+    f"  {FG_GREEN}/tokens <n>{RESET}         Set max tokens per response",
+    f"  {FG_GREEN}/ctx <n>{RESET}            Set context size (chars)",
+    "",
+    "NAVIGATION & FILES:",
+    f"  {FG_GREEN}/pwd{RESET}                Show current directory",
+    f"  {FG_GREEN}/cd <path>{RESET}          Change directory",
+    f"  {FG_GREEN}/ls [path]{RESET}          List directory contents",
+    f"  {FG_GREEN}/tree [path]{RESET}        Show directory tree",
+    f"  {FG_GREEN}/open <file>{RESET}        Load file into context",
+    f"  {FG_GREEN}/grep <pattern>{RESET}     Search in files",
+    f"  {FG_GREEN}/diff <f1> <f2>{RESET}     Compare two files",
+    "",
+    "TEMPLATES & WORKFLOWS:",
+    f"  {FG_GREEN}/template{RESET}           List available templates",
+    f"  {FG_GREEN}/template <name> <file>{RESET}  Apply template to file",
+    f"    Available: {', '.join(TEMPLATES.keys())}",
+    "",
+    "BACKUP & HISTORY:",
+    f"  {FG_GREEN}/backups [file]{RESET}     List backups",
+    f"  {FG_GREEN}/restore <bk> <file>{RESET} Restore from backup",
+    f"  {FG_GREEN}/save [file]{RESET}        Export chat to markdown",
+    f"  {FG_GREEN}/last{RESET}               Repeat last query",
+    f"  {FG_GREEN}/edit{RESET}               Open last modified file in $EDITOR",
+    "",
+    "INFORMATION:",
+    f"  {FG_GREEN}/stats{RESET}              Show session statistics",
+    f"  {FG_GREEN}/project{RESET}            Detect project type",
+    "",
+    "TIPS:",
+    "  • Multi-line input: finish with an empty line",
+    "  • Files are automatically backed up before modification",
+    "  • Use /tree to understand project structure",
+    "  • Templates speed up common tasks",
+    "=" * 80,
+    "",
+])
+
+
+def print_banner():
+    sys.stdout.write(_BANNER)
 
 
 def print_help(model_name: str, cwd: str, max_tokens: int, ctx_chars: int):
-    print("=" * 80)
-    print(" MLX-CODE — Enhanced Local Coding Assistant")
-    print("=" * 80)
-    print(f"Model:  {FG_CYAN}{model_name}{RESET}")
-    print(f"Sandbox: {FG_CYAN}{ROOT_DIR}{RESET}")
-    print(f"Logs:   {FG_CYAN}{LOG_DIR}{RESET}")
-    print()
-    print("CORE COMMANDS:")
-    print(f"  {FG_GREEN}/help{RESET}              Show this help")
-    print(f"  {FG_GREEN}/exit{RESET}              Quit the assistant")
-    print(f"  {FG_GREEN}/clear{RESET}             Clear chat history")
-    print()
-    print("MODEL CONFIGURATION:")
-    print(f"  {FG_GREEN}/model <id>{RESET}         Switch model (HuggingFace ID)")
-    print(f"  {FG_GREEN}/q7b{RESET}               Quick: Qwen2.5 Coder 7B 4bit")
-    print(f"  {FG_GREEN}/q3b{RESET}               Quick: Qwen2.5 Coder 3B 4bit")
-    print(f"  {FG_GREEN}/tokens <n>{RESET}         Set max tokens per response")
-    print(f"  {FG_GREEN}/ctx <n>{RESET}            Set context size (chars)")
-    print()
-    print("NAVIGATION & FILES:")
-    print(f"  {FG_GREEN}/pwd{RESET}                Show current directory")
-    print(f"  {FG_GREEN}/cd <path>{RESET}          Change directory")
-    print(f"  {FG_GREEN}/ls [path]{RESET}          List directory contents")
-    print(f"  {FG_GREEN}/tree [path]{RESET}        Show directory tree")
-    print(f"  {FG_GREEN}/open <file>{RESET}        Load file into context")
-    print(f"  {FG_GREEN}/grep <pattern>{RESET}     Search in files")
-    print(f"  {FG_GREEN}/diff <f1> <f2>{RESET}     Compare two files")
-    print()
-    print("TEMPLATES & WORKFLOWS:")
-    print(f"  {FG_GREEN}/template{RESET}           List available templates")
-    print(f"  {FG_GREEN}/template <name> <file>{RESET}  Apply template to file")
-    print(f"    Available: {', '.join(TEMPLATES.keys())}")
-    print()
-    print("BACKUP & HISTORY:")
-    print(f"  {FG_GREEN}/backups [file]{RESET}     List backups")
-    print(f"  {FG_GREEN}/restore <bk> <file>{RESET} Restore from backup")
-    print(f"  {FG_GREEN}/save [file]{RESET}        Export chat to markdown")
-    print(f"  {FG_GREEN}/last{RESET}               Repeat last query")
-    print(f"  {FG_GREEN}/edit{RESET}               Open last modified file in $EDITOR")
-    print()
-    print("INFORMATION:")
-    print(f"  {FG_GREEN}/stats{RESET}              Show session statistics")
-    print(f"  {FG_GREEN}/project{RESET}            Detect project type")
-    print()
-    print("TIPS:")
-    print("  • Multi-line input: finish with an empty line")
-    print("  • Files are automatically backed up before modification")
-    print("  • Use /tree to understand project structure")
-    print("  • Templates speed up common tasks")
-    print("=" * 80)
-    print(f"CWD: {FG_CYAN}{cwd}{RESET} | "
-          f"Tokens: {FG_CYAN}{max_tokens}{RESET} | "
-          f"Context: {FG_CYAN}{ctx_chars}{RESET}")
-    print("=" * 80)
+    rule = "=" * 80
+    sys.stdout.write(
+        f"{rule}\n"
+        " MLX-CODE — Enhanced Local Coding Assistant\n"
+        f"{rule}\n"
+        f"Model:  {FG_CYAN}{model_name}{RESET}\n"
+        f"Sandbox: {FG_CYAN}{ROOT_DIR}{RESET}\n"
+        f"Logs:   {FG_CYAN}{LOG_DIR}{RESET}\n"
+    )
+    sys.stdout.write(_HELP_BODY)
+    sys.stdout.write(
+        f"CWD: {FG_CYAN}{cwd}{RESET} | "
+        f"Tokens: {FG_CYAN}{max_tokens}{RESET} | "
+        f"Context: {FG_CYAN}{ctx_chars}{RESET}\n"
+        f"{rule}\n"
+    )
+
+
+_STATUS_TEMPLATE = "=" * 80 + "\n {model} | {cwd}{project}\n" + "=" * 80 + "\n"
 
 
 def print_status(model_name: str, cwd: str, max_tokens: int, ctx_chars: int, project_type: Optional[str]):
-    print("=" * 80)
     model_short = model_name.split('/')[-1][:30]
-    cwd_short = cwd.replace(ROOT_DIR, "~")
+    project = f" | {FG_YELLOW}{project_type}{RESET}" if project_type else ""
+    sys.stdout.write(_STATUS_TEMPLATE.format(model=model_short, cwd=tildify(cwd), project=project))
+
+
+# ---------------------------------------------------------------------------
+# APP STATE (shared mutable state for command handlers)
+# ---------------------------------------------------------------------------
+
+class AppState:
+    """Mutable application state shared across command handlers."""
+
+    def __init__(self, model_name: str, max_tokens: int, ctx_chars: int, cwd: str,
+                 draft_model: Optional[str] = None):
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.ctx_chars = ctx_chars
+        self.cwd = cwd
+        self.draft_model = draft_model  # As written in config.json (alias or model id)
+        self.session = self._new_session()
+        self.project_type = detect_project_type(cwd)
+        self.buffer: List[str] = []
+
+    def _new_session(self, preload: bool = False) -> ChatSession:
+        # At startup the model loads on the first query, so /help, /ls etc. stay instant
+        draft_model_name = MODEL_ALIASES.get(self.draft_model, self.draft_model)
+        return ChatSession(self.model_name, self.max_tokens, self.ctx_chars, draft_model_name, preload)
+
+    def reload_session(self):
+        """Load state.model_name into a fresh ChatSession."""
+        self.session = self._new_session(preload=True)
+
+    def print_status(self):
+        print_status(self.model_name, self.cwd, self.max_tokens, self.ctx_chars, self.project_type)
+
+
+# ---------------------------------------------------------------------------
+# COMMAND HANDLERS (each returns a signal: None=continue, "break"=exit)
+# ---------------------------------------------------------------------------
+
+def cmd_exit(parts: List[str], state: AppState) -> Optional[str]:
+    config = {
+        "model": state.model_name,
+        "max_tokens": state.max_tokens,
+        "ctx_chars": state.ctx_chars,
+        "backup_mode": BACKUP_MODE,
+        "draft_model": state.draft_model,
+    }
+    save_config(config)
+    print("Configuration saved. Goodbye! 👋")
+    return "break"
+
+
+def cmd_help(parts: List[str], state: AppState) -> None:
+    print_help(state.model_name, state.cwd, state.max_tokens, state.ctx_chars)
+    state.print_status()
+
+
+def cmd_clear(parts: List[str], state: AppState) -> None:
+    state.session.clear_history()
+    state.session.opened_files.clear()
+    print(f"{FG_GREEN}✓ Chat history cleared{RESET}")
+
+
+def cmd_model(parts: List[str], state: AppState) -> None:
+    if len(parts) < 2:
+        print(f"{FG_RED}Usage: /model <huggingface-model-id>{RESET}")
+        return
+    _switch_model(parts[1].strip(), state)
+
+
+def cmd_model_alias(parts: List[str], state: AppState) -> None:
+    _switch_model(MODEL_ALIASES[parts[0].lower()[1:]], state)
+
+
+def _switch_model(new_model: str, state: AppState) -> None:
+    # Reloading is the slowest thing the loop can do, and it drops the history
+    if new_model == state.session.model_name:
+        print(f"{FG_YELLOW}Already using {new_model}{RESET}")
+        return
+    state.model_name = new_model
+    state.reload_session()
+    state.print_status()
+
+
+def cmd_tokens(parts: List[str], state: AppState) -> None:
+    if len(parts) != 2 or not parts[1].isdigit():
+        print(f"{FG_RED}Usage: /tokens <number>{RESET}")
+        return
+    state.max_tokens = int(parts[1])
+    state.session.max_tokens = state.max_tokens
+    print(f"{FG_GREEN}✓ Max tokens set to {state.max_tokens}{RESET}")
+
+
+def cmd_ctx(parts: List[str], state: AppState) -> None:
+    if len(parts) != 2 or not parts[1].isdigit():
+        print(f"{FG_RED}Usage: /ctx <number>{RESET}")
+        return
+    state.ctx_chars = int(parts[1])
+    state.session.ctx_chars = state.ctx_chars
+    print(f"{FG_GREEN}✓ Context size set to {state.ctx_chars} chars{RESET}")
+
+
+def cmd_pwd(parts: List[str], state: AppState) -> None:
+    rel = tildify(state.cwd)
+    print(f"{FG_CYAN}{rel}{RESET}")
+
+
+def cmd_cd(parts: List[str], state: AppState) -> None:
+    if len(parts) < 2:
+        print(f"{FG_RED}Usage: /cd <path>{RESET}")
+        return
+    target = resolve_path(parts[1], state.cwd)
+    if not in_sandbox(target):
+        print(f"{FG_RED}Cannot cd outside sandbox{RESET}")
+        return
+    if not os.path.isdir(target):
+        print(f"{FG_RED}No such directory: {target}{RESET}")
+        return
+    state.cwd = target
+    os.chdir(state.cwd)
+    state.project_type = detect_project_type(state.cwd)
+    state.print_status()
+
+
+def cmd_ls(parts: List[str], state: AppState) -> None:
+    if len(parts) > 1:
+        target = resolve_path(parts[1], state.cwd)
+    else:
+        target = state.cwd
+    if not in_sandbox(target):
+        print(f"{FG_RED}Cannot list outside sandbox{RESET}")
+        return
+    if not os.path.isdir(target):
+        print(f"{FG_RED}No such directory: {target}{RESET}")
+        return
+    # DirEntry.is_dir() reuses the type from the directory read
+    with os.scandir(target) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    out = [f"{FG_BLUE}{e.name}/{RESET}" if e.is_dir() else e.name for e in entries]
+    if out:
+        out.append("")
+    sys.stdout.write("\n".join(out))
+
+
+def cmd_open(parts: List[str], state: AppState) -> None:
+    if len(parts) < 2:
+        print(f"{FG_RED}Usage: /open <file>{RESET}")
+        return
+    target = resolve_path(parts[1], state.cwd)
+    if not in_sandbox(target):
+        print(f"{FG_RED}Cannot open outside sandbox{RESET}")
+        return
+    if not os.path.isfile(target):
+        print(f"{FG_RED}No such file: {target}{RESET}")
+        return
+    try:
+        content = read_text_cached(target)
+    except Exception as e:
+        print(f"{FG_RED}Error reading file: {e}{RESET}")
+        return
+
+    rel = os.path.relpath(target, ROOT_DIR)
+    pseudo_message = f"Opened file {rel}:\n\n{BACKTICKS}\n{content}\n{BACKTICKS}"
+    state.session.add_message("user", pseudo_message)
+    state.session.opened_files.append(rel)
+    print(f"{FG_GREEN}✓ Loaded {rel} into context{RESET}")
+
+
+def cmd_template(parts: List[str], state: AppState) -> None:
+    template_query = handle_template(parts, state.cwd, state.session)
+    if template_query:
+        state.buffer = [template_query]
+        print(f"{FG_CYAN}Template prepared. Press Enter to send.{RESET}")
+
+
+def cmd_save(parts: List[str], state: AppState) -> None:
+    if len(parts) > 1:
+        out_path_raw = parts[1]
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        out_path_raw = f"mlx-session-{timestamp}.md"
+    out_path = resolve_path(out_path_raw, state.cwd)
+    if not in_sandbox(out_path):
+        print(f"{FG_RED}Cannot save outside sandbox{RESET}")
+        return
+
+    # Per-process temp name, so two sessions saving to the same file don't share it
+    tmp_path = f"{out_path}.mlx-tmp-{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        # Stream the export instead of joining it in memory; replace atomically
+        try:
+            with open(tmp_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+                w = f.write
+                w("# MLX-CODE Session Export\n")
+                w(f"**Model:** {state.model_name}\n")
+                w(f"**Date:** {datetime.now().isoformat()}\n")
+                w(f"**Project:** {state.project_type or 'Unknown'}\n")
+                w("\n---\n\n")
+                for role, txt in state.session.history:
+                    w("## 👤 User\n\n" if role == "user" else "## 🤖 Assistant\n\n")
+                    w(txt)
+                    w("\n\n---\n\n")
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            # Failed or interrupted: don't leave the partial export behind
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        rel = os.path.relpath(out_path, ROOT_DIR)
+        print(f"{FG_GREEN}✓ Saved session to {rel}{RESET}")
+    except Exception as e:
+        print(f"{FG_RED}Error saving session: {e}{RESET}")
+
+
+def cmd_last(parts: List[str], state: AppState) -> None:
+    if state.session.last_query:
+        state.buffer = [state.session.last_query]
+        print(f"{FG_CYAN}Repeating last query. Press Enter to send.{RESET}")
+    else:
+        print(f"{FG_YELLOW}No previous query to repeat{RESET}")
+
 
-    status_line = f" {model_short} | {cwd_short}"
-    if project_type:
-        status_line += f" | {FG_YELLOW}{project_type}{RESET}"
+def cmd_edit(parts: List[str], state: AppState) -> None:
+    if not state.session.last_modified_files:
+        print(f"{FG_YELLOW}No files have been modified yet{RESET}")
+        return
+    editor = os.environ.get("EDITOR", "nano")
+    last_file = state.session.last_modified_files[-1]
+    print(f"{FG_CYAN}Opening {last_file} in {editor}...{RESET}")
+    # No shell: paths with spaces work, and EDITOR may carry flags ("code -w")
+    try:
+        subprocess.run(shlex.split(editor) + [last_file], check=False)
+    except (OSError, ValueError) as e:
+        print(f"{FG_RED}Could not start editor: {e}{RESET}")
 
-    print(status_line)
-    print("=" * 80)
+
+def cmd_project(parts: List[str], state: AppState) -> None:
+    detected = detect_project_type(state.cwd)
+    if detected:
+        print(f"{FG_GREEN}Detected project type: {detected}{RESET}")
+    else:
+        print(f"{FG_YELLOW}Could not detect project type{RESET}")
+
+
+# Command dispatcher table
+COMMAND_DISPATCH = {
+    "/exit": cmd_exit,
+    "/help": cmd_help,
+    "/clear": cmd_clear,
+    "/model": cmd_model,
+    "/q7b": cmd_model_alias,
+    "/q3b": cmd_model_alias,
+    "/q1.5b": cmd_model_alias,
+    "/tokens": cmd_tokens,
+    "/ctx": cmd_ctx,
+    "/pwd": cmd_pwd,
+    "/cd": cmd_cd,
+    "/ls": cmd_ls,
+    "/tree": lambda parts, state: handle_tree(parts, state.cwd),
+    "/grep": lambda parts, state: handle_grep(parts, state.cwd),
+    "/diff": lambda parts, state: handle_diff(parts, state.cwd),
+    "/open": cmd_open,
+    "/template": cmd_template,
+    "/backups": lambda parts, state: handle_backups(parts, state.cwd),
+    "/restore": lambda parts, state: handle_restore(parts, state.cwd),
+    "/save": cmd_save,
+    "/last": cmd_last,
+    "/edit": cmd_edit,
+    "/stats": lambda parts, state: handle_stats(state.session),
+    "/project": cmd_project,
+}
+
+# Commands whose last argument is a path: split only this many times so the
+# path keeps its spaces verbatim (default: split on every run of whitespace)
+COMMAND_MAXSPLIT = {
+    "/cd": 1,
+    "/ls": 1,
+    "/tree": 1,
+    "/open": 1,
+    "/backups": 1,
+    "/save": 1,
+    "/grep": 2,
+    "/template": 2,
+    "/restore": 2,
+}
+
+
+# ---------------------------------------------------------------------------
+# LINE EDITING (readline history + tab completion)
+# ---------------------------------------------------------------------------
+
+def setup_readline():
+    """Persist input history and complete /commands and paths with Tab."""
+    if readline is None:
+        return
+
+    try:
+        readline.read_history_file(REPL_HISTORY_FILE)
+    except OSError:
+        pass
+    readline.set_history_length(1000)
+    atexit.register(_save_readline_history)
+
+    # Complete whole tokens so paths keep their directory part
+    readline.set_completer_delims(" \t\n")
+    readline.set_completer(_complete)
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")  # macOS system Python
+    else:
+        readline.parse_and_bind("tab: complete")
+
+
+def _save_readline_history():
+    try:
+        readline.write_history_file(REPL_HISTORY_FILE)
+    except OSError:
+        pass
+
+
+_completions: List[str] = []
+
+
+def _complete(text: str, state: int) -> Optional[str]:
+    """readline completer: commands for the first word, paths elsewhere."""
+    global _completions
+    if state == 0:
+        line = readline.get_line_buffer()
+        if text.startswith("/") and not line[:readline.get_begidx()].strip():
+            _completions = sorted(c for c in COMMAND_DISPATCH if c.startswith(text))
+        else:
+            _completions = [
+                p + "/" if os.path.isdir(p) else p
+                for p in sorted(glob.glob(os.path.expanduser(text) + "*"))
+            ]
+    return _completions[state] if state < len(_completions) else None
 
 
 # ---------------------------------------------------------------------------
@@ -1028,32 +2142,40 @@ def print_status(model_name: str, cwd: str, max_tokens: int, ctx_chars: int, pro
 # ---------------------------------------------------------------------------
 
 def main():
+    global BACKUP_MODE
+
     ensure_directories()
 
     # Initialize
     cwd = os.getcwd()
     if not is_safe_path(cwd):
-        cwd = ROOT_DIR
+        cwd = _real_root()  # Commands treat cwd as resolved
         os.chdir(cwd)
 
     config = load_config()
-    model_name = config.get("model", DEFAULT_MODEL)
+    model_name = config.get("model") or default_model()
     max_tokens = config.get("max_tokens", DEFAULT_MAX_TOKENS)
     ctx_chars = config.get("ctx_chars", DEFAULT_CTX_CHARS)
+    if config.get("backup_mode") in BACKUP_MODES:
+        BACKUP_MODE = config["backup_mode"]
+
+    setup_readline()
 
     print_banner()
     print_help(model_name, cwd, max_tokens, ctx_chars)
 
-    session = ChatSession(model_name, max_tokens, ctx_chars)
-    project_type = detect_project_type(cwd)
-
-    print_status(model_name, cwd, max_tokens, ctx_chars, project_type)
+    state = AppState(model_name, max_tokens, ctx_chars, cwd, config.get("draft_model"))
+    state.print_status()
 
-    buffer: List[str] = []
+    # readline must be told the color codes take no space (\001...\002) or wrapping breaks
+    if readline is not None and sys.stdin.isatty():
+        prompt = f"\001{FG_GREEN}\002>\001{RESET}\002 "
+    else:
+        prompt = f"{FG_GREEN}>{RESET} "
 
     while True:
         try:
-            line = input(f"{FG_GREEN}>{RESET} ")
+            line = input(prompt)
         except (EOFError, KeyboardInterrupt):
             print("\n\nGoodbye! 👋")
             break
@@ -1062,281 +2184,42 @@ def main():
 
         # Empty line -> send buffer
         if stripped == "":
-            if buffer:
-                user_message = "\n".join(buffer)
-                buffer = []
+            if state.buffer:
+                user_message = "\n".join(state.buffer)
+                state.buffer = []
 
                 # Generate response
                 print(f"\n{FG_CYAN}Assistant:{RESET}\n")
-                response = session.ask(user_message, cwd, project_type)
-                print_colored_response(response)
+                response = state.session.ask(user_message, state.cwd, state.project_type)
 
                 # Handle file changes
-                blocks = extract_file_blocks(response)
-                if blocks:
-                    apply_file_changes(blocks, cwd, session)
+                file_blocks, code_blocks = extract_blocks(response)
+                if file_blocks:
+                    apply_file_changes(file_blocks, state.cwd, state.session)
                 else:
-                    maybe_save_code_block(response, cwd, session)
+                    maybe_save_code_block(code_blocks, state.cwd, state.session)
 
                 print()
-                continue
-            else:
-                continue
+            continue
 
         # Commands
         if stripped.startswith("/"):
-            parts = stripped.split()
-            cmd = parts[0].lower()
-
-            # Exit
-            if cmd == "/exit":
-                config = {
-                    "model": model_name,
-                    "max_tokens": max_tokens,
-                    "ctx_chars": ctx_chars,
-                }
-                save_config(config)
-                print("Configuration saved. Goodbye! 👋")
-                break
-
-            # Help
-            if cmd == "/help":
-                print_help(model_name, cwd, max_tokens, ctx_chars)
-                print_status(model_name, cwd, max_tokens, ctx_chars, project_type)
-                continue
+            cmd = stripped.split(None, 1)[0].lower()
+            parts = stripped.split(None, COMMAND_MAXSPLIT.get(cmd, -1))
 
-            # Clear
-            if cmd == "/clear":
-                session.history.clear()
-                session.opened_files.clear()
-                print(f"{FG_GREEN}✓ Chat history cleared{RESET}")
+            handler = COMMAND_DISPATCH.get(cmd)
+            if handler is None:
+                print(f"{FG_RED}Unknown command: {cmd}{RESET}")
+                print(f"{FG_YELLOW}Type /help for available commands{RESET}")
                 continue
 
-            # Model change
-            if cmd == "/model":
-                if len(parts) < 2:
-                    print(f"{FG_RED}Usage: /model <huggingface-model-id>{RESET}")
-                    continue
-                new_model = parts[1].strip()
-                model_name = new_model
-                session = ChatSession(model_name, max_tokens, ctx_chars)
-                print_status(model_name, cwd, max_tokens, ctx_chars, project_type)
-                continue
-
-            # Model aliases
-            if cmd in ("/q7b", "/q3b", "/q1.5b"):
-                key = cmd[1:]
-                new_model = MODEL_ALIASES.get(key)
-                if not new_model:
-                    print(f"{FG_RED}Alias {cmd} not configured{RESET}")
-                    continue
-                model_name = new_model
-                session = ChatSession(model_name, max_tokens, ctx_chars)
-                print_status(model_name, cwd, max_tokens, ctx_chars, project_type)
-                continue
-
-            # Tokens
-            if cmd == "/tokens":
-                if len(parts) != 2 or not parts[1].isdigit():
-                    print(f"{FG_RED}Usage: /tokens <number>{RESET}")
-                    continue
-                max_tokens = int(parts[1])
-                session.max_tokens = max_tokens
-                print(f"{FG_GREEN}✓ Max tokens set to {max_tokens}{RESET}")
-                continue
-
-            # Context
-            if cmd == "/ctx":
-                if len(parts) != 2 or not parts[1].isdigit():
-                    print(f"{FG_RED}Usage: /ctx <number>{RESET}")
-                    continue
-                ctx_chars = int(parts[1])
-                session.ctx_chars = ctx_chars
-                print(f"{FG_GREEN}✓ Context size set to {ctx_chars} chars{RESET}")
-                continue
-
-            # PWD
-            if cmd == "/pwd":
-                rel = cwd.replace(ROOT_DIR, "~")
-                print(f"{FG_CYAN}{rel}{RESET}")
-                continue
-
-            # CD
-            if cmd == "/cd":
-                if len(parts) < 2:
-                    print(f"{FG_RED}Usage: /cd <path>{RESET}")
-                    continue
-                target = resolve_path(" ".join(parts[1:]), cwd)
-                if not is_safe_path(target):
-                    print(f"{FG_RED}Cannot cd outside sandbox{RESET}")
-                    continue
-                if not os.path.isdir(target):
-                    print(f"{FG_RED}No such directory: {target}{RESET}")
-                    continue
-                cwd = target
-                os.chdir(cwd)
-                project_type = detect_project_type(cwd)
-                print_status(model_name, cwd, max_tokens, ctx_chars, project_type)
-                continue
-
-            # LS
-            if cmd == "/ls":
-                if len(parts) > 1:
-                    target = resolve_path(" ".join(parts[1:]), cwd)
-                else:
-                    target = cwd
-                if not is_safe_path(target):
-                    print(f"{FG_RED}Cannot list outside sandbox{RESET}")
-                    continue
-                if not os.path.isdir(target):
-                    print(f"{FG_RED}No such directory: {target}{RESET}")
-                    continue
-                entries = sorted(os.listdir(target))
-                for name in entries:
-                    full = os.path.join(target, name)
-                    if os.path.isdir(full):
-                        print(FG_BLUE + name + "/" + RESET)
-                    else:
-                        print(name)
-                continue
-
-            # TREE
-            if cmd == "/tree":
-                handle_tree(parts, cwd)
-                continue
-
-            # GREP
-            if cmd == "/grep":
-                handle_grep(parts, cwd)
-                continue
-
-            # DIFF
-            if cmd == "/diff":
-                handle_diff(parts, cwd)
-                continue
-
-            # OPEN
-            if cmd == "/open":
-                if len(parts) < 2:
-                    print(f"{FG_RED}Usage: /open <file>{RESET}")
-                    continue
-                target = resolve_path(" ".join(parts[1:]), cwd)
-                if not is_safe_path(target):
-                    print(f"{FG_RED}Cannot open outside sandbox{RESET}")
-                    continue
-                if not os.path.isfile(target):
-                    print(f"{FG_RED}No such file: {target}{RESET}")
-                    continue
-                try:
-                    with open(target, "r", encoding="utf-8") as f:
-                        content = f.read()
-                except Exception as e:
-                    print(f"{FG_RED}Error reading file: {e}{RESET}")
-                    continue
-
-                rel = os.path.relpath(target, ROOT_DIR)
-                pseudo_message = f"Opened file {rel}:\n\n{BACKTICKS}\n{content}\n{BACKTICKS}"
-                session.history.append(("user", pseudo_message))
-                session.opened_files.append(rel)
-                print(f"{FG_GREEN}✓ Loaded {rel} into context{RESET}")
-                continue
-
-            # TEMPLATE
-            if cmd == "/template":
-                template_query = handle_template(parts, cwd, session)
-                if template_query:
-                    buffer = [template_query]
-                    print(f"{FG_CYAN}Template prepared. Press Enter to send.{RESET}")
-                continue
-
-            # BACKUPS
-            if cmd == "/backups":
-                handle_backups(parts, cwd)
-                continue
-
-            # RESTORE
-            if cmd == "/restore":
-                handle_restore(parts, cwd)
-                continue
-
-            # SAVE
-            if cmd == "/save":
-                if len(parts) > 1:
-                    out_path_raw = " ".join(parts[1:])
-                else:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    out_path_raw = f"mlx-session-{timestamp}.md"
-                out_path = resolve_path(out_path_raw, cwd)
-                if not is_safe_path(out_path):
-                    print(f"{FG_RED}Cannot save outside sandbox{RESET}")
-                    continue
-
-                lines = [
-                    f"# MLX-CODE Session Export\n",
-                    f"**Model:** {model_name}\n",
-                    f"**Date:** {datetime.now().isoformat()}\n",
-                    f"**Project:** {project_type or 'Unknown'}\n",
-                    "\n---\n\n",
-                ]
-                for role, txt in session.history:
-                    if role == "user":
-                        lines.append("## 👤 User\n\n")
-                    else:
-                        lines.append("## 🤖 Assistant\n\n")
-                    lines.append(txt)
-                    lines.append("\n\n---\n\n")
-                try:
-                    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-                    with open(out_path, "w", encoding="utf-8") as f:
-                        f.write("".join(lines))
-                    rel = os.path.relpath(out_path, ROOT_DIR)
-                    print(f"{FG_GREEN}✓ Saved session to {rel}{RESET}")
-                except Exception as e:
-                    print(f"{FG_RED}Error saving session: {e}{RESET}")
-                continue
-
-            # LAST
-            if cmd == "/last":
-                if session.last_query:
-                    buffer = [session.last_query]
-                    print(f"{FG_CYAN}Repeating last query. Press Enter to send.{RESET}")
-                else:
-                    print(f"{FG_YELLOW}No previous query to repeat{RESET}")
-                continue
-
-            # EDIT
-            if cmd == "/edit":
-                if not session.last_modified_files:
-                    print(f"{FG_YELLOW}No files have been modified yet{RESET}")
-                    continue
-                editor = os.environ.get("EDITOR", "nano")
-                last_file = session.last_modified_files[-1]
-                print(f"{FG_CYAN}Opening {last_file} in {editor}...{RESET}")
-                os.system(f"{editor} {last_file}")
-                continue
-
-            # STATS
-            if cmd == "/stats":
-                handle_stats(session)
-                continue
-
-            # PROJECT
-            if cmd == "/project":
-                detected = detect_project_type(cwd)
-                if detected:
-                    print(f"{FG_GREEN}Detected project type: {detected}{RESET}")
-                else:
-                    print(f"{FG_YELLOW}Could not detect project type{RESET}")
-                continue
-
-            # Unknown command
-            print(f"{FG_RED}Unknown command: {cmd}{RESET}")
-            print(f"{FG_YELLOW}Type /help for available commands{RESET}")
+            if handler(parts, state) == "break":
+                break
             continue
 
         # Normal text -> add to buffer
-        buffer.append(line)
+        state.buffer.append(line)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
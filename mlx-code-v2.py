@@ -7,41 +7,83 @@ import sys
 import re
 import textwrap
 import difflib
+import fnmatch
+import functools
+import hashlib
+import heapq
+import importlib.util
+import itertools
 import json
+import mmap
 import shutil
+import sqlite3
+import struct
 import threading
 import time
-import glob
+import atexit
 import base64
+import codecs
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Tuple, Optional, Dict, Set
+from typing import List, Tuple, Optional, Dict, Set, NamedTuple
 from pathlib import Path
 
-try:
-    from mlx_lm import load, stream_generate
-except ImportError:
+# Heavy packages are only checked for here; they are imported on first use
+if importlib.util.find_spec("mlx_lm") is None:
     print("ERROR: mlx-lm not found. Install with: pip install mlx-lm")
     sys.exit(1)
 
-try:
-    from PIL import Image
+# mlx-lm takes a while to import, so _import_mlx() binds these on first use
+load = stream_generate = mx = None
+make_prompt_cache = can_trim_prompt_cache = trim_prompt_cache = None
+save_prompt_cache = load_prompt_cache = None
+HAS_PROMPT_CACHE = False
 
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+HAS_PROMPT_TOOLKIT = importlib.util.find_spec("prompt_toolkit") is not None
+if not HAS_PROMPT_TOOLKIT:
+    print("WARNING: prompt-toolkit not found. Install for better experience: pip install prompt-toolkit")
 
+# orjson is optional; it makes config/autosave/cache JSON much cheaper
 try:
-    from prompt_toolkit import PromptSession
-    from prompt_toolkit.history import FileHistory
-    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-    from prompt_toolkit.completion import WordCompleter
-    from prompt_toolkit.styles import Style
-    from prompt_toolkit.formatted_text import HTML
-    HAS_PROMPT_TOOLKIT = True
+    import orjson
+
+    def _dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    _loads = orjson.loads
 except ImportError:
-    HAS_PROMPT_TOOLKIT = False
-    print("WARNING: prompt-toolkit not found. Install for better experience: pip install prompt-toolkit")
+    def _dumps(obj, indent: bool = False) -> bytes:
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    _loads = json.loads
+
+
+@functools.lru_cache(maxsize=None)
+def _import_mlx():
+    """Import mlx / mlx-lm into the module globals (once)."""
+    global load, stream_generate, mx, HAS_PROMPT_CACHE
+    global make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache
+    global save_prompt_cache, load_prompt_cache
+
+    from mlx_lm import load, stream_generate
+
+    try:
+        import mlx.core as mx
+        from mlx_lm.models.cache import (
+            make_prompt_cache,
+            can_trim_prompt_cache,
+            trim_prompt_cache,
+            save_prompt_cache,
+            load_prompt_cache,
+        )
+        HAS_PROMPT_CACHE = True
+    except ImportError:
+        HAS_PROMPT_CACHE = False
 
 # ---------------------------------------------------------------------------
 # CONFIG
@@ -54,6 +96,18 @@ BACKUP_DIR = os.path.join(LOG_DIR, "backups")
 HISTORY_FILE = os.path.join(LOG_DIR, "history.log")
 CONFIG_FILE = os.path.join(LOG_DIR, "config.json")
 AUTOSAVE_FILE = os.path.join(LOG_DIR, "autosave.json")
+KV_CACHE_DIR = os.path.join(LOG_DIR, "kv_cache")  # Saved KV caches of project prefixes
+RESPONSE_CACHE_FILE = os.path.join(LOG_DIR, "response_cache.db")
+SEMANTIC_INDEX_FILE = os.path.join(LOG_DIR, "sem_index.bin")
+SEMANTIC_META_FILE = os.path.join(LOG_DIR, "sem_index.json")
+# HuggingFace model cache; honours the same variables huggingface_hub does
+HF_CACHE_DIR = os.environ.get("HF_HUB_CACHE") or os.path.join(
+    os.environ.get("HF_HOME") or os.path.expanduser("~/.cache/huggingface"), "hub")
+# Repo files mlx_lm.load() fetches; other weight formats in a repo are skipped
+HF_ALLOW_PATTERNS = [
+    "*.json", "*.safetensors", "*.py", "tokenizer.model",
+    "*.tiktoken", "tiktoken.model", "*.txt", "*.jsonl", "*.jinja",
+]
 
 DEFAULT_MODEL = "mlx-community/Qwen2.5-Coder-1.5B-Instruct-4bit"  # 1.5B - lightweight demo model (upgrade recommended)
 
@@ -88,9 +142,31 @@ MODEL_ALIASES = {
     "cl13b": "mlx-community/CodeLlama-13b-Instruct-hf-4bit",
 }
 
+# /models menu sections, in display order
+MODEL_CATEGORIES = {
+    "Qwen Coder (Recommended for Code)": ["q1.5b", "q3b", "q7b", "q14b", "q32b"],
+    "DeepSeek Coder (Excellent)": ["ds1.3b", "ds6.7b", "ds", "deepseek"],
+    "Mistral (Versatile)": ["mistral", "m7b"],
+    "Llama 3 (Strong Reasoning)": ["llama3-8b", "l3-8b"],
+    "Phi (Efficient)": ["phi3", "phi"],
+    "CodeLlama (Code Specialist)": ["codellama", "cl13b"],
+}
+
 DEFAULT_MAX_TOKENS = 1024
 DEFAULT_CTX_CHARS = 24000
 MAX_FILE_CONTEXT_CHARS = 15000  # Max chars for all loaded files combined in prompt
+READ_CACHE_MAX_FILE_BYTES = 256 * 1024  # Larger files are re-read rather than kept in memory
+KV_PREFIX_MIN_TOKENS = 256  # Shorter project prefixes are cheaper to prefill than to load
+KV_PREFIX_MAX_FILES = 4  # Saved prefixes kept on disk (each can be 100MB+)
+RESPONSE_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Least recently used responses evicted past this
+
+# End-of-turn tokens across chat templates; generation stops at the first one
+_STOP_RE = re.compile(r'<\|im_end\|>|<\|im_start\|>|<\|eot_id\|>|</s>')
+
+# Semantic cache (opt-in with "semantic_cache": true; needs sentence-transformers + hnswlib)
+SEMANTIC_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_DIM = 384
+SEMANTIC_THRESHOLD = 0.95  # Minimum cosine similarity to reuse an answer
 
 # File extensions for different purposes
 CODE_EXTENSIONS = {
@@ -115,7 +191,10 @@ IMAGE_EXTENSIONS = {
     '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'
 }
 
-ALLOWED_EXTENSIONS = CODE_EXTENSIONS | CONFIG_EXTENSIONS | WEB_EXTENSIONS | DOC_EXTENSIONS
+ALLOWED_EXTENSIONS = frozenset(CODE_EXTENSIONS | CONFIG_EXTENSIONS | WEB_EXTENSIONS | DOC_EXTENSIONS)
+
+# Directories never worth indexing or searching (hidden dirs are skipped too)
+SKIP_DIRS = {'node_modules', '__pycache__', 'venv', 'env', 'dist', 'build'}
 
 # Project structure files to auto-load for context
 PROJECT_CONTEXT_FILES = [
@@ -156,40 +235,10 @@ FG_WHITE = "\033[37m"
 DIM = "\033[2m"
 BG_RED = "\033[41m"
 
-
-# ---------------------------------------------------------------------------
-# LOADING SPINNER
-# ---------------------------------------------------------------------------
-
-class Spinner:
-    """Simple loading spinner for long operations."""
-
-    def __init__(self, message="Working"):
-        self.message = message
-        self.running = False
-        self.thread = None
-
-    def _spin(self):
-        chars = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
-        idx = 0
-        while self.running:
-            sys.stdout.write(f"\r{FG_CYAN}{chars[idx]} {self.message}...{RESET}")
-            sys.stdout.flush()
-            idx = (idx + 1) % len(chars)
-            time.sleep(0.1)
-        sys.stdout.write("\r" + " " * (len(self.message) + 10) + "\r")
-        sys.stdout.flush()
-
-    def start(self):
-        self.running = True
-        self.thread = threading.Thread(target=self._spin)
-        self.thread.daemon = True
-        self.thread.start()
-
-    def stop(self):
-        self.running = False
-        if self.thread:
-            self.thread.join()
+# Color + bold in one SGR sequence, for headers and panel titles
+CYAN_BOLD = "\033[36;1m"
+YELLOW_BOLD = "\033[33;1m"
+WHITE_BOLD = "\033[37;1m"
 
 
 # ---------------------------------------------------------------------------
@@ -217,8 +266,8 @@ def load_config() -> Dict:
     """Load user configuration (global)."""
     if os.path.exists(CONFIG_FILE):
         try:
-            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(CONFIG_FILE, "rb") as f:
+                return _loads(f.read())
         except Exception:
             pass
     return {}
@@ -227,16 +276,16 @@ def load_config() -> Dict:
 def load_project_config(cwd: str) -> Dict:
     """Load per-project config from .mlx-code.json if present.
 
-    Supported fields: model, max_tokens, ctx_chars, auto_context.
+    Supported fields: model, max_tokens, ctx_chars, auto_context, semantic_cache.
     Project config overrides global config.
     """
     project_config_path = os.path.join(cwd, ".mlx-code.json")
     if os.path.exists(project_config_path):
         try:
-            with open(project_config_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(project_config_path, "rb") as f:
+                data = _loads(f.read())
             # Only allow known keys
-            allowed = {"model", "max_tokens", "ctx_chars", "auto_context"}
+            allowed = {"model", "max_tokens", "ctx_chars", "auto_context", "semantic_cache"}
             return {k: v for k, v in data.items() if k in allowed}
         except Exception as e:
             print(f"{FG_YELLOW}Warning: Could not read .mlx-code.json: {e}{RESET}")
@@ -246,25 +295,57 @@ def load_project_config(cwd: str) -> Dict:
 def save_config(config: Dict):
     """Save user configuration."""
     try:
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2)
+        with open(CONFIG_FILE, "wb") as f:
+            f.write(_dumps(config, indent=True))
     except Exception as e:
         print(f"{FG_YELLOW}Warning: Could not save config: {e}{RESET}")
 
 
+# Autosave is debounced: exchanges within AUTOSAVE_DELAY share one write
+AUTOSAVE_DELAY = 2.0
+_autosave_lock = threading.Lock()
+_autosave_pending: Optional[Dict] = None
+_autosave_timer: Optional[threading.Timer] = None
+
+
 def autosave_conversation(session_history: List[Tuple[str, str]], model_name: str, cwd: str):
     """Auto-save conversation to disk after each exchange."""
-    try:
-        data = {
-            "model": model_name,
-            "cwd": cwd,
-            "timestamp": datetime.now().isoformat(),
-            "history": [{"role": role, "content": content} for role, content in session_history],
-        }
-        with open(AUTOSAVE_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception:
-        pass  # Silent - don't interrupt user flow
+    global _autosave_pending, _autosave_timer
+    data = {
+        "model": model_name,
+        "cwd": cwd,
+        "timestamp": datetime.now().isoformat(),
+        "history": [{"role": role, "content": content} for role, content in session_history],
+    }
+    with _autosave_lock:
+        _autosave_pending = data
+        if _autosave_timer is None:
+            _autosave_timer = threading.Timer(AUTOSAVE_DELAY, _flush_autosave)
+            _autosave_timer.daemon = True
+            _autosave_timer.start()
+
+
+def _flush_autosave():
+    """Write the latest pending autosave, atomically via a temp file."""
+    global _autosave_pending, _autosave_timer
+    # The lock is held through the write so clear_autosave() can't delete the
+    # file in the middle of it and have this recreate it after a clean exit
+    with _autosave_lock:
+        data, _autosave_pending = _autosave_pending, None
+        _autosave_timer = None
+        if data is None:
+            return
+        try:
+            payload = _dumps(data)
+            tmp_path = AUTOSAVE_FILE + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, AUTOSAVE_FILE)
+        except Exception:
+            pass  # Silent - don't interrupt user flow
+
+
+atexit.register(_flush_autosave)  # Unclean exits keep the last exchange
 
 
 def load_autosave() -> Optional[Dict]:
@@ -272,8 +353,8 @@ def load_autosave() -> Optional[Dict]:
     if not os.path.exists(AUTOSAVE_FILE):
         return None
     try:
-        with open(AUTOSAVE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(AUTOSAVE_FILE, "rb") as f:
+            data = _loads(f.read())
         if data.get("history"):
             return data
     except Exception:
@@ -283,26 +364,57 @@ def load_autosave() -> Optional[Dict]:
 
 def clear_autosave():
     """Remove autosave file (on clean exit)."""
-    try:
-        if os.path.exists(AUTOSAVE_FILE):
-            os.remove(AUTOSAVE_FILE)
-    except Exception:
-        pass
+    global _autosave_pending, _autosave_timer
+    # Under the lock: waits out a flush that is already writing, and a timer
+    # that fires after this finds nothing pending
+    with _autosave_lock:
+        if _autosave_timer is not None:
+            _autosave_timer.cancel()
+        _autosave_pending = _autosave_timer = None
+        try:
+            if os.path.exists(AUTOSAVE_FILE):
+                os.remove(AUTOSAVE_FILE)
+        except Exception:
+            pass
 
 
 # ---------------------------------------------------------------------------
 # UTILS: SAFE PATHS
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
+def _real_root() -> str:
+    """Resolved ROOT_DIR, computed once after main() sets it."""
+    return os.path.realpath(ROOT_DIR)
+
+
+@functools.lru_cache(maxsize=None)
+def _root_prefix() -> str:
+    """ROOT_DIR with a trailing separator, computed once after main() sets it."""
+    return os.path.join(ROOT_DIR, "")
+
+
+def rel_to_root(path: str) -> str:
+    """os.path.relpath(path, ROOT_DIR); paths under the root just lose the prefix."""
+    prefix = _root_prefix()
+    if path.startswith(prefix):
+        return path[len(prefix):]
+    return os.path.relpath(path, ROOT_DIR)
+
+
 def is_safe_path(path: str) -> bool:
     """True if path is inside ROOT_DIR."""
-    root = os.path.realpath(ROOT_DIR)
-    target = os.path.realpath(path)
-    return target == root or target.startswith(root + os.sep)
+    return in_sandbox(os.path.realpath(path))
+
+
+def in_sandbox(real_path: str) -> bool:
+    """is_safe_path() for a path that is already resolved (as resolve_path returns)."""
+    root = _real_root()
+    return real_path == root or real_path.startswith(root + os.sep)
 
 
 def resolve_path(user_path: str, current_dir: str) -> str:
-    """Resolve a user path (relative or absolute) within ROOT_DIR."""
+    """Resolve a user path (relative or absolute); check it with in_sandbox()."""
     if not user_path:
         return os.path.realpath(current_dir)
     if os.path.isabs(user_path):
@@ -313,77 +425,182 @@ def resolve_path(user_path: str, current_dir: str) -> str:
     return real
 
 
+def file_ext(path: str) -> str:
+    """os.path.splitext(path)[1] without building the root half."""
+    name_start = path.rfind(os.sep) + 1
+    dot = path.rfind('.', name_start)
+    if dot <= name_start:
+        return ''
+    # Like splitext, dots leading the name (".bashrc", "..x") don't start an extension
+    if path[name_start] == '.' and not path[name_start:dot].strip('.'):
+        return ''
+    return path[dot:]
+
+
 def is_allowed_file(path: str) -> bool:
     """Check if file extension is allowed for modification."""
-    ext = os.path.splitext(path)[1].lower()
+    ext = file_ext(path).lower()
     return ext in ALLOWED_EXTENSIONS or ext == ''
 
 
 def is_image_file(path: str) -> bool:
     """Check if file is an image."""
-    ext = os.path.splitext(path)[1].lower()
-    return ext in IMAGE_EXTENSIONS
+    return file_ext(path).lower() in IMAGE_EXTENSIONS
+
+
+# ---------------------------------------------------------------------------
+# DIRECTORY INDEX
+# ---------------------------------------------------------------------------
+
+class DirIndex:
+    """One scandir walk of a tree, shared by file lookup, search and overview."""
+
+    def __init__(self, root: str, max_depth: Optional[int] = None, skip_build_dirs: bool = True):
+        self.root = root
+        self.max_depth = max_depth  # Directories deeper than this are not walked
+        self.skip_build_dirs = skip_build_dirs  # Leave out SKIP_DIRS (only hidden ones otherwise)
+        self.dirs: Dict[str, Tuple[int, List[str]]] = {}  # dir -> (depth, sorted files), walk order
+        self.by_name: Dict[str, List[str]] = {}
+        self.all_files: List[str] = []
+        self.links: Set[str] = set()  # Indexed files that are symlinks (may point outside)
+        self.mtimes: Dict[str, int] = {}
+        self._walk(root, 0)
+        self.files: Set[str] = set(self.all_files)
+
+    def _walk(self, directory: str, depth: int):
+        try:
+            self.mtimes[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+
+        files = []
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not self.skip_build_dirs or entry.name not in SKIP_DIRS:
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.name)
+                    self.by_name.setdefault(entry.name, []).append(entry.path)
+                    self.all_files.append(entry.path)
+                    if entry.is_symlink():
+                        self.links.add(entry.path)
+            except OSError:
+                continue
+
+        self.dirs[directory] = (depth, files)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return
+        for sub in subdirs:
+            self._walk(sub, depth + 1)
+
+    def is_stale(self) -> bool:
+        """True if any indexed directory gained, lost or renamed an entry."""
+        for directory, mtime in self.mtimes.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+_dir_indexes: Dict[Tuple[str, Optional[int], bool], DirIndex] = {}
+
+
+def get_dir_index(root: str, max_depth: Optional[int] = None, skip_build_dirs: bool = True) -> DirIndex:
+    """Return the index for root, rebuilding it only if the tree changed."""
+    key = (os.path.realpath(root), max_depth, skip_build_dirs)
+    index = _dir_indexes.get(key)
+    if index is None or index.is_stale():
+        index = _dir_indexes[key] = DirIndex(*key)
+    return index
 
 
 # ---------------------------------------------------------------------------
 # INTELLIGENT FILE DETECTION
 # ---------------------------------------------------------------------------
 
+# File mentions in a user message, unioned into one alternation so the text
+# is scanned once; each alternative has exactly one capture group
+FILE_REF_PATTERNS = [
+    r'(?:file|script|code|document)?\s*["\']([^"\']+\.[a-zA-Z0-9]+)["\']',
+    r'(?:in|at|see|check|read|open|look at|modify|edit|update)\s+([a-zA-Z0-9_\-./]+\.[a-zA-Z0-9]+)',
+    r'`([^`]+\.[a-zA-Z0-9]+)`',
+    r'\b([a-zA-Z0-9_\-]+\.(?:py|js|jsx|ts|tsx|java|cpp|c|h|go|rs|rb|php|html|css|json|yaml|yml|md|txt))\b',
+]
+FILE_REF_RE = re.compile(
+    "|".join(f"(?:{p})" for p in FILE_REF_PATTERNS),
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _file_ref_candidates(text: str) -> Tuple[str, ...]:
+    """The paths FILE_REF_RE finds in text; only the scan is cached, not the lookups."""
+    return tuple(next(g for g in match.groups() if g is not None)
+                 for match in FILE_REF_RE.finditer(text))
+
+
 def extract_file_references(text: str, cwd: str) -> List[str]:
     """Extract file paths mentioned in user message."""
-    references = []
-
-    # Pattern 1: Explicit file mentions
-    patterns = [
-        r'(?:file|script|code|document)?\s*["\']([^"\']+\.[a-zA-Z0-9]+)["\']',
-        r'(?:in|at|see|check|read|open|look at|modify|edit|update)\s+([a-zA-Z0-9_\-./]+\.[a-zA-Z0-9]+)',
-        r'`([^`]+\.[a-zA-Z0-9]+)`',
-        r'\b([a-zA-Z0-9_\-]+\.(py|js|jsx|ts|tsx|java|cpp|c|h|go|rs|rb|php|html|css|json|yaml|yml|md|txt))\b',
-    ]
+    candidates = _file_ref_candidates(text)
+    if not candidates:
+        return []
 
-    for pattern in patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            file_path = match.group(1)
-            # Try to resolve the path
-            if os.path.sep in file_path or file_path.startswith('.'):
-                abs_path = resolve_path(file_path, cwd)
-            else:
-                # Try as relative to cwd first
-                abs_path = resolve_path(file_path, cwd)
-                # If not found, search in current directory
-                if not os.path.exists(abs_path):
-                    found = find_file_in_tree(file_path, cwd)
-                    if found:
-                        abs_path = found
-
-            if os.path.exists(abs_path) and is_safe_path(abs_path):
+    references = []
+    seen = set()
+    # Only as deep as find_file_in_tree searches; deeper paths take the slow path
+    index = get_dir_index(cwd, max_depth=3)
+    index_in_sandbox = in_sandbox(index.root)
+
+    for file_path in candidates:
+        # Fast path: answer from the directory index, without touching the disk
+        abs_path = None
+        if not os.path.isabs(file_path) and '..' not in file_path:
+            candidate = os.path.normpath(os.path.join(index.root, file_path))
+            if candidate in index.files:
+                abs_path = candidate
+        if abs_path is None and os.path.sep not in file_path and not file_path.startswith('.'):
+            abs_path = _find_in_index(index, file_path)
+
+        if abs_path is not None and index_in_sandbox and abs_path not in index.links:
+            if abs_path not in seen:
+                seen.add(abs_path)
                 references.append(abs_path)
+            continue
+
+        # Slow path: absolute, hidden, parent-relative or symlinked paths
+        abs_path = resolve_path(file_path, cwd)
+        if abs_path not in seen and os.path.exists(abs_path) and is_safe_path(abs_path):
+            seen.add(abs_path)
+            references.append(abs_path)
 
-    return list(set(references))  # Remove duplicates
+    return references
 
 
 def find_file_in_tree(filename: str, start_dir: str, max_depth: int = 3) -> Optional[str]:
     """Search for a file in directory tree."""
-    for root, dirs, files in os.walk(start_dir):
-        # Limit depth
-        depth = root[len(start_dir):].count(os.sep)
-        if depth > max_depth:
-            continue
+    return _find_in_index(get_dir_index(start_dir, max_depth), filename, max_depth)
 
-        # Skip hidden directories
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
 
-        if filename in files:
-            return os.path.join(root, filename)
-
-    return None
+def _find_in_index(index: DirIndex, filename: str, max_depth: int = 3) -> Optional[str]:
+    # Prefer the shallowest match, as a top-down walk would
+    matches = [(index.dirs[os.path.dirname(path)][0], path)
+               for path in index.by_name.get(filename, ())]
+    matches = [m for m in matches if m[0] <= max_depth]
+    return min(matches)[1] if matches else None
 
 
 def should_auto_load_file(filepath: str) -> bool:
     """Determine if file should be auto-loaded."""
     filename = os.path.basename(filepath)
-    ext = os.path.splitext(filepath)[1].lower()
+    ext = file_ext(filepath).lower()
 
     # Always load project context files
     if filename in PROJECT_CONTEXT_FILES:
@@ -417,14 +634,19 @@ def detect_project_type(cwd: str) -> Optional[str]:
         "dotnet": ["*.csproj", "*.sln"],
     }
 
+    try:
+        names = os.listdir(cwd)
+    except OSError:
+        return None
+    name_set = set(names)
+
     for project_type, files in markers.items():
         for marker in files:
             if '*' in marker:
-                if glob.glob(os.path.join(cwd, marker)):
-                    return project_type
-            else:
-                if os.path.exists(os.path.join(cwd, marker)):
+                if fnmatch.filter(names, marker):
                     return project_type
+            elif marker in name_set:
+                return project_type
     return None
 
 
@@ -433,23 +655,22 @@ def get_project_structure(cwd: str, max_files: int = 20) -> str:
     structure = []
     file_count = 0
 
+    # Walked directly rather than through the directory index: only the first
+    # few directories are needed, and the walk stops once max_files are listed
     for root, dirs, files in os.walk(cwd):
         if file_count >= max_files:
             break
 
-        # Skip hidden and common ignore directories
-        dirs[:] = [d for d in dirs if
-                   not d.startswith('.') and d not in ['node_modules', '__pycache__', 'venv', 'env', 'dist', 'build']]
+        # Skip hidden and common ignore directories; sorted, as in the index
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in SKIP_DIRS)
 
-        level = root.replace(cwd, '').count(os.sep)
+        level = root[len(cwd):].count(os.sep)
         indent = ' ' * 2 * level
         folder_name = os.path.basename(root) or os.path.basename(cwd)
         structure.append(f'{indent}{folder_name}/')
 
         subindent = ' ' * 2 * (level + 1)
-        for file in sorted(files)[:5]:  # Limit files per directory
-            if file.startswith('.'):
-                continue
+        for file in sorted(f for f in files if not f.startswith('.'))[:5]:  # Limit files per directory
             structure.append(f'{subindent}{file}')
             file_count += 1
             if file_count >= max_files:
@@ -461,22 +682,40 @@ def get_project_structure(cwd: str, max_files: int = 20) -> str:
     return '\n'.join(structure)
 
 
+@functools.lru_cache(maxsize=64)
+def _read_context_file(filepath: str, mtime_ns: int, file_size: int) -> str:
+    """First 5KB of a project context file; the stat fields key the cache."""
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read(5000)  # First 5KB
+    if file_size > 5000:
+        content += f"\n\n[... TRUNCATED — showing 5KB of {file_size / 1024:.1f}KB total ...]"
+    return content
+
+
 def load_project_context(cwd: str) -> Dict[str, str]:
     """Load important project files for context."""
-    context = {}
-
+    candidates = []
     for filename in PROJECT_CONTEXT_FILES:
         filepath = os.path.join(cwd, filename)
-        if os.path.exists(filepath) and is_safe_path(filepath):
-            try:
-                file_size = os.path.getsize(filepath)
-                with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read(5000)  # First 5KB
-                    if file_size > 5000:
-                        content += f"\n\n[... TRUNCATED — showing 5KB of {file_size / 1024:.1f}KB total ...]"
-                    context[filename] = content
-            except Exception:
-                continue
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        if is_safe_path(filepath):
+            candidates.append((filename, filepath, st))
+
+    def read(candidate):
+        filename, filepath, st = candidate
+        try:
+            return filename, _read_context_file(filepath, st.st_mtime_ns, st.st_size)
+        except Exception:
+            return filename, None
+
+    # Independent files: read them concurrently (slow on cloud-synced folders)
+    context = {}
+    for filename, content in _io_pool().map(read, candidates):
+        if content is not None:
+            context[filename] = content
 
     return context
 
@@ -485,15 +724,63 @@ def load_project_context(cwd: str) -> Dict[str, str]:
 # IMAGE HANDLING
 # ---------------------------------------------------------------------------
 
+# PNG IHDR (color type, bit depth) -> PIL mode; other depths go through PIL
+_PNG_MODES = {(0, 8): "L", (2, 8): "RGB", (4, 8): "LA", (6, 8): "RGBA",
+              (3, 1): "P", (3, 2): "P", (3, 4): "P", (3, 8): "P"}
+_JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}  # By component count
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _fast_image_meta(image_path: str) -> Optional[Tuple[int, int, str, str]]:
+    """Read (width, height, mode, format) from a PNG or JPEG header without PIL.
+
+    Returns None for anything else, or anything unusual, so callers can fall
+    back to PIL.
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            head = f.read(32)
+            if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+                width, height, depth, color = struct.unpack(">IIBB", head[16:26])
+                mode = _PNG_MODES.get((color, depth))
+                return (width, height, mode, "PNG") if mode else None
+            if head[:2] != b"\xff\xd8":
+                return None
+            # Walk JPEG segments to the frame header; EXIF can push it past 32 bytes
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                length = struct.unpack(">H", f.read(2))[0]
+                if marker[1] in _JPEG_SOF:
+                    _, height, width, components = struct.unpack(">BHHB", f.read(6))
+                    mode = _JPEG_MODES.get(components)
+                    return (width, height, mode, "JPEG") if mode else None
+                f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
 def encode_image_to_base64(image_path: str) -> Optional[str]:
     """Encode image to base64 for context."""
+    # Small enough RGB/grayscale PNG or JPEG: send the file bytes as they are
+    max_size = (800, 800)
+    meta = _fast_image_meta(image_path)
+    if meta and meta[0] <= max_size[0] and meta[1] <= max_size[1] and meta[2] in ('RGB', 'L'):
+        try:
+            with open(image_path, 'rb') as f:
+                return base64.b64encode(f.read()).decode()
+        except OSError:
+            pass
+
     if not HAS_PIL:
         return None
+    from PIL import Image
 
     try:
         with Image.open(image_path) as img:
             # Resize if too large
-            max_size = (800, 800)
             img.thumbnail(max_size, Image.Resampling.LANCZOS)
 
             # Convert to RGB if necessary
@@ -513,8 +800,14 @@ def encode_image_to_base64(image_path: str) -> Optional[str]:
 
 def describe_image(image_path: str) -> str:
     """Create a textual description of image for context."""
+    meta = _fast_image_meta(image_path)
+    if meta:
+        width, height, mode, format_name = meta
+        return f"[Image: {os.path.basename(image_path)} - {width}x{height}px, {mode} mode, {format_name} format]"
+
     if not HAS_PIL:
         return f"[Image: {os.path.basename(image_path)}]"
+    from PIL import Image
 
     try:
         with Image.open(image_path) as img:
@@ -532,18 +825,27 @@ def describe_image(image_path: str) -> str:
 # ---------------------------------------------------------------------------
 
 def create_backup(file_path: str) -> Optional[str]:
-    """Create a timestamped backup of a file before modification."""
+    """Create a timestamped backup of a file before modification.
+
+    The backup is a hard link when possible, so nothing is copied; this is
+    safe because files are only ever rewritten via replace_file(), which
+    swaps in a new inode and leaves the linked one untouched.
+    """
     if not os.path.exists(file_path):
         return None
 
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        rel_path = os.path.relpath(file_path, ROOT_DIR)
+        rel_path = rel_to_root(file_path)
         backup_name = f"{rel_path.replace(os.sep, '_')}_{timestamp}"
         backup_path = os.path.join(BACKUP_DIR, backup_name)
 
         os.makedirs(os.path.dirname(backup_path), exist_ok=True)
-        shutil.copy2(file_path, backup_path)
+        try:
+            os.link(file_path, backup_path)
+        except OSError:
+            # Cross-device, unsupported filesystem or existing name
+            shutil.copy2(file_path, backup_path)
         return backup_path
     except Exception as e:
         print(f"{FG_YELLOW}Warning: Could not create backup: {e}{RESET}")
@@ -555,7 +857,7 @@ def list_backups(file_path: str = None) -> List[str]:
     try:
         backups = sorted(os.listdir(BACKUP_DIR), reverse=True)
         if file_path:
-            rel_path = os.path.relpath(file_path, ROOT_DIR)
+            rel_path = rel_to_root(file_path)
             prefix = rel_path.replace(os.sep, '_')
             backups = [b for b in backups if b.startswith(prefix)]
         return backups
@@ -569,13 +871,107 @@ def restore_backup(backup_name: str, target_path: str) -> bool:
         backup_path = os.path.join(BACKUP_DIR, backup_name)
         if not os.path.exists(backup_path):
             return False
-        shutil.copy2(backup_path, target_path)
+        target_path = os.path.realpath(target_path)
+        tmp_path = f"{target_path}.mlx-tmp-{os.getpid()}"
+        shutil.copy2(backup_path, tmp_path)
+        os.replace(tmp_path, target_path)
+        _read_text_at.cache_clear()  # copy2 keeps the backup's mtime
         return True
     except Exception as e:
         print(f"{FG_RED}Error restoring backup: {e}{RESET}")
         return False
 
 
+def replace_file(path: str, content: str):
+    """Write content to path through a temp file and rename.
+
+    Writing in place would also change any backup hard-linked to the file.
+    """
+    path = os.path.realpath(path)
+    tmp_path = f"{path}.mlx-tmp-{os.getpid()}"  # Same directory, so the rename is atomic
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        try:
+            shutil.copymode(path, tmp_path)
+        except OSError:
+            pass  # New file: keep default permissions
+        os.replace(tmp_path, path)
+        _read_text_at.cache_clear()  # Don't trust mtime alone for a write in the same tick
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_text_file(path: str) -> str:
+    """Whole file as UTF-8 text: one binary read, decoded in one go."""
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8")
+    if "\r" in text:  # Same newlines as a text-mode read
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def read_line_range(path: str, start: int, stop: Optional[int]) -> Tuple[List[str], bool]:
+    """Lines start..stop (0-based, stop exclusive; None reads to EOF) and whether EOF was reached.
+
+    Reading stops at stop, so a range near the top of a large file never touches the rest.
+    """
+    with open(path, "r", encoding="utf-8", buffering=1 << 17) as f:
+        lines = list(itertools.islice(f, start, stop))
+        at_eof = stop is None or not f.readline()
+    return lines, at_eof
+
+
+def read_text_cached(path: str) -> str:
+    """read_text_file() memoized on (path, mtime, size) for files that are read repeatedly."""
+    st = os.stat(path)
+    if st.st_size > READ_CACHE_MAX_FILE_BYTES:
+        return read_text_file(path)
+    return _read_text_at(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_text_at(path: str, mtime_ns: int, size: int) -> str:
+    return read_text_file(path)
+
+
+def read_file_head(path: str, limit: int = 10000) -> Tuple[str, int]:
+    """First limit bytes of path as text, plus the file size (one open and fstat).
+
+    The limit is in bytes, not characters; a character cut in half at the limit
+    is completed from the following bytes rather than dropped.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        chunks = []
+        remaining = limit
+        while remaining > 0:  # os.read may return less than asked for
+            chunk = os.read(fd, remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        text = decoder.decode(b"".join(chunks))
+        for _ in range(3):  # A UTF-8 character is at most 4 bytes
+            if not decoder.getstate()[0]:
+                break
+            chunk = os.read(fd, 1)
+            if not chunk:
+                break
+            text += decoder.decode(chunk)
+    finally:
+        os.close(fd)
+    if "\r" in text:  # Same newlines as a text-mode read
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text, size
+
+
 # ---------------------------------------------------------------------------
 # FILE TREE & SEARCH
 # ---------------------------------------------------------------------------
@@ -604,31 +1000,84 @@ def print_tree(directory: str, prefix: str = "", max_depth: int = 3, current_dep
         print(f"{prefix}{FG_RED}[Permission Denied]{RESET}")
 
 
+@functools.lru_cache(maxsize=None)
+def _io_pool() -> ThreadPoolExecutor:
+    """Shared worker threads for file scanning, started once and reused by every /grep."""
+    return ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+
+
+MMAP_MIN_SIZE = 4096  # Smaller files are cheaper to read() than to map
+_LINE_START_RE = re.compile(r"^", re.MULTILINE)
+
+
+def _scan_one(file_path: str, regex, whole) -> List[Tuple[str, int, str]]:
+    """Search one file, memory-mapping it unless it is small.
+
+    whole is the pattern compiled with MULTILINE; both run on the decoded text.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+                text = f.read().decode('utf-8', errors='ignore')
+            else:
+                # Decoded straight from the mapping, without a bytes copy in between
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text = str(mm, 'utf-8', 'ignore')
+    except (OSError, ValueError):
+        return []
+    return _scan_text(file_path, text, regex, whole)
+
+
+def _scan_text(file_path: str, text: str, regex, whole) -> List[Tuple[str, int, str]]:
+    """Run whole over the text in C and confirm each hit against its line.
+
+    The confirmation keeps results identical to a per-line grep: one entry
+    per line, and no matches spanning a newline.
+    """
+    if "\r" in text:  # Same newlines as a text-mode read
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    results = []
+    size = len(text)
+    pos = 0  # Always the start of a line
+    line_num = 1
+    while pos < size:
+        m = whole.search(text, pos)
+        if not m:
+            break
+        start = text.rfind("\n", 0, m.start()) + 1
+        if start == size:
+            break  # Empty match after the final newline, not a line
+        end = text.find("\n", m.start())
+        if end == -1:
+            end = size
+        line_num += text.count("\n", pos, start)
+        line = text[start:end]
+        if regex.search(line):
+            results.append((file_path, line_num, line.rstrip()))
+        line_num += 1
+        pos = end + 1
+    return results
+
+
 def grep_files(pattern: str, directory: str, extensions: set = None) -> List[Tuple[str, int, str]]:
     """Search for pattern in files. Returns list of (file, line_num, line_content)."""
     results = []
     try:
+        # Always a text pattern: on bytes, \w, \b, \d, \s and . only know ASCII
+        # and would miss hits in non-ASCII text
         regex = re.compile(pattern, re.IGNORECASE)
-        for root, dirs, files in os.walk(directory):
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-            for file in files:
-                if file.startswith('.'):
-                    continue
-
-                file_path = os.path.join(root, file)
-                ext = os.path.splitext(file)[1]
-
-                if extensions and ext not in extensions:
-                    continue
+        # \A and \Z only make sense per line, so visit every line for those
+        if "\\A" in pattern or "\\Z" in pattern:
+            whole = _LINE_START_RE
+        else:
+            whole = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
 
-                try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        for line_num, line in enumerate(f, 1):
-                            if regex.search(line):
-                                results.append((file_path, line_num, line.rstrip()))
-                except Exception:
-                    continue
+        # Same walk rules as before the index: only hidden directories are skipped
+        paths = [p for p in get_dir_index(directory, skip_build_dirs=False).all_files
+                 if not extensions or file_ext(p) in extensions]
+        scans = _io_pool().map(lambda p: _scan_one(p, regex, whole), paths)
+        results = list(itertools.chain.from_iterable(scans))
     except Exception as e:
         print(f"{FG_RED}Error during search: {e}{RESET}")
 
@@ -639,36 +1088,115 @@ def grep_files(pattern: str, directory: str, extensions: set = None) -> List[Tup
 # MODEL HELPERS
 # ---------------------------------------------------------------------------
 
+_models_seen_cached: Set[str] = set()  # Positive is_model_cached results...
+_models_seen_mtime: Optional[int] = None  # ...valid while HF_CACHE_DIR has this mtime
+_model_sizes: Dict[str, Tuple[Tuple[int, ...], int]] = {}  # path -> (mtimes, bytes)
+
+
 def is_model_cached(model_name: str) -> bool:
     """Check if model is already downloaded in cache."""
-    cache_dir = os.path.expanduser("~/.cache/huggingface/hub")
-    if not os.path.exists(cache_dir):
+    global _models_seen_mtime
+    cache_dir = HF_CACHE_DIR
+    try:
+        mtime = os.stat(cache_dir).st_mtime_ns
+    except OSError:
         return False
+    # Downloading or deleting a model, in or outside the app, adds or removes a models--* entry
+    if mtime != _models_seen_mtime:
+        _models_seen_cached.clear()
+        _models_seen_mtime = mtime
+    if model_name in _models_seen_cached:
+        return True
 
     # HuggingFace converts model names like: mlx-community/model -> models--mlx-community--model
     model_dir_name = f"models--{model_name.replace('/', '--')}"
     model_path = os.path.join(cache_dir, model_dir_name)
 
-    return os.path.exists(model_path) and os.path.isdir(model_path)
+    if os.path.isdir(model_path):
+        _models_seen_cached.add(model_name)
+        return True
+    return False
+
+
+class ModelMeta(NamedTuple):
+    size: str
+    ram: str
+    tier: str
+
+
+# Checked in order: "13b" must win over "3b", "1.5b" would also match "5b", etc.
+MODEL_TIERS = (
+    (("32b",), ModelMeta("~17GB", "~20-22GB", "32B")),
+    (("14b", "13b"), ModelMeta("~8.5GB", "~10-12GB", "14B")),
+    (("8b", "9b"), ModelMeta("~4.5GB", "~6-8GB", "8B")),
+    (("7b", "6.7b"), ModelMeta("~4.0GB", "~5-7GB", "7B")),
+    (("3b",), ModelMeta("~1.9GB", "~3-4GB", "3B")),
+    (("1.5b", "1.3b"), ModelMeta("~1.0GB", "~2-3GB", "1.5B")),
+)
+UNKNOWN_MODEL_META = ModelMeta("~2-5GB", "~4-8GB", "unknown")
+
+
+def _classify(model_name: str) -> ModelMeta:
+    """Size, RAM and tier estimate for a model, from the parameter count in its name."""
+    name_lower = model_name.lower()
+    for keys, meta in MODEL_TIERS:
+        if any(key in name_lower for key in keys):
+            return meta
+    return UNKNOWN_MODEL_META
+
+
+def get_model_meta(model_name: str) -> ModelMeta:
+    """Estimates for a full model name, precomputed for the known models."""
+    meta = _MODEL_META_BY_NAME.get(model_name)
+    return meta if meta is not None else _classify(model_name)
 
 
 def get_model_size_estimate(model_name: str) -> str:
     """Get estimated download size for model."""
-    name_lower = model_name.lower()
-    if "32b" in name_lower:
-        return "~17GB"
-    elif "14b" in name_lower or "13b" in name_lower:
-        return "~8.5GB"
-    elif "8b" in name_lower or "9b" in name_lower:
-        return "~4.5GB"
-    elif "7b" in name_lower or "6.7b" in name_lower:
-        return "~4.0GB"
-    elif "3b" in name_lower:
-        return "~1.9GB"
-    elif "1.5b" in name_lower or "1.3b" in name_lower:
-        return "~1.0GB"
-    else:
-        return "~2-5GB"
+    return get_model_meta(model_name).size
+
+
+def enable_hf_transfer() -> bool:
+    """Route HuggingFace downloads through hf_transfer if it is installed.
+
+    Returns False if it is not installed or the user turned it off with
+    HF_HUB_ENABLE_HF_TRANSFER=0.
+    """
+    if importlib.util.find_spec("hf_transfer") is None:
+        return False
+    if os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1").lower() in ("0", "false", "no", "off"):
+        return False
+    # huggingface_hub reads the env var on import; it is only loaded once a model
+    # has been (mlx-lm imports it), in which case patch the constant it already read
+    if "huggingface_hub.constants" in sys.modules:
+        sys.modules["huggingface_hub.constants"].HF_HUB_ENABLE_HF_TRANSFER = True
+    return True
+
+
+def download_model_with_hf_transfer(model_name: str) -> bool:
+    """
+    Download model straight into the HuggingFace cache with parallel,
+    resumable HTTP transfers (hf_transfer's Rust backend).
+    Returns True if successful, False if hf_transfer is missing or it failed.
+    """
+    if not enable_hf_transfer():
+        return False
+    try:
+        from huggingface_hub import snapshot_download
+    except ImportError:
+        return False
+
+    print(f"{FG_CYAN}🚀 Using hf_transfer for faster download{RESET}")
+    print(f"{FG_CYAN}{'─' * 70}{RESET}")
+    try:
+        snapshot_download(repo_id=model_name, allow_patterns=HF_ALLOW_PATTERNS, max_workers=8)
+    except Exception as e:
+        print(f"{FG_RED}❌ Error during hf_transfer download: {e}{RESET}")
+        return False
+
+    print(f"{FG_GREEN}✅ Model downloaded successfully!{RESET}")
+    print(f"{FG_CYAN}{'─' * 70}{RESET}\n")
+    return True
 
 
 def download_model_with_git_lfs(model_name: str) -> bool:
@@ -710,7 +1238,7 @@ def download_model_with_git_lfs(model_name: str) -> bool:
             return False
 
         # Move to HuggingFace cache location
-        cache_dir = os.path.expanduser("~/.cache/huggingface/hub")
+        cache_dir = HF_CACHE_DIR
         os.makedirs(cache_dir, exist_ok=True)
 
         model_dir_name = f"models--{model_name.replace('/', '--')}"
@@ -734,12 +1262,12 @@ def download_model_with_git_lfs(model_name: str) -> bool:
         return False
 
 
-def list_installed_models() -> List[Tuple[str, str, str]]:
+def list_installed_models() -> List[Tuple[str, str, float]]:
     """
     List all installed models in the HuggingFace cache.
-    Returns list of (model_name, directory_name, size)
+    Returns list of (model_name, directory_name, size_gb)
     """
-    cache_dir = os.path.expanduser("~/.cache/huggingface/hub")
+    cache_dir = HF_CACHE_DIR
     if not os.path.exists(cache_dir):
         return []
 
@@ -752,30 +1280,61 @@ def list_installed_models() -> List[Tuple[str, str, str]]:
                     # Convert directory name back to model name
                     model_name = entry.replace("models--", "").replace("--", "/")
 
-                    # Calculate size
-                    total_size = 0
-                    for dirpath, dirnames, filenames in os.walk(model_path):
-                        for filename in filenames:
-                            filepath = os.path.join(dirpath, filename)
-                            try:
-                                total_size += os.path.getsize(filepath)
-                            except Exception:
-                                pass
-
-                    # Format size
-                    size_gb = total_size / (1024**3)
-                    size_str = f"{size_gb:.2f}GB"
-
-                    installed.append((model_name, entry, size_str))
+                    size_gb = _model_dir_size(model_path) / (1024**3)
+                    installed.append((model_name, entry, size_gb))
     except Exception as e:
         print(f"{FG_YELLOW}Warning: Could not list models: {e}{RESET}")
 
     return sorted(installed)
 
 
+def _dir_size(path: str) -> int:
+    """Bytes used by files under path. Symlinks count as themselves, so the
+    snapshot links into blobs/ are not added on top of the blobs."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+
+def _model_dir_size(model_path: str) -> int:
+    """Size of a cached model, recomputed only when its top-level dirs change.
+
+    Downloads add or rename files in blobs/ and snapshots/, which bumps the
+    mtime of those directories.
+    """
+    try:
+        with os.scandir(model_path) as it:
+            mtimes = tuple(
+                [os.stat(model_path).st_mtime_ns] +
+                [e.stat(follow_symlinks=False).st_mtime_ns for e in it]
+            )
+    except OSError:
+        return _dir_size(model_path)
+
+    cached = _model_sizes.get(model_path)
+    if cached and cached[0] == mtimes:
+        return cached[1]
+    size = _dir_size(model_path)
+    _model_sizes[model_path] = (mtimes, size)
+    return size
+
+
 def delete_model(model_name: str) -> bool:
     """Delete a model from the cache."""
-    cache_dir = os.path.expanduser("~/.cache/huggingface/hub")
+    cache_dir = HF_CACHE_DIR
     model_dir_name = f"models--{model_name.replace('/', '--')}"
     model_path = os.path.join(cache_dir, model_dir_name)
 
@@ -783,6 +1342,7 @@ def delete_model(model_name: str) -> bool:
         return False
 
     try:
+        _models_seen_cached.discard(model_name)
         shutil.rmtree(model_path)
         return True
     except Exception as e:
@@ -792,49 +1352,187 @@ def delete_model(model_name: str) -> bool:
 
 def get_model_ram_requirement(model_name: str) -> str:
     """Get estimated RAM requirement for model."""
-    name_lower = model_name.lower()
-    if "32b" in name_lower:
-        return "~20-22GB"
-    elif "14b" in name_lower or "13b" in name_lower:
-        return "~10-12GB"
-    elif "8b" in name_lower or "9b" in name_lower:
-        return "~6-8GB"
-    elif "7b" in name_lower or "6.7b" in name_lower:
-        return "~5-7GB"
-    elif "3b" in name_lower:
-        return "~3-4GB"
-    elif "1.5b" in name_lower or "1.3b" in name_lower:
-        return "~2-3GB"
-    else:
-        return "~4-8GB"
+    return get_model_meta(model_name).ram
+
 
+class ModelTable:
+    """Known models as parallel lists, in MODEL_ALIASES order.
 
-def list_available_models() -> Dict[str, Dict]:
+    Everything but `cached` is fixed at import; filter with e.g.
+    [i for i, c in enumerate(table.cached) if c].
+    """
+
+    def __init__(self):
+        self.aliases: List[str] = list(MODEL_ALIASES)
+        self.names: List[str] = list(MODEL_ALIASES.values())
+        self.sizes: List[str] = [_MODEL_META[a].size for a in self.aliases]
+        self.rams: List[str] = [_MODEL_META[a].ram for a in self.aliases]
+        self.cached: List[bool] = [False] * len(self.aliases)
+        self.index: Dict[str, int] = {a: i for i, a in enumerate(self.aliases)}
+        self.alias_by_name: Dict[str, str] = {}
+        for alias, name in zip(self.aliases, self.names):
+            self.alias_by_name.setdefault(name, alias)  # first alias wins
+
+    def refresh(self) -> "ModelTable":
+        self.cached = [is_model_cached(name) for name in self.names]
+        return self
+
+
+def list_available_models() -> ModelTable:
     """List all available models with metadata."""
-    models = {}
-
-    for alias, full_name in MODEL_ALIASES.items():
-        models[alias] = {
-            "name": full_name,
-            "size": get_model_size_estimate(full_name),
-            "ram": get_model_ram_requirement(full_name),
-            "cached": is_model_cached(full_name)
-        }
+    return _model_table().refresh()
+
+
+# Estimates for the known models, computed once at import.
+_MODEL_META = {alias: _classify(full) for alias, full in MODEL_ALIASES.items()}
+_MODEL_META_BY_NAME = {full: _MODEL_META[alias] for alias, full in MODEL_ALIASES.items()}
+
 
-    return models
+@functools.lru_cache(maxsize=None)
+def _model_table() -> ModelTable:
+    return ModelTable()
+
+
+# ---------------------------------------------------------------------------
+# RESPONSE CACHE
+# ---------------------------------------------------------------------------
+
+class ResponseCache:
+    """On-disk LRU of finished responses, keyed by the full prompt.
+
+    Decoding is greedy (temperature 0), so the same prompt on the same model
+    yields the same answer; a hit skips generation entirely.
+    """
+
+    def __init__(self, path: str, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(hash TEXT PRIMARY KEY, response BLOB NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.commit()
+        atexit.register(self.db.close)
+
+    @staticmethod
+    def make_key(prompt: str, model_name: str, max_tokens: int) -> str:
+        payload = json.dumps([model_name, max_tokens, 0.0, prompt])  # 0.0: temperature
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT response FROM responses WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE responses SET used = ? WHERE hash = ?", (time.time(), key))
+        self.db.commit()
+        return row[0].decode("utf-8")
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (hash, response, created, used) VALUES (?, ?, ?, ?)",
+            (key, response.encode("utf-8"), now, now),
+        )
+        # Keep the most recently used responses that fit in max_bytes
+        self.db.execute(
+            "DELETE FROM responses WHERE hash IN (SELECT hash FROM "
+            "(SELECT hash, SUM(LENGTH(response)) OVER (ORDER BY used DESC) AS total FROM responses) "
+            "WHERE total > ?)",
+            (self.max_bytes,),
+        )
+        self.db.commit()
+
+
+class SemanticCache:
+    """Nearest-neighbour index of past queries, pointing at ResponseCache keys.
+
+    A paraphrased question ("what does foo do" / "explain foo") reuses the
+    earlier answer when the embeddings are nearly identical and the files and
+    conversation history in context are the same.
+    """
+
+    def __init__(self, index_path: str = SEMANTIC_INDEX_FILE, meta_path: str = SEMANTIC_META_FILE):
+        # Imported here: sentence-transformers pulls in torch, which takes
+        # seconds to load and is only needed when the cache is enabled
+        import hnswlib
+        from sentence_transformers import SentenceTransformer
+
+        self.index_path = index_path
+        self.meta_path = meta_path
+        self.encoder = SentenceTransformer(SEMANTIC_MODEL)
+        self.index = hnswlib.Index(space='cosine', dim=SEMANTIC_DIM)
+        self.entries: List[Dict[str, str]] = []  # label -> {"key", "context"}
+        self._last: Tuple[str, object] = ("", None)
+
+        if os.path.exists(index_path) and os.path.exists(meta_path):
+            with open(meta_path, "rb") as f:
+                self.entries = _loads(f.read())
+            self.index.load_index(index_path, max_elements=max(1024, len(self.entries) * 2))
+        else:
+            self.index.init_index(max_elements=1024, ef_construction=200, M=16)
+
+    def _embed(self, query: str):
+        # lookup() and add() run on the same query; encode it once
+        if self._last[0] != query or self._last[1] is None:
+            self._last = (query, self.encoder.encode([query], normalize_embeddings=True))
+        return self._last[1]
+
+    def lookup(self, query: str, context: str) -> Optional[str]:
+        """Response-cache key of a near-identical past query, if any."""
+        if not self.entries:
+            return None
+        labels, distances = self.index.knn_query(self._embed(query), k=1)
+        label = int(labels[0][0])
+        if 1 - distances[0][0] < SEMANTIC_THRESHOLD or label >= len(self.entries):
+            return None
+        entry = self.entries[label]
+        return entry["key"] if entry["context"] == context else None
+
+    def add(self, query: str, context: str, key: str):
+        label = len(self.entries)
+        if label >= self.index.get_max_elements():
+            self.index.resize_index(label * 2)
+        self.index.add_items(self._embed(query), [label])
+        self.entries.append({"key": key, "context": context})
+        self.index.save_index(self.index_path)
+        with open(self.meta_path, "wb") as f:
+            f.write(_dumps(self.entries))
 
 
 # ---------------------------------------------------------------------------
 # INTELLIGENT CHAT SESSION
 # ---------------------------------------------------------------------------
 
+# Old messages worth re-sending, and ones that survive history trimming.
+# Each message is tagged once when it enters the history (see _tag_message).
+IMPORTANT_MARKERS = ("Opened file", "```file:", "Auto-loaded", "Project context")
+PINNED_MARKERS = ("Opened", "```file:", "Auto-loaded", "Project")
+
+
+class MessageTags(NamedTuple):
+    important: bool
+    pinned: bool
+
+
+def _tag_message(text: str) -> MessageTags:
+    return MessageTags(
+        any(marker in text for marker in IMPORTANT_MARKERS),
+        any(marker in text for marker in PINNED_MARKERS),
+    )
+
+
 class ChatSession:
     def __init__(self, model_name: str, max_tokens: int, ctx_chars: int):
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.ctx_chars = ctx_chars
         self.history: List[Tuple[str, str]] = []
-        self.opened_files: Dict[str, str] = {}  # path -> content
+        self._history_chars = 0  # Sum of message lengths; see set_history()
+        self._history_tags: List[MessageTags] = []  # Parallel to history
+        self.opened_files: Dict[str, str] = {}  # path -> content; write via set_opened_file()
+        self._opened_chars = 0  # Sum of opened file lengths
         self.project_context: Dict[str, str] = {}
         self.last_query: str = ""
         self.last_modified_files: List[str] = []
@@ -845,8 +1543,16 @@ class ChatSession:
             "files_auto_loaded": 0,
             "tokens_generated": 0,
             "prompt_tokens": 0,
+            "cache_hits": 0,
         }
 
+        try:
+            self.response_cache = ResponseCache(RESPONSE_CACHE_FILE)
+        except sqlite3.Error as e:
+            print(f"{FG_YELLOW}Warning: Response cache disabled: {e}{RESET}")
+            self.response_cache = None
+        self.semantic_cache: Optional[SemanticCache] = None  # See enable_semantic_cache()
+
         # Model loading with better feedback
         model_cached = is_model_cached(model_name)
         model_size = get_model_size_estimate(model_name)
@@ -865,14 +1571,24 @@ class ChatSession:
             print(f"   • Check your internet connection (try ethernet cable)")
             print(f"   • Try again later (servers might be busy)")
             print(f"   • Download manually: huggingface-cli download {model_name}")
+            if enable_hf_transfer():
+                print(f"{FG_CYAN}🚀 Using hf_transfer for faster download{RESET}")
+            else:
+                print(f"   • Faster downloads: pip install hf_transfer")
             print(f"{FG_CYAN}{'─' * 70}{RESET}\n")
             print(f"{FG_CYAN}Download progress:{RESET}")
 
         try:
             # Don't use spinner - let HuggingFace progress bars show
+            _import_mlx()
             self.model, self.tokenizer = load(model_name)
             print(f"\n{FG_GREEN}✅ Model loaded successfully!{RESET}\n")
 
+            # KV cache kept across turns; _cache_tokens mirrors what it holds,
+            # so each turn only prefills what differs from the previous prompt
+            self.prompt_cache = make_prompt_cache(self.model) if HAS_PROMPT_CACHE else None
+            self._cache_tokens: List[int] = []
+
         except KeyboardInterrupt:
             print(f"\n\n{FG_YELLOW}⚠️  Download interrupted by user{RESET}")
             print(f"{FG_CYAN}💡 Next time you run, download will resume from where it stopped{RESET}")
@@ -918,6 +1634,14 @@ class ChatSession:
 
         self.system_prompt = self._build_system_prompt()
 
+        # System message (prompt + context section) and the tokens of its
+        # rendered head, reused while cwd, project files and opened files
+        # stay the same between turns
+        self._system_cache: Dict[bool, Tuple[tuple, str]] = {}  # include_files -> (key, text)
+        self._head_tokens: Optional[Tuple[str, List[int]]] = None
+        self._project_head: Optional[Tuple[str, List[int]]] = None
+        self._split_encode_ok: Optional[bool] = None  # Checked once per tokenizer
+
     def _build_system_prompt(self) -> str:
         today = time.strftime("%Y-%m-%d")
         return textwrap.dedent(
@@ -934,6 +1658,27 @@ Do NOT use ```python or ```js for file edits — only ```file:filename.
 Be concise. Use markdown. Never hallucinate file names."""
         ).strip()
 
+    def enable_semantic_cache(self):
+        """Also reuse answers to paraphrased queries (config: "semantic_cache": true)."""
+        if self.semantic_cache is not None or self.response_cache is None:
+            return
+        try:
+            self.semantic_cache = SemanticCache()
+        except ImportError:
+            print(f"{FG_YELLOW}Warning: Semantic cache needs: pip install sentence-transformers hnswlib{RESET}")
+        except Exception as e:
+            print(f"{FG_YELLOW}Warning: Semantic cache disabled: {e}{RESET}")
+
+    def _context_hash(self, cwd: str) -> str:
+        """Identifies the files and conversation a semantic-cache answer was given for.
+
+        The history window is part of it so that follow-ups such as "continue"
+        only match answers given in the same conversation.
+        """
+        payload = json.dumps([self.model_name, cwd, sorted(self.opened_files.items()),
+                              self._get_prioritized_history()])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
     def load_project_context(self, cwd: str):
         """Load project context files."""
         if not self.auto_context_enabled:
@@ -958,21 +1703,19 @@ Be concise. Use markdown. Never hallucinate file names."""
             if is_image_file(filepath):
                 # Handle images
                 desc = describe_image(filepath)
-                self.opened_files[filepath] = desc
+                self.set_opened_file(filepath, desc)
                 loaded.append(filepath)
                 continue
 
             if should_auto_load_file(filepath):
                 try:
-                    file_size = os.path.getsize(filepath)
-                    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read(10000)  # First 10KB
-                        if file_size > 10000:
-                            content += f"\n\n[... TRUNCATED — showing 10KB of {file_size / 1024:.1f}KB total ...]"
-                            print(f"{FG_YELLOW}  ⚠ {os.path.basename(filepath)} truncated ({file_size / 1024:.1f}KB > 10KB limit){RESET}")
-                        self.opened_files[filepath] = content
-                        loaded.append(filepath)
-                        self.stats["files_auto_loaded"] += 1
+                    content, file_size = read_file_head(filepath)  # First 10KB
+                    if file_size > 10000:
+                        content += f"\n\n[... TRUNCATED — showing 10KB of {file_size / 1024:.1f}KB total ...]"
+                        print(f"{FG_YELLOW}  ⚠ {os.path.basename(filepath)} truncated ({file_size / 1024:.1f}KB > 10KB limit){RESET}")
+                    self.set_opened_file(filepath, content)
+                    loaded.append(filepath)
+                    self.stats["files_auto_loaded"] += 1
                 except Exception:
                     continue
 
@@ -982,7 +1725,7 @@ Be concise. Use markdown. Never hallucinate file names."""
 
         return loaded
 
-    def _build_context_section(self, cwd: str) -> str:
+    def _build_context_section(self, cwd: str, include_files: bool = True) -> str:
         """Build context section with project info and loaded files."""
         parts = []
 
@@ -995,7 +1738,9 @@ Be concise. Use markdown. Never hallucinate file names."""
 
         # List files in current directory for better context
         try:
-            files_in_dir = os.listdir(cwd)[:10]  # First 10 files
+            # First 10 names in sorted order (stable across turns), without sorting them all
+            with os.scandir(cwd) as it:
+                files_in_dir = heapq.nsmallest(10, (entry.name for entry in it))
             if files_in_dir:
                 parts.append(f"Files in current directory: {', '.join(files_in_dir)}")
         except Exception:
@@ -1013,27 +1758,16 @@ Be concise. Use markdown. Never hallucinate file names."""
                 parts.append(content[:500] + ("..." if len(content) > 500 else ""))
 
         # Opened files — with total budget enforcement
-        if self.opened_files:
+        if include_files and self.opened_files:
             budget_remaining = MAX_FILE_CONTEXT_CHARS
-            files_included = 0
-            # Iterate in reverse order (most recently added first = most relevant)
-            file_items = list(self.opened_files.items())
-            file_items.reverse()
-
-            parts.append(f"\nFiles in context ({len(self.opened_files)} loaded, budget {MAX_FILE_CONTEXT_CHARS} chars):")
-
-            for filepath, content in file_items:
+            included = []
+            # Budget goes to the most recently added files first (most relevant)
+            for filepath, content in reversed(self.opened_files.items()):
                 if budget_remaining <= 0:
-                    skipped = len(file_items) - files_included
-                    parts.append(f"\n[... {skipped} more file(s) skipped — context budget exhausted ...]")
                     break
 
-                rel_path = os.path.relpath(filepath, ROOT_DIR)
-                parts.append(f"\n--- {rel_path} ---")
-
                 if content.startswith("[Image:"):
-                    parts.append(content)
-                    files_included += 1
+                    included.append((filepath, content))
                     continue
 
                 # Fit within remaining budget
@@ -1042,9 +1776,19 @@ Be concise. Use markdown. Never hallucinate file names."""
                     preview = content[:max_for_file] + f"\n[... TRUNCATED — {len(content)} chars total, showing {max_for_file} ...]"
                 else:
                     preview = content
-                parts.append(preview)
+                included.append((filepath, preview))
                 budget_remaining -= len(preview)
-                files_included += 1
+
+            # ...but they are listed oldest first, so opening a file only appends
+            # to the prompt and the KV cache for everything before it stays valid
+            parts.append(f"\nFiles in context (budget {MAX_FILE_CONTEXT_CHARS} chars):")
+            for filepath, preview in reversed(included):
+                parts.append(f"\n--- {rel_to_root(filepath)} ---")
+                parts.append(preview)
+
+            skipped = len(self.opened_files) - len(included)
+            if skipped:
+                parts.append(f"\n[... {skipped} more file(s) skipped — context budget exhausted ...]")
 
         return "\n".join(parts)
 
@@ -1054,10 +1798,8 @@ Be concise. Use markdown. Never hallucinate file names."""
         This works correctly with any model (Qwen, Llama, Mistral, Phi, DeepSeek, etc.)
         by delegating template formatting to the tokenizer itself.
         """
-        context = self._build_context_section(cwd)
-
         # Put context in the system prompt to avoid repeating it every turn
-        system_with_ctx = f"{self.system_prompt}\n\n{context}"
+        system_with_ctx = self._system_with_context(cwd)
 
         # Build messages list in OpenAI-compatible format
         messages: List[Dict[str, str]] = []
@@ -1070,36 +1812,170 @@ Be concise. Use markdown. Never hallucinate file names."""
         # Current user message — clean, no context duplication
         messages.append({"role": "user", "content": user_message})
 
+        return self._apply_chat_template(messages)
+
+    def _system_with_context(self, cwd: str, include_files: bool = True) -> str:
+        """System prompt plus context section, rebuilt only when its inputs change."""
+        try:
+            dir_mtime = os.stat(cwd).st_mtime_ns  # Directory listing and project type
+        except OSError:
+            dir_mtime = None
+        key = (
+            cwd, dir_mtime, self.system_prompt,
+            tuple(self.project_context.items()),
+            tuple(self.opened_files.items()) if include_files else (),
+        )
+        cached = self._system_cache.get(include_files)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        system = f"{self.system_prompt}\n\n{self._build_context_section(cwd, include_files)}"
+        self._system_cache[include_files] = (key, system)
+        return system
+
+    def _apply_chat_template(self, messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
         # Use tokenizer's native chat template
         try:
             prompt = self.tokenizer.apply_chat_template(
                 messages,
                 tokenize=False,
-                add_generation_prompt=True,
+                add_generation_prompt=add_generation_prompt,
             )
         except Exception:
             # Fallback: manual Qwen-style template for older tokenizers
             parts: List[str] = []
             for msg in messages:
                 parts.append(f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>")
-            parts.append("<|im_start|>assistant")
+            if add_generation_prompt:
+                parts.append("<|im_start|>assistant")
             prompt = "\n".join(parts)
 
         return prompt
 
+    def _project_prefix_tokens(self, cwd: str, tokens: List[int]) -> List[int]:
+        """Leading tokens of the prompt that depend only on the project.
+
+        That is the system prompt plus directory info and project files, up to
+        where opened files and history begin; it repeats across sessions in the
+        same directory, so its KV cache is worth keeping on disk.
+        """
+        system = self._system_with_context(cwd, include_files=False)
+        if self._project_head is None or self._project_head[0] != system:
+            self._project_head = (system, self._encode_prompt(self._apply_chat_template(
+                [{"role": "system", "content": system}], add_generation_prompt=False)))
+        prefix = self._project_head[1]
+        common = 0
+        for a, b in zip(prefix, tokens):
+            if a != b:
+                break
+            common += 1
+        return tokens[:common]
+
+    def _load_project_prefix(self, prefix: List[int]):
+        """Point the KV cache at prefix, from disk if a past session saved it."""
+        key = hashlib.sha256(f"{self.model_name}\n{json.dumps(prefix)}".encode()).hexdigest()
+        path = os.path.join(KV_CACHE_DIR, f"{key}.safetensors")
+
+        if os.path.exists(path):
+            try:
+                cache, metadata = load_prompt_cache(path, return_metadata=True)
+                if metadata.get("model") == self.model_name:
+                    self.prompt_cache = cache
+                    self._cache_tokens = prefix
+                    os.utime(path)  # Mark as recently used for pruning
+                    return
+            except Exception:
+                pass
+
+        self.prompt_cache = make_prompt_cache(self.model)
+        self._cache_tokens = []
+        for i in range(0, len(prefix), 512):
+            self.model(mx.array(prefix[i:i + 512])[None], cache=self.prompt_cache)
+            mx.eval([c.state for c in self.prompt_cache])
+        self._cache_tokens = prefix
+
+        try:
+            os.makedirs(KV_CACHE_DIR, exist_ok=True)
+            save_prompt_cache(path, self.prompt_cache, {"model": self.model_name})
+            saved = sorted(os.scandir(KV_CACHE_DIR), key=lambda e: e.stat().st_mtime, reverse=True)
+            for entry in saved[KV_PREFIX_MAX_FILES:]:
+                os.remove(entry.path)
+        except Exception as e:
+            print(f"{FG_YELLOW}Warning: Could not save KV cache: {e}{RESET}")
+
+    def _encode_prompt(self, prompt: str) -> List[int]:
+        """Tokenize prompt exactly as stream_generate would for a string."""
+        bos = getattr(self.tokenizer, "bos_token", None)
+        add_special = bos is None or not prompt.startswith(bos)
+        return list(self.tokenizer.encode(prompt, add_special_tokens=add_special))
+
+    def _encode_prompt_incremental(self, prompt: str) -> List[int]:
+        """_encode_prompt, reusing the system message tokens from earlier turns.
+
+        The rendered system message is cut right after its end-of-turn token;
+        special tokens are never merged with neighbouring text, so only what
+        follows (history and the new message) needs tokenizing. The first
+        split is checked against a full encode, in case a tokenizer disagrees.
+        """
+        if self._split_encode_ok is False:
+            return self._encode_prompt(prompt)
+
+        if self._head_tokens is None or not prompt.startswith(self._head_tokens[0]):
+            self._head_tokens = None
+            cached = self._system_cache.get(True)
+            if cached is not None:
+                head = self._apply_chat_template(
+                    [{"role": "system", "content": cached[1]}], add_generation_prompt=False)
+                ends = [m.end() for m in _STOP_RE.finditer(head)]
+                if ends and prompt.startswith(head[:ends[-1]]):
+                    head = head[:ends[-1]]
+                    self._head_tokens = (head, self._encode_prompt(head))
+            if self._head_tokens is None:
+                return self._encode_prompt(prompt)
+
+        head, head_tokens = self._head_tokens
+        tokens = head_tokens + list(self.tokenizer.encode(prompt[len(head):], add_special_tokens=False))
+        if self._split_encode_ok is None:
+            full = self._encode_prompt(prompt)
+            self._split_encode_ok = tokens == full
+            return full
+        return tokens
+
+    def _reuse_prompt_cache(self, tokens: List[int]) -> List[int]:
+        """Trim the KV cache to the prefix it shares with tokens; return the rest.
+
+        Only the returned suffix has to be prefilled. A changed file or a
+        history window that slid forward rolls the cache back to the point
+        where the prompts diverge.
+        """
+        common = 0
+        for cached, new in zip(self._cache_tokens, tokens):
+            if cached != new:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)  # Always feed at least one token
+
+        stale = len(self._cache_tokens) - common
+        if stale > 0:
+            if can_trim_prompt_cache(self.prompt_cache):
+                trim_prompt_cache(self.prompt_cache, stale)
+            else:
+                self.prompt_cache = make_prompt_cache(self.model)
+                common = 0
+
+        self._cache_tokens = tokens[:common]
+        return tokens[common:]
+
     def _get_prioritized_history(self) -> List[Tuple[str, str]]:
         """Get history with intelligent prioritization."""
         if not self.history:
             return []
 
         # Keep last 4 exchanges (8 messages)
-        recent = self.history[-8:] if len(self.history) >= 8 else self.history
+        recent = self.history[-8:]
 
         # Add important context messages (file operations, opens)
-        important = [
-            (r, t) for r, t in self.history[:-8]
-            if any(keyword in t for keyword in ["Opened file", "```file:", "Auto-loaded", "Project context"])
-        ]
+        important = [m for m, tags in zip(self.history[:-8], self._history_tags)
+                     if tags.important]
 
         # Combine, remove duplicates
         combined = important[-3:] + recent  # Max 3 old important + recent
@@ -1113,28 +1989,44 @@ Be concise. Use markdown. Never hallucinate file names."""
 
         return result
 
+    def set_history(self, history):
+        """Replace the conversation history (restore, reload, /clear)."""
+        self.history = list(history)
+        self._history_chars = sum(len(t) for _, t in self.history)
+        self._history_tags = [_tag_message(t) for _, t in self.history]
+
+    def _record_exchange(self, user_message: str, response: str):
+        """Append a finished exchange, trim, and autosave."""
+        self.history.append(("user", user_message))
+        self.history.append(("assistant", response))
+        self._history_tags.append(_tag_message(user_message))
+        self._history_tags.append(_tag_message(response))
+        self._history_chars += len(user_message) + len(response)
+        self._trim_history()
+        autosave_conversation(self.history, self.model_name, ROOT_DIR)
+
     def _trim_history(self):
         """Smart context trimming."""
-        total = sum(len(t) for _, t in self.history)
+        total = self._history_chars
         if total <= self.ctx_chars:
             return
 
-        # Keep important messages, trim others
-        while self.history and total > self.ctx_chars:
-            removed = False
-            for i in range(len(self.history) - 8):  # Don't touch last 8
-                role, txt = self.history[i]
-                if not any(keyword in txt for keyword in ["Opened", "```file:", "Auto-loaded", "Project"]):
-                    self.history.pop(i)
-                    total -= len(txt)
-                    removed = True
+        # Drop the oldest unpinned messages first, then the oldest pinned
+        # ones; the last 8 are never touched
+        older = range(len(self.history) - 8)
+        drop = set()
+        for pinned_pass in (False, True):
+            for i in older:
+                if total <= self.ctx_chars:
                     break
+                if i not in drop and self._history_tags[i].pinned == pinned_pass:
+                    drop.add(i)
+                    total -= len(self.history[i][1])
 
-            if not removed and len(self.history) > 8:
-                role, txt = self.history.pop(0)
-                total -= len(txt)
-            else:
-                break
+        if drop:
+            self.history[:] = [m for i, m in enumerate(self.history) if i not in drop]
+            self._history_tags[:] = [t for i, t in enumerate(self._history_tags) if i not in drop]
+            self._history_chars = total
 
     def ask(self, user_message: str, cwd: str) -> str:
         """Send query with automatic context loading and streaming output."""
@@ -1147,12 +2039,48 @@ Be concise. Use markdown. Never hallucinate file names."""
         # Build and send prompt
         prompt = self._build_prompt(user_message, cwd)
 
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(prompt, self.model_name, self.max_tokens)
+            try:
+                response = self.response_cache.get(cache_key)
+            except sqlite3.Error:
+                response = None
+            if response is None and self.semantic_cache is not None:
+                try:
+                    similar = self.semantic_cache.lookup(user_message, self._context_hash(cwd))
+                    response = self.response_cache.get(similar) if similar else None
+                except Exception:
+                    response = None
+            if response is not None:
+                renderer = StreamRenderer()
+                renderer.feed(response)
+                renderer.flush()
+                print(f"\n{DIM}(cached response){RESET}")
+                self.stats["cache_hits"] += 1
+                self._record_exchange(user_message, response)
+                return response
+
         # Count prompt tokens for stats
         try:
-            prompt_tokens = len(self.tokenizer.encode(prompt))
-            self.stats["prompt_tokens"] += prompt_tokens
+            tokens = self._encode_prompt_incremental(prompt)
+            self.stats["prompt_tokens"] += len(tokens)
         except Exception:
-            prompt_tokens = 0
+            tokens = None
+
+        kwargs = {}
+        if self.prompt_cache is not None and tokens:
+            try:
+                prefix = self._project_prefix_tokens(cwd, tokens)
+                if len(prefix) >= KV_PREFIX_MIN_TOKENS and self._cache_tokens[:len(prefix)] != prefix:
+                    self._load_project_prefix(prefix)
+            except Exception as e:
+                print(f"{FG_YELLOW}Warning: KV cache prefix skipped: {e}{RESET}")
+            prompt = self._reuse_prompt_cache(tokens)
+            kwargs["prompt_cache"] = self.prompt_cache
+        elif tokens:
+            prompt = tokens  # Already encoded for the stats; don't tokenize twice
+        generated: List[int] = []
 
         # Stream response token by token with markdown rendering
         response_parts: List[str] = []
@@ -1161,8 +2089,9 @@ Be concise. Use markdown. Never hallucinate file names."""
         renderer = StreamRenderer()
 
         # Repetition detection: track recent output to detect stuck loops
-        recent_window = ""
+        tail = ""  # Last 300 chars, for repetition detection
         repetition_detected = False
+        interrupted = False
 
         # Show thinking indicator while prompt is processed
         print(f"{DIM}Thinking...{RESET}", end="", flush=True)
@@ -1174,44 +2103,47 @@ Be concise. Use markdown. Never hallucinate file names."""
                 self.tokenizer,
                 prompt=prompt,
                 max_tokens=self.max_tokens,
+                **kwargs,
             ):
+                generated.append(chunk.token)
                 if first_token:
                     # Clear "Thinking..." and start showing response
                     print(f"\r{' ' * 20}\r", end="", flush=True)
                     first_token = False
                 text = chunk.text
                 # Stop at end-of-turn tokens (model-agnostic cleanup)
-                if any(stop in text for stop in ["<|im_end|>", "<|im_start|>", "<|eot_id|>", "</s>"]):
-                    for stop in ["<|im_end|>", "<|im_start|>", "<|eot_id|>", "</s>"]:
-                        text = text.split(stop)[0]
+                m = _STOP_RE.search(text)
+                if m:
+                    text = text[:m.start()]
                     if text:
                         renderer.feed(text)
                         response_parts.append(text)
                     break
                 renderer.feed(text)
                 response_parts.append(text)
+                tail = (tail + text)[-300:]
                 token_count += 1
 
                 # Repetition detection — check every 50 tokens
-                if token_count % 50 == 0 and token_count >= 150:
-                    full_text = "".join(response_parts)
-                    tail = full_text[-300:]  # Last 300 chars
-                    # Check if a pattern of 30+ chars repeats 3+ times
-                    for pat_len in range(30, 80):
-                        if pat_len > len(tail) // 3:
-                            break
-                        pattern = tail[-pat_len:]
-                        if tail.count(pattern) >= 3:
-                            repetition_detected = True
-                            break
+                if token_count % 50 == 0 and token_count >= 150 and len(tail) >= 90:
+                    # A 30+ char pattern repeating 3+ times means its last
+                    # 30 chars do too, so checking that suffix is enough
+                    suffix = tail[-30:]
+                    first = tail.find(suffix)
+                    second = tail.find(suffix, first + 30)
+                    repetition_detected = second != -1 and tail.find(suffix, second + 30) != -1
                     if repetition_detected:
                         print(f"\n{FG_YELLOW}(repetition detected — stopping generation){RESET}")
                         break
         except KeyboardInterrupt:
+            interrupted = True
             print(f"\n{FG_YELLOW}(generation interrupted){RESET}")
         except Exception as e:
             print(f"\n{FG_RED}Error generating response: {e}{RESET}")
             return f"Error generating response: {e}"
+        finally:
+            if "prompt_cache" in kwargs:
+                self._sync_cache_tokens(prompt, generated)
 
         renderer.flush()
         elapsed = time.time() - start_time
@@ -1220,21 +2152,58 @@ Be concise. Use markdown. Never hallucinate file names."""
 
         response = "".join(response_parts).strip()
 
-        # Update stats and history
-        self.stats["tokens_generated"] += token_count
-        self.history.append(("user", user_message))
-        self.history.append(("assistant", response))
-        self._trim_history()
+        # Only complete answers are worth replaying
+        if cache_key is not None and not interrupted and not repetition_detected:
+            try:
+                self.response_cache.put(cache_key, response)
+                if self.semantic_cache is not None:
+                    self.semantic_cache.add(user_message, self._context_hash(cwd), cache_key)
+            except Exception:
+                pass
 
-        # Auto-save conversation to disk
-        autosave_conversation(self.history, self.model_name, ROOT_DIR)
+        # Update stats and history (auto-saved to disk)
+        self.stats["tokens_generated"] += token_count
+        self._record_exchange(user_message, response)
 
         return response
 
+    def _sync_cache_tokens(self, suffix: List[int], generated: List[int]):
+        """Record what the KV cache holds after a generation step."""
+        offset = getattr(self.prompt_cache[0], "offset", None)
+        if offset is None:
+            self.prompt_cache = None  # Not a positional KV cache; can't reuse
+            return
+        known = self._cache_tokens + suffix + generated
+        if offset > len(known):
+            # Drop anything processed that we have no token record of
+            if can_trim_prompt_cache(self.prompt_cache):
+                trim_prompt_cache(self.prompt_cache, offset - len(known))
+            else:
+                self.prompt_cache = make_prompt_cache(self.model)
+                known = []
+        self._cache_tokens = known[:offset]
+
+    @property
+    def opened_chars(self) -> int:
+        """Total characters of the files in context."""
+        return self._opened_chars
+
+    def set_opened_file(self, path: str, content: str):
+        """Add or replace a file in context, keeping the character total current."""
+        self._opened_chars += len(content) - len(self.opened_files.get(path, ""))
+        self.opened_files[path] = content
+
+    def set_opened_files(self, files: Dict[str, str]):
+        """Replace all opened files (reload)."""
+        self.opened_files = dict(files)
+        self._opened_chars = sum(len(c) for c in self.opened_files.values())
+
     def clear_context(self):
         """Clear loaded files context."""
         self.opened_files.clear()
+        self._opened_chars = 0
         self.project_context.clear()
+        _read_text_at.cache_clear()  # Don't keep the cleared files' text around
         print(f"{FG_GREEN}✓ Context cleared{RESET}")
 
 
@@ -1242,48 +2211,74 @@ Be concise. Use markdown. Never hallucinate file names."""
 # PARSING ASSISTANT OUTPUT
 # ---------------------------------------------------------------------------
 
-FILE_BLOCK_RE = re.compile(
-    r"```file:(?P<path>[^\n\r]+)\n(?P<content>.*?)(?:```|\Z)",
-    re.DOTALL,
-)
-
+# A fenced block runs to the next ``` (or the end of an unfinished response).
+# The content is spelled out as "no ``` inside" so the engine never backtracks.
 CODE_BLOCK_RE = re.compile(
-    r"```(?P<lang>[^\n\r]*)\n(?P<content>.*?)(?:```|\Z)",
-    re.DOTALL,
+    r"```(?P<lang>[^\n\r]*)\n(?P<content>[^`]*(?:`(?!``)[^`]*)*)(?:```|\Z)"
 )
 
 
-def extract_file_blocks(text: str):
-    """Extract file blocks from response."""
-    blocks = []
-    for m in FILE_BLOCK_RE.finditer(text):
-        path = m.group("path").strip()
-        content = m.group("content")
-        blocks.append({"path": path, "content": content})
-    return blocks
-
+def extract_blocks(text: str) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """Extract (file blocks, code blocks) from a response in one pass.
 
-def extract_code_blocks(text: str):
-    """Extract code blocks from response."""
-    blocks = []
+    File blocks are fenced as ```file:path and are applied as edits; any
+    other fenced block is a code block that can be saved.
+    """
+    file_blocks = []
+    code_blocks = []
     for m in CODE_BLOCK_RE.finditer(text):
-        if m.group("lang").strip().startswith("file:"):
-            continue
         lang = m.group("lang").strip()
         content = m.group("content")
-        blocks.append({"lang": lang, "content": content})
-    return blocks
+        if lang.startswith("file:"):
+            path = lang[5:].strip()
+            if path:
+                file_blocks.append({"path": path, "content": content})
+        else:
+            code_blocks.append({"lang": lang, "content": content})
+    return file_blocks, code_blocks
+
+
+# Markdown patterns for the renderers below, which run once per streamed line.
+# Inline spans are one alternation: `code`, **bold**, *italic* (not bullets).
+_INLINE_MD_RE = re.compile(r'(`[^`]+`)|(\*\*[^*]+\*\*)|((?<!\*)\*[^*\n]+\*(?!\*))')
+_HEADER_RE = re.compile(r'^#{1,6}\s')
+_BULLET_RE = re.compile(r'^(\s*)([-*+])\s(.*)')
+_NUM_RE = re.compile(r'^(\s*)(\d+[.)]\s)(.*)')
+_HR_RE = re.compile(r'^---+$|^\*\*\*+$|^___+$')
 
 
 def _render_inline_markdown(line: str) -> str:
     """Apply inline markdown formatting: **bold**, *italic*, `code`."""
-    # Inline code: `text` -> magenta
-    line = re.sub(r'`([^`]+)`', f'{FG_MAGENTA}\\1{RESET}', line)
-    # Bold: **text** -> bold
-    line = re.sub(r'\*\*([^*]+)\*\*', f'{BOLD}\\1{RESET}', line)
-    # Italic: *text* -> dim (avoid matching bullet lists)
-    line = re.sub(r'(?<!\*)\*([^*\n]+)\*(?!\*)', f'{DIM}\\1{RESET}', line)
-    return line
+    if '`' not in line and '*' not in line:
+        return line
+    # One pass; code spans are left as written inside. Spans of the same
+    # style separated only by whitespace share one escape and one reset.
+    out = []
+    pos = 0
+    open_style = None
+    for m in _INLINE_MD_RE.finditer(line):
+        if m.lastindex == 1:  # `code` -> magenta
+            style, inner = FG_MAGENTA, m.group(1)[1:-1]
+        elif m.lastindex == 2:  # **bold** -> bold
+            style, inner = BOLD, m.group(2)[2:-2]
+        else:  # *italic* -> dim
+            style, inner = DIM, m.group(3)[1:-1]
+        gap = line[pos:m.start()]
+        pos = m.end()
+        if open_style is not None:
+            if style == open_style and not gap.strip():
+                out.append(gap)
+                out.append(inner)
+                continue
+            out.append(RESET)
+        out.append(gap)
+        out.append(style)
+        out.append(inner)
+        open_style = style
+    if open_style is not None:
+        out.append(RESET)
+    out.append(line[pos:])
+    return "".join(out)
 
 
 def print_colored_response(text: str):
@@ -1300,20 +2295,18 @@ def print_colored_response(text: str):
             print(FG_MAGENTA + line + RESET)
         else:
             # Headers
-            if re.match(r'^#{1,6}\s', line):
-                print(BOLD + FG_CYAN + line + RESET)
+            if _HEADER_RE.match(line):
+                print(CYAN_BOLD + line + RESET)
             # Bullet lists (-, *, +)
-            elif re.match(r'^(\s*)([-*+])\s', line):
-                m = re.match(r'^(\s*)([-*+])\s(.*)', line)
+            elif m := _BULLET_RE.match(line):
                 indent, bullet, content = m.group(1), m.group(2), m.group(3)
                 print(f"{indent}{FG_GREEN}{bullet}{RESET} {_render_inline_markdown(content)}")
             # Numbered lists
-            elif re.match(r'^(\s*)\d+[.)]\s', line):
-                m = re.match(r'^(\s*)(\d+[.)]\s)(.*)', line)
+            elif m := _NUM_RE.match(line):
                 indent, num, content = m.group(1), m.group(2), m.group(3)
                 print(f"{indent}{FG_GREEN}{num}{RESET}{_render_inline_markdown(content)}")
             # Horizontal rules
-            elif re.match(r'^---+$|^\*\*\*+$|^___+$', line.strip()):
+            elif _HR_RE.match(line.strip()):
                 print(DIM + line + RESET)
             # Blockquotes
             elif line.startswith('>'):
@@ -1329,74 +2322,74 @@ class StreamRenderer:
     def __init__(self):
         self.line_buffer = ""
         self.in_code_block = False
+        self._write = sys.stdout.write
+        # Piped output gets the plain markdown: no colors to add, nothing to buffer
+        self._plain = not sys.stdout.isatty()
 
     def feed(self, text: str):
         """Feed a chunk of text. Renders complete lines with markdown colors."""
-        self.line_buffer += text
+        if self._plain:
+            self._write(text)
+            sys.stdout.flush()
+            return
 
-        while "\n" in self.line_buffer:
-            line, self.line_buffer = self.line_buffer.split("\n", 1)
-            self._render_line(line)
-            print(flush=True)
+        self.line_buffer += text
+        if "\n" not in self.line_buffer:
+            return
 
-        # Flush partial lines to show streaming in real-time
+        # Complete lines go out in one write, partial line stays buffered
+        *lines, self.line_buffer = self.line_buffer.split("\n")
+        out = []
+        for line in lines:
+            out.append(self._format_line(line))
+            out.append("\n")
+        self._write("".join(out))
         sys.stdout.flush()
 
     def flush(self):
         """Flush any remaining text in the buffer."""
         if self.line_buffer:
-            self._render_line(self.line_buffer)
+            self._write(self._format_line(self.line_buffer))
             self.line_buffer = ""
             sys.stdout.flush()
 
-    def _render_line(self, line: str):
-        """Render a single line with markdown formatting."""
+    def _format_line(self, line: str) -> str:
+        """Format a single line with markdown colors."""
         stripped = line.strip()
 
         # Code block delimiters
         if stripped.startswith("```"):
-            print(FG_YELLOW + line + RESET, end="")
             self.in_code_block = not self.in_code_block
-            return
+            return FG_YELLOW + line + RESET
 
         # Inside code block
         if self.in_code_block:
-            print(FG_MAGENTA + line + RESET, end="")
-            return
+            return FG_MAGENTA + line + RESET
 
         # Headers
-        if re.match(r'^#{1,6}\s', line):
-            print(BOLD + FG_CYAN + line + RESET, end="")
+        if _HEADER_RE.match(line):
+            return CYAN_BOLD + line + RESET
         # Bullet lists
-        elif re.match(r'^(\s*)([-*+])\s', line):
-            m = re.match(r'^(\s*)([-*+])\s(.*)', line)
-            if m:
-                print(f"{m.group(1)}{FG_GREEN}{m.group(2)}{RESET} {_render_inline_markdown(m.group(3))}", end="")
-            else:
-                print(line, end="")
+        if m := _BULLET_RE.match(line):
+            return f"{m.group(1)}{FG_GREEN}{m.group(2)}{RESET} {_render_inline_markdown(m.group(3))}"
         # Numbered lists
-        elif re.match(r'^(\s*)\d+[.)]\s', line):
-            m = re.match(r'^(\s*)(\d+[.)]\s)(.*)', line)
-            if m:
-                print(f"{m.group(1)}{FG_GREEN}{m.group(2)}{RESET}{_render_inline_markdown(m.group(3))}", end="")
-            else:
-                print(line, end="")
+        if m := _NUM_RE.match(line):
+            return f"{m.group(1)}{FG_GREEN}{m.group(2)}{RESET}{_render_inline_markdown(m.group(3))}"
         # Blockquotes
-        elif line.startswith('>'):
-            print(f"{FG_YELLOW}│{RESET} {DIM}{line[1:].strip()}{RESET}", end="")
+        if line.startswith('>'):
+            return f"{FG_YELLOW}│{RESET} {DIM}{line[1:].strip()}{RESET}"
         # Horizontal rules
-        elif re.match(r'^---+$|^\*\*\*+$|^___+$', stripped):
-            print(DIM + line + RESET, end="")
+        if _HR_RE.match(stripped):
+            return DIM + line + RESET
         # Normal text with inline formatting
-        else:
-            print(_render_inline_markdown(line), end="")
+        return _render_inline_markdown(line)
 
 
 def print_diff(old: str, new: str, path_display: str):
     """Print colored diff."""
-    print(f"\n{FG_WHITE}{BOLD}{'─' * 70}{RESET}")
-    print(f"{FG_WHITE}{BOLD}📝 Changes for: {path_display}{RESET}")
-    print(f"{FG_WHITE}{BOLD}{'─' * 70}{RESET}")
+    print(f"\n{WHITE_BOLD}{'─' * 70}{RESET}")
+    print(f"{WHITE_BOLD}📝 Changes for: {path_display}{RESET}")
+    print(f"{WHITE_BOLD}{'─' * 70}{RESET}")
 
     diff = difflib.unified_diff(
         old.splitlines(),
@@ -1406,16 +2399,20 @@ def print_diff(old: str, new: str, path_display: str):
         lineterm="",
     )
 
+    # Color every line first, then emit the whole diff in one write
+    out = []
+    append = out.append
     for line in diff:
         if line.startswith("+") and not line.startswith("+++"):
-            print(FG_GREEN + line + RESET)
+            append(f"{FG_GREEN}{line}{RESET}")
         elif line.startswith("-") and not line.startswith("---"):
-            print(FG_RED + line + RESET)
+            append(f"{FG_RED}{line}{RESET}")
         elif line.startswith("@@"):
-            print(FG_YELLOW + line + RESET)
+            append(f"{FG_YELLOW}{line}{RESET}")
         else:
-            print(DIM + line + RESET)
-    print(f"{FG_WHITE}{BOLD}{'─' * 70}{RESET}\n")
+            append(f"{DIM}{line}{RESET}")
+    out.append(f"{WHITE_BOLD}{'─' * 70}{RESET}\n\n")
+    sys.stdout.write("\n".join(out))
 
 
 def apply_file_changes(blocks, current_dir: str, session: ChatSession):
@@ -1432,7 +2429,7 @@ def apply_file_changes(blocks, current_dir: str, session: ChatSession):
         abs_path = resolve_path(rel_path, current_dir)
 
         # Safety checks
-        if not is_safe_path(abs_path):
+        if not in_sandbox(abs_path):
             print(f"{BG_RED}{FG_WHITE} ⛔ BLOCKED {RESET} {FG_RED}Path outside sandbox: {abs_path}{RESET}")
             log_operation("BLOCKED_WRITE", abs_path)
             continue
@@ -1446,26 +2443,25 @@ def apply_file_changes(blocks, current_dir: str, session: ChatSession):
         new_content = block["content"].rstrip("\n") + "\n"
 
         # Read existing content
-        old_content = ""
-        if os.path.exists(abs_path):
-            try:
-                with open(abs_path, "r", encoding="utf-8") as f:
-                    old_content = f.read()
-            except Exception as e:
-                print(f"{FG_RED}Cannot read existing file {abs_path}: {e}{RESET}")
-                continue
+        try:
+            old_content = read_text_cached(abs_path)
+        except FileNotFoundError:
+            old_content = ""
+        except Exception as e:
+            print(f"{FG_RED}Cannot read existing file {abs_path}: {e}{RESET}")
+            continue
 
-        rel_display = os.path.relpath(abs_path, ROOT_DIR)
+        rel_display = rel_to_root(abs_path)
 
         # Show diff
         if old_content:
             print_diff(old_content, new_content, rel_display)
         else:
-            print(f"\n{FG_WHITE}{BOLD}{'─' * 70}{RESET}")
+            print(f"\n{WHITE_BOLD}{'─' * 70}{RESET}")
             print(f"{FG_GREEN}➕ NEW FILE: {rel_display}{RESET}")
-            print(f"{FG_WHITE}{BOLD}{'─' * 70}{RESET}")
+            print(f"{WHITE_BOLD}{'─' * 70}{RESET}")
             print(FG_MAGENTA + new_content[:600] + ("..." if len(new_content) > 600 else "") + RESET)
-            print(f"{FG_WHITE}{BOLD}{'─' * 70}{RESET}\n")
+            print(f"{WHITE_BOLD}{'─' * 70}{RESET}\n")
 
         changes_to_apply.append({
             "path": abs_path,
@@ -1515,8 +2511,7 @@ def _write_file(change: Dict, session: ChatSession):
 
         # Write
         os.makedirs(os.path.dirname(change["path"]), exist_ok=True)
-        with open(change["path"], "w", encoding="utf-8") as f:
-            f.write(change["new"])
+        replace_file(change["path"], change["new"])
 
         print(f"{FG_GREEN}  ✅ Wrote {change['display']}{RESET}")
 
@@ -1526,16 +2521,15 @@ def _write_file(change: Dict, session: ChatSession):
         log_operation("FILE_WRITE", change["display"])
 
         # Add to opened files for context
-        session.opened_files[change["path"]] = change["new"]
+        session.set_opened_file(change["path"], change["new"])
 
     except Exception as e:
         print(f"{FG_RED}  ❌ Error writing {change['path']}: {e}{RESET}")
         log_operation("FILE_WRITE_ERROR", f"{change['path']}: {e}")
 
 
-def maybe_save_code_block(text: str, current_dir: str, session: ChatSession):
+def maybe_save_code_block(blocks: List[Dict[str, str]], current_dir: str, session: ChatSession):
     """Offer to save code blocks."""
-    blocks = extract_code_blocks(text)
     if not blocks:
         return
 
@@ -1573,19 +2567,16 @@ def maybe_save_code_block(text: str, current_dir: str, session: ChatSession):
         print(f"{FG_CYAN}Using filename: {ans}{RESET}")
 
     abs_path = resolve_path(ans, current_dir)
-    if not is_safe_path(abs_path):
+    if not in_sandbox(abs_path):
         print(f"{FG_RED}Cannot save outside sandbox{RESET}")
         return
 
-    old_content = ""
-    if os.path.exists(abs_path):
-        try:
-            with open(abs_path, "r", encoding="utf-8") as f:
-                old_content = f.read()
-        except Exception:
-            pass
+    try:
+        old_content = read_text_cached(abs_path)
+    except Exception:
+        old_content = ""
 
-    rel_display = os.path.relpath(abs_path, ROOT_DIR)
+    rel_display = rel_to_root(abs_path)
 
     if old_content:
         print_diff(old_content, content, rel_display)
@@ -1611,7 +2602,7 @@ def handle_tree(parts: List[str], cwd: str):
     """Handle /tree command."""
     target = resolve_path(" ".join(parts[1:]) if len(parts) > 1 else "", cwd)
 
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot access outside sandbox{RESET}")
         return
 
@@ -1634,7 +2625,7 @@ def handle_grep(parts: List[str], cwd: str):
     pattern = parts[1]
     target = resolve_path(" ".join(parts[2:]) if len(parts) > 2 else "", cwd)
 
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot search outside sandbox{RESET}")
         return
 
@@ -1645,13 +2636,16 @@ def handle_grep(parts: List[str], cwd: str):
         print(f"{FG_YELLOW}No matches found.{RESET}")
         return
 
-    print(f"\n{FG_GREEN}Found {len(results)} match(es):{RESET}\n")
-    for file_path, line_num, line_content in results[:50]:
-        rel_path = os.path.relpath(file_path, ROOT_DIR)
-        print(f"{FG_BLUE}{rel_path}{RESET}:{FG_YELLOW}{line_num}{RESET}: {line_content}")
+    out = [f"\n{FG_GREEN}Found {len(results)} match(es):{RESET}\n"]
+    out.extend(
+        f"{FG_BLUE}{rel_to_root(file_path)}{RESET}:{FG_YELLOW}{line_num}{RESET}: {line_content}"
+        for file_path, line_num, line_content in results[:50]
+    )
 
     if len(results) > 50:
-        print(f"\n{FG_YELLOW}... and {len(results) - 50} more matches{RESET}")
+        out.append(f"\n{FG_YELLOW}... and {len(results) - 50} more matches{RESET}")
+    out.append("")
+    sys.stdout.write("\n".join(out))
 
 
 def handle_diff(parts: List[str], cwd: str):
@@ -1663,18 +2657,16 @@ def handle_diff(parts: List[str], cwd: str):
     file1 = resolve_path(parts[1], cwd)
     file2 = resolve_path(parts[2], cwd)
 
-    if not is_safe_path(file1) or not is_safe_path(file2):
+    if not in_sandbox(file1) or not in_sandbox(file2):
         print(f"{FG_RED}Cannot access files outside sandbox{RESET}")
         return
 
     try:
-        with open(file1, 'r', encoding='utf-8') as f:
-            content1 = f.read()
-        with open(file2, 'r', encoding='utf-8') as f:
-            content2 = f.read()
+        content1 = read_text_cached(file1)
+        content2 = read_text_cached(file2)
 
-        rel1 = os.path.relpath(file1, ROOT_DIR)
-        rel2 = os.path.relpath(file2, ROOT_DIR)
+        rel1 = rel_to_root(file1)
+        rel2 = rel_to_root(file2)
 
         print_diff(content1, content2, f"{rel1} ↔ {rel2}")
     except Exception as e:
@@ -1699,13 +2691,12 @@ def handle_template(parts: List[str], cwd: str, session: ChatSession) -> Optiona
         return None
 
     file_path = resolve_path(parts[2], cwd)
-    if not is_safe_path(file_path) or not os.path.isfile(file_path):
+    if not in_sandbox(file_path) or not os.path.isfile(file_path):
         print(f"{FG_RED}Invalid file: {file_path}{RESET}")
         return None
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = read_text_cached(file_path)
 
         return TEMPLATES[template_name] + f"```\n{content}\n```"
     except Exception as e:
@@ -1713,37 +2704,42 @@ def handle_template(parts: List[str], cwd: str, session: ChatSession) -> Optiona
         return None
 
 
+# Every possible context budget bar, indexed by filled cells
+_BUDGET_BAR_LEN = 20
+_BUDGET_BARS = tuple("█" * i + "░" * (_BUDGET_BAR_LEN - i) for i in range(_BUDGET_BAR_LEN + 1))
+
+
 def handle_context(parts: List[str], session: ChatSession, cwd: str):
     """Handle /context command."""
     if len(parts) < 2:
         # Show current context
-        print(f"\n{FG_CYAN}📚 Current Context:{RESET}\n")
-        print(
-            f"  Auto-context: {FG_GREEN if session.auto_context_enabled else FG_RED}{'enabled' if session.auto_context_enabled else 'disabled'}{RESET}")
-        print(f"  Project files: {len(session.project_context)}")
-        print(f"  Loaded files: {len(session.opened_files)}")
+        out = [
+            f"\n{FG_CYAN}📚 Current Context:{RESET}\n",
+            f"  Auto-context: {FG_GREEN if session.auto_context_enabled else FG_RED}{'enabled' if session.auto_context_enabled else 'disabled'}{RESET}",
+            f"  Project files: {len(session.project_context)}",
+            f"  Loaded files: {len(session.opened_files)}",
+        ]
 
         # Show context budget usage
-        total_chars = sum(len(c) for c in session.opened_files.values())
+        total_chars = session.opened_chars
         pct = (total_chars / MAX_FILE_CONTEXT_CHARS * 100) if MAX_FILE_CONTEXT_CHARS > 0 else 0
-        bar_len = 20
-        filled = int(bar_len * min(pct, 100) / 100)
-        bar = "█" * filled + "░" * (bar_len - filled)
+        bar = _BUDGET_BARS[int(_BUDGET_BAR_LEN * min(pct, 100) / 100)]
         color = FG_GREEN if pct < 70 else (FG_YELLOW if pct < 90 else FG_RED)
-        print(f"  Context budget: {color}{bar} {total_chars}/{MAX_FILE_CONTEXT_CHARS} chars ({pct:.0f}%){RESET}")
+        out.append(f"  Context budget: {color}{bar} {total_chars}/{MAX_FILE_CONTEXT_CHARS} chars ({pct:.0f}%){RESET}")
 
         if session.project_context:
-            print(f"\n  {FG_CYAN}Project context files:{RESET}")
+            out.append(f"\n  {FG_CYAN}Project context files:{RESET}")
             for name, content in session.project_context.items():
-                print(f"    • {name} ({len(content)} chars)")
+                out.append(f"    • {name} ({len(content)} chars)")
 
         if session.opened_files:
-            print(f"\n  {FG_CYAN}Opened files:{RESET}")
+            out.append(f"\n  {FG_CYAN}Opened files:{RESET}")
             for path, content in session.opened_files.items():
-                rel = os.path.relpath(path, ROOT_DIR)
-                print(f"    • {rel} ({len(content)} chars)")
+                rel = rel_to_root(path)
+                out.append(f"    • {rel} ({len(content)} chars)")
 
-        print()
+        out.append("\n")
+        sys.stdout.write("\n".join(out))
         return
 
     subcmd = parts[1].lower()
@@ -1792,7 +2788,7 @@ def handle_restore(parts: List[str], cwd: str):
     backup_name = parts[1]
     target_path = resolve_path(parts[2], cwd)
 
-    if not is_safe_path(target_path):
+    if not in_sandbox(target_path):
         print(f"{FG_RED}Cannot restore outside sandbox{RESET}")
         return
 
@@ -1807,20 +2803,25 @@ def handle_restore(parts: List[str], cwd: str):
 
 def handle_stats(session: ChatSession):
     """Handle /stats command."""
-    print(f"\n{FG_CYAN}{'═' * 60}{RESET}")
-    print(f"{FG_CYAN}{BOLD}📊 Session Statistics{RESET}")
-    print(f"{FG_CYAN}{'═' * 60}{RESET}")
-    print(f"  Queries sent:           {session.stats['queries']}")
-    print(f"  Files modified:         {session.stats['files_modified']}")
-    print(f"  Files auto-loaded:      {session.stats['files_auto_loaded']}")
-    print(f"  Prompt tokens (total):  {session.stats['prompt_tokens']}")
-    print(f"  Generated tokens:       {session.stats['tokens_generated']}")
-    print(f"  Files in context:       {len(session.opened_files)}")
-    print(f"  Project context files:  {len(session.project_context)}")
-    print(f"  History entries:        {len(session.history)}")
-    print(
-        f"  Auto-context:           {FG_GREEN if session.auto_context_enabled else FG_RED}{'enabled' if session.auto_context_enabled else 'disabled'}{RESET}")
-    print(f"{FG_CYAN}{'═' * 60}{RESET}\n")
+    rule = f"{FG_CYAN}{'═' * 60}{RESET}"
+    sys.stdout.write("\n".join([
+        "",
+        rule,
+        f"{CYAN_BOLD}📊 Session Statistics{RESET}",
+        rule,
+        f"  Queries sent:           {session.stats['queries']}",
+        f"  Files modified:         {session.stats['files_modified']}",
+        f"  Files auto-loaded:      {session.stats['files_auto_loaded']}",
+        f"  Prompt tokens (total):  {session.stats['prompt_tokens']}",
+        f"  Generated tokens:       {session.stats['tokens_generated']}",
+        f"  Cached responses used:  {session.stats['cache_hits']}",
+        f"  Files in context:       {len(session.opened_files)}",
+        f"  Project context files:  {len(session.project_context)}",
+        f"  History entries:        {len(session.history)}",
+        f"  Auto-context:           {FG_GREEN if session.auto_context_enabled else FG_RED}{'enabled' if session.auto_context_enabled else 'disabled'}{RESET}",
+        rule,
+        "\n",
+    ]))
 
 
 # ---------------------------------------------------------------------------
@@ -1841,104 +2842,114 @@ def print_banner():
     print(FG_MAGENTA + logo + RESET)
 
 
+_HELP_BODY = "\n".join([
+    "",
+    "🎯 KEY FEATURES:",
+    "  • Automatic file loading when you mention them",
+    "  • Full project context awareness",
+    "  • Image support (with PIL)",
+    "  • Smart code suggestions based on your codebase",
+    "",
+    "CORE COMMANDS:",
+    f"  {FG_GREEN}/help{RESET}                  Show this help",
+    f"  {FG_GREEN}/exit{RESET}                  Quit",
+    f"  {FG_GREEN}/clear{RESET}                 Clear chat history",
+    "",
+    "CONTEXT MANAGEMENT:",
+    f"  {FG_GREEN}/context{RESET}               Show current context",
+    f"  {FG_GREEN}/context on|off{RESET}        Enable/disable auto-context",
+    f"  {FG_GREEN}/context clear{RESET}         Clear loaded files",
+    f"  {FG_GREEN}/context reload{RESET}        Reload project context",
+    f"  {FG_GREEN}/open <file>{RESET}           Manually load file",
+    "",
+    "MODEL & SETTINGS:",
+    f"  {FG_GREEN}/model <id>{RESET}            Switch model",
+    f"  {FG_GREEN}/models{RESET}                List available models",
+    f"  {FG_GREEN}/installed{RESET}             Show installed models",
+    f"  {FG_GREEN}/download <model>{RESET}      Download a model",
+    f"  {FG_GREEN}/delete <model>{RESET}        Delete a model from cache",
+    "",
+    f"  {FG_CYAN}Quick model switches (M4 Pro 24GB optimized):{RESET}",
+    f"    {FG_GREEN}/q1.5b{RESET} (1GB)   {FG_GREEN}/q3b{RESET} (2GB)    {FG_GREEN}/q7b{RESET} (4GB)    {FG_GREEN}/q14b{RESET} (9GB)   {FG_GREEN}/q32b{RESET} (17GB)",
+    f"    {FG_GREEN}/ds1.3b{RESET} (1GB)  {FG_GREEN}/ds6.7b{RESET} (4GB)  {FG_GREEN}/ds{RESET} (9GB)     {FG_GREEN}/deepseek{RESET} (9GB)",
+    f"    {FG_GREEN}/phi3{RESET} (2GB)    {FG_GREEN}/llama3-8b{RESET} (5GB)  {FG_GREEN}/mistral{RESET} (4GB)  {FG_GREEN}/codellama{RESET} (7GB)",
+    "",
+    f"  {FG_GREEN}/tokens <n>{RESET}            Set max tokens",
+    f"  {FG_GREEN}/ctx <n>{RESET}               Set context size",
+    "",
+    "NAVIGATION:",
+    f"  {FG_GREEN}/pwd{RESET}                   Show directory",
+    f"  {FG_GREEN}/cd <path>{RESET}             Change directory",
+    f"  {FG_GREEN}/ls [path]{RESET}             List files",
+    f"  {FG_GREEN}/tree [path]{RESET}           Show tree",
+    "",
+    "SEARCH & COMPARE:",
+    f"  {FG_GREEN}/find <pattern>{RESET}        Find files by name (glob)",
+    f"  {FG_GREEN}/grep <pattern>{RESET}        Search in file contents",
+    f"  {FG_GREEN}/diff <f1> <f2>{RESET}        Compare files",
+    f"  {FG_GREEN}/replace <f> \"a\" \"b\"{RESET}  Find and replace in file",
+    "",
+    "GIT:",
+    f"  {FG_GREEN}/git{RESET}                   Show git subcommands",
+    f"  {FG_GREEN}/git status{RESET}             Show changed files",
+    f"  {FG_GREEN}/git diff{RESET}               Show changes",
+    f"  {FG_GREEN}/git log{RESET}                Recent commits",
+    f"  {FG_GREEN}/git add <file>{RESET}         Stage file",
+    f"  {FG_GREEN}/git commit <msg>{RESET}       Commit changes",
+    "",
+    "TEMPLATES:",
+    f"  {FG_GREEN}/template{RESET}              List templates",
+    f"  {FG_GREEN}/template <name> <file>{RESET} Apply template",
+    f"    Available: test, doc, refactor, review, optimize, explain, debug, secure",
+    "",
+    "BACKUP & HISTORY:",
+    f"  {FG_GREEN}/undo{RESET}                  Undo last file modification",
+    f"  {FG_GREEN}/backups [file]{RESET}        List backups",
+    f"  {FG_GREEN}/restore <bk> <file>{RESET}   Restore from backup",
+    f"  {FG_GREEN}/save [file]{RESET}           Export chat",
+    "",
+    "EXECUTION:",
+    f"  {FG_GREEN}/run <command>{RESET}         Execute a shell command",
+    f"  {FG_GREEN}/run <cmd> --ai{RESET}        Run and send output to AI",
+    "",
+    "UTILITIES:",
+    f"  {FG_GREEN}/copy{RESET}                  Copy last code block to clipboard",
+    f"  {FG_GREEN}/last{RESET}                  Repeat last query",
+    f"  {FG_GREEN}/edit{RESET}                  Open last file in $EDITOR",
+    f"  {FG_GREEN}/stats{RESET}                 Show statistics",
+    f"  {FG_GREEN}/project{RESET}               Detect project type",
+    "",
+    "💡 SMART FEATURES:",
+    "  • Just mention a file (e.g., 'check main.py') and it's auto-loaded!",
+    "  • The assistant reads and understands your project structure",
+    "  • Multi-line input: finish with empty line",
+    "  • All files backed up before modification",
+    "",
+] + ([
+    "⌨️  KEYBOARD SHORTCUTS:",
+    "  • ↑/↓ Arrow keys: Navigate command history",
+    "  • ←/→ Arrow keys: Move cursor for editing",
+    "  • Tab: Auto-complete commands",
+    "  • Ctrl+C: Clear current input (or use /exit to quit)",
+    "  • Ctrl+D: Exit",
+    "  • Ctrl+R: Search command history",
+] if HAS_PROMPT_TOOLKIT else [
+    f"{FG_YELLOW}💡 Install prompt-toolkit for better input: pip install prompt-toolkit{RESET}",
+]) + [
+    "=" * 80,
+    "",
+])
+
+
 def print_help():
-    print("=" * 80)
-    print(" MLX-CODE-PRO — Intelligent Context-Aware Coding Assistant")
-    print("=" * 80)
-    print(f"Working Directory: {FG_CYAN}{ROOT_DIR}{RESET}")
-    print()
-    print("🎯 KEY FEATURES:")
-    print("  • Automatic file loading when you mention them")
-    print("  • Full project context awareness")
-    print("  • Image support (with PIL)")
-    print("  • Smart code suggestions based on your codebase")
-    print()
-    print("CORE COMMANDS:")
-    print(f"  {FG_GREEN}/help{RESET}                  Show this help")
-    print(f"  {FG_GREEN}/exit{RESET}                  Quit")
-    print(f"  {FG_GREEN}/clear{RESET}                 Clear chat history")
-    print()
-    print("CONTEXT MANAGEMENT:")
-    print(f"  {FG_GREEN}/context{RESET}               Show current context")
-    print(f"  {FG_GREEN}/context on|off{RESET}        Enable/disable auto-context")
-    print(f"  {FG_GREEN}/context clear{RESET}         Clear loaded files")
-    print(f"  {FG_GREEN}/context reload{RESET}        Reload project context")
-    print(f"  {FG_GREEN}/open <file>{RESET}           Manually load file")
-    print()
-    print("MODEL & SETTINGS:")
-    print(f"  {FG_GREEN}/model <id>{RESET}            Switch model")
-    print(f"  {FG_GREEN}/models{RESET}                List available models")
-    print(f"  {FG_GREEN}/installed{RESET}             Show installed models")
-    print(f"  {FG_GREEN}/download <model>{RESET}      Download a model")
-    print(f"  {FG_GREEN}/delete <model>{RESET}        Delete a model from cache")
-    print()
-    print(f"  {FG_CYAN}Quick model switches (M4 Pro 24GB optimized):{RESET}")
-    print(f"    {FG_GREEN}/q1.5b{RESET} (1GB)   {FG_GREEN}/q3b{RESET} (2GB)    {FG_GREEN}/q7b{RESET} (4GB)    {FG_GREEN}/q14b{RESET} (9GB)   {FG_GREEN}/q32b{RESET} (17GB)")
-    print(f"    {FG_GREEN}/ds1.3b{RESET} (1GB)  {FG_GREEN}/ds6.7b{RESET} (4GB)  {FG_GREEN}/ds{RESET} (9GB)     {FG_GREEN}/deepseek{RESET} (9GB)")
-    print(f"    {FG_GREEN}/phi3{RESET} (2GB)    {FG_GREEN}/llama3-8b{RESET} (5GB)  {FG_GREEN}/mistral{RESET} (4GB)  {FG_GREEN}/codellama{RESET} (7GB)")
-    print()
-    print(f"  {FG_GREEN}/tokens <n>{RESET}            Set max tokens")
-    print(f"  {FG_GREEN}/ctx <n>{RESET}               Set context size")
-    print()
-    print("NAVIGATION:")
-    print(f"  {FG_GREEN}/pwd{RESET}                   Show directory")
-    print(f"  {FG_GREEN}/cd <path>{RESET}             Change directory")
-    print(f"  {FG_GREEN}/ls [path]{RESET}             List files")
-    print(f"  {FG_GREEN}/tree [path]{RESET}           Show tree")
-    print()
-    print("SEARCH & COMPARE:")
-    print(f"  {FG_GREEN}/find <pattern>{RESET}        Find files by name (glob)")
-    print(f"  {FG_GREEN}/grep <pattern>{RESET}        Search in file contents")
-    print(f"  {FG_GREEN}/diff <f1> <f2>{RESET}        Compare files")
-    print(f"  {FG_GREEN}/replace <f> \"a\" \"b\"{RESET}  Find and replace in file")
-    print()
-    print("GIT:")
-    print(f"  {FG_GREEN}/git{RESET}                   Show git subcommands")
-    print(f"  {FG_GREEN}/git status{RESET}             Show changed files")
-    print(f"  {FG_GREEN}/git diff{RESET}               Show changes")
-    print(f"  {FG_GREEN}/git log{RESET}                Recent commits")
-    print(f"  {FG_GREEN}/git add <file>{RESET}         Stage file")
-    print(f"  {FG_GREEN}/git commit <msg>{RESET}       Commit changes")
-    print()
-    print("TEMPLATES:")
-    print(f"  {FG_GREEN}/template{RESET}              List templates")
-    print(f"  {FG_GREEN}/template <name> <file>{RESET} Apply template")
-    print(f"    Available: test, doc, refactor, review, optimize, explain, debug, secure")
-    print()
-    print("BACKUP & HISTORY:")
-    print(f"  {FG_GREEN}/undo{RESET}                  Undo last file modification")
-    print(f"  {FG_GREEN}/backups [file]{RESET}        List backups")
-    print(f"  {FG_GREEN}/restore <bk> <file>{RESET}   Restore from backup")
-    print(f"  {FG_GREEN}/save [file]{RESET}           Export chat")
-    print()
-    print("EXECUTION:")
-    print(f"  {FG_GREEN}/run <command>{RESET}         Execute a shell command")
-    print(f"  {FG_GREEN}/run <cmd> --ai{RESET}        Run and send output to AI")
-    print()
-    print("UTILITIES:")
-    print(f"  {FG_GREEN}/copy{RESET}                  Copy last code block to clipboard")
-    print(f"  {FG_GREEN}/last{RESET}                  Repeat last query")
-    print(f"  {FG_GREEN}/edit{RESET}                  Open last file in $EDITOR")
-    print(f"  {FG_GREEN}/stats{RESET}                 Show statistics")
-    print(f"  {FG_GREEN}/project{RESET}               Detect project type")
-    print()
-    print("💡 SMART FEATURES:")
-    print("  • Just mention a file (e.g., 'check main.py') and it's auto-loaded!")
-    print("  • The assistant reads and understands your project structure")
-    print("  • Multi-line input: finish with empty line")
-    print("  • All files backed up before modification")
-    print()
-    if HAS_PROMPT_TOOLKIT:
-        print("⌨️  KEYBOARD SHORTCUTS:")
-        print("  • ↑/↓ Arrow keys: Navigate command history")
-        print("  • ←/→ Arrow keys: Move cursor for editing")
-        print("  • Tab: Auto-complete commands")
-        print("  • Ctrl+C: Clear current input (or use /exit to quit)")
-        print("  • Ctrl+D: Exit")
-        print("  • Ctrl+R: Search command history")
-    else:
-        print(f"{FG_YELLOW}💡 Install prompt-toolkit for better input: pip install prompt-toolkit{RESET}")
-    print("=" * 80)
+    rule = "=" * 80
+    sys.stdout.write(
+        f"{rule}\n"
+        " MLX-CODE-PRO — Intelligent Context-Aware Coding Assistant\n"
+        f"{rule}\n"
+        f"Working Directory: {FG_CYAN}{ROOT_DIR}{RESET}\n"
+    )
+    sys.stdout.write(_HELP_BODY)
 
 
 def print_status(model_name: str, cwd: str, project_type: Optional[str], session: ChatSession):
@@ -1953,9 +2964,8 @@ def print_status(model_name: str, cwd: str, project_type: Optional[str], session
     auto_ctx = "🟢" if session.auto_context_enabled else "🔴"
     status_parts.append(f"{auto_ctx} auto-context")
 
-    print("=" * 80)
-    print(" | ".join(status_parts))
-    print("=" * 80)
+    rule = "=" * 80
+    sys.stdout.write(f"{rule}\n{' | '.join(status_parts)}\n{rule}\n")
 
 
 # ---------------------------------------------------------------------------
@@ -1973,19 +2983,22 @@ class AppState:
         self.session = session
         self.project_type = detect_project_type(cwd)
         self.buffer: List[str] = []
+        self.notices: List[str] = []  # Background results, printed before the next prompt
 
     def reload_session(self):
         """Create a new ChatSession preserving history and context."""
         old_history = self.session.history[:]
-        old_files = dict(self.session.opened_files)
+        old_files = self.session.opened_files
         old_stats = dict(self.session.stats)
         old_auto_ctx = self.session.auto_context_enabled
+        old_semantic = self.session.semantic_cache
 
         self.session = ChatSession(self.model_name, self.max_tokens, self.ctx_chars)
-        self.session.history = old_history
-        self.session.opened_files = old_files
+        self.session.set_history(old_history)
+        self.session.set_opened_files(old_files)
         self.session.stats = old_stats
         self.session.auto_context_enabled = old_auto_ctx
+        self.session.semantic_cache = old_semantic
         self.session.load_project_context(self.cwd)
         self.project_type = detect_project_type(self.cwd)
 
@@ -1995,11 +3008,12 @@ class AppState:
 # ---------------------------------------------------------------------------
 
 def cmd_exit(parts: List[str], state: AppState) -> Optional[str]:
-    config = {
+    config = load_config()  # Keep hand-set keys such as semantic_cache
+    config.update({
         "model": state.model_name,
         "max_tokens": state.max_tokens,
         "ctx_chars": state.ctx_chars,
-    }
+    })
     save_config(config)
     clear_autosave()
     print("Configuration saved. 👋 Goodbye!")
@@ -2012,7 +3026,7 @@ def cmd_help(parts: List[str], state: AppState) -> None:
 
 
 def cmd_clear(parts: List[str], state: AppState) -> None:
-    state.session.history.clear()
+    state.session.set_history([])
     print(f"{FG_GREEN}✓ Chat history cleared{RESET}")
 
 
@@ -2026,34 +3040,36 @@ def cmd_model(parts: List[str], state: AppState) -> None:
 
 
 def cmd_models(parts: List[str], state: AppState) -> None:
-    print(f"\n{FG_CYAN}{'═' * 80}{RESET}")
-    print(f"{FG_CYAN}{BOLD}📦 Available Models{RESET}")
-    print(f"{FG_CYAN}{'═' * 80}{RESET}\n")
-
-    models = list_available_models()
-    categories = {
-        "Qwen Coder (Recommended for Code)": ["q1.5b", "q3b", "q7b", "q14b", "q32b"],
-        "DeepSeek Coder (Excellent)": ["ds1.3b", "ds6.7b", "ds", "deepseek"],
-        "Mistral (Versatile)": ["mistral", "m7b"],
-        "Llama 3 (Strong Reasoning)": ["llama3-8b", "l3-8b"],
-        "Phi (Efficient)": ["phi3", "phi"],
-        "CodeLlama (Code Specialist)": ["codellama", "cl13b"],
-    }
+    table = list_available_models()
+    print(_render_models_menu(tuple(table.cached)), end="")
 
-    for category, aliases in categories.items():
-        print(f"{FG_YELLOW}{BOLD}{category}{RESET}")
-        for alias in aliases:
-            if alias in models:
-                model = models[alias]
-                status = f"{FG_GREEN}✓ Installed{RESET}" if model["cached"] else f"{FG_RED}✗ Not installed{RESET}"
-                print(f"  {FG_GREEN}/{alias:12}{RESET}  {model['size']:>7}  {model['ram']:>10} RAM  {status}")
-        print()
 
-    print(f"{FG_CYAN}💡 Usage:{RESET}")
-    print(f"  • Switch model: {FG_GREEN}/<alias>{RESET} (e.g., /q32b)")
-    print(f"  • Download: {FG_GREEN}/download <alias>{RESET} (e.g., /download q32b)")
-    print(f"  • Delete: {FG_GREEN}/delete <alias>{RESET}")
-    print(f"\n{FG_CYAN}{'═' * 80}{RESET}\n")
+@functools.lru_cache(maxsize=8)
+def _render_models_menu(cached: Tuple[bool, ...]) -> str:
+    """The /models menu text; only changes when a model is installed or removed."""
+    table = _model_table()
+    lines = [
+        f"\n{FG_CYAN}{'═' * 80}{RESET}",
+        f"{CYAN_BOLD}📦 Available Models{RESET}",
+        f"{FG_CYAN}{'═' * 80}{RESET}\n",
+    ]
+    for category, aliases in MODEL_CATEGORIES.items():
+        lines.append(f"{YELLOW_BOLD}{category}{RESET}")
+        for alias in aliases:
+            i = table.index.get(alias)
+            if i is not None:
+                status = f"{FG_GREEN}✓ Installed{RESET}" if cached[i] else f"{FG_RED}✗ Not installed{RESET}"
+                lines.append(f"  {FG_GREEN}/{alias:12}{RESET}  {table.sizes[i]:>7}  {table.rams[i]:>10} RAM  {status}")
+        lines.append("")
+
+    lines += [
+        f"{FG_CYAN}💡 Usage:{RESET}",
+        f"  • Switch model: {FG_GREEN}/<alias>{RESET} (e.g., /q32b)",
+        f"  • Download: {FG_GREEN}/download <alias>{RESET} (e.g., /download q32b)",
+        f"  • Delete: {FG_GREEN}/delete <alias>{RESET}",
+        f"\n{FG_CYAN}{'═' * 80}{RESET}\n",
+    ]
+    return "\n".join(lines) + "\n"
 
 
 def cmd_installed(parts: List[str], state: AppState) -> None:
@@ -2063,27 +3079,25 @@ def cmd_installed(parts: List[str], state: AppState) -> None:
         print(f"{FG_CYAN}Use {FG_GREEN}/models{FG_CYAN} to see available models{RESET}\n")
         return
 
-    print(f"\n{FG_CYAN}{'═' * 80}{RESET}")
-    print(f"{FG_CYAN}{BOLD}💾 Installed Models{RESET}")
-    print(f"{FG_CYAN}{'═' * 80}{RESET}\n")
+    rule = f"{FG_CYAN}{'═' * 80}{RESET}"
+    out = ["", rule, f"{CYAN_BOLD}💾 Installed Models{RESET}", rule, ""]
 
     total_size = 0
-    for m_name, dir_name, size_str in installed:
-        size_gb = float(size_str.replace("GB", ""))
+    aliases = _model_table().alias_by_name
+    for m_name, dir_name, size_gb in installed:
         total_size += size_gb
 
-        alias = None
-        for a, full_name in MODEL_ALIASES.items():
-            if full_name == m_name:
-                alias = f"/{a}"
-                break
-
-        alias_str = f"{FG_GREEN}{alias}{RESET}" if alias else ""
-        print(f"  {FG_CYAN}{m_name:55}{RESET} {size_str:>8}  {alias_str}")
+        alias = aliases.get(m_name)
+        alias_str = f"{FG_GREEN}/{alias}{RESET}" if alias else ""
+        out.append(f"  {FG_CYAN}{m_name:55}{RESET} {size_gb:>6.2f}GB  {alias_str}")
 
-    print(f"\n{FG_YELLOW}Total disk usage: {total_size:.2f}GB{RESET}")
-    print(f"{FG_CYAN}Cache location: ~/.cache/huggingface/hub/{RESET}")
-    print(f"{FG_CYAN}{'═' * 80}{RESET}\n")
+    out += [
+        f"\n{FG_YELLOW}Total disk usage: {total_size:.2f}GB{RESET}",
+        f"{FG_CYAN}Cache location: {HF_CACHE_DIR}{RESET}",
+        rule,
+        "\n",
+    ]
+    sys.stdout.write("\n".join(out))
 
 
 def cmd_download(parts: List[str], state: AppState) -> None:
@@ -2124,19 +3138,19 @@ def cmd_download(parts: List[str], state: AppState) -> None:
         return
 
     print(f"\n{FG_CYAN}Starting download...{RESET}\n")
-    success = download_model_with_git_lfs(target_model)
+    success = download_model_with_hf_transfer(target_model) or download_model_with_git_lfs(target_model)
 
     if not success:
         print(f"{FG_CYAN}Falling back to standard download...{RESET}\n")
         try:
-            spinner = Spinner("Downloading model")
-            spinner.start()
-            _model, _tokenizer = load(target_model)
-            spinner.stop()
+            # HuggingFace draws its own progress bars; a spinner would fight them.
+            # Fetch the files only: loading the weights just to cache them would
+            # allocate (and then have to free) the whole model.
+            from huggingface_hub import snapshot_download
+            print(f"{FG_CYAN}Downloading model...{RESET}", flush=True)
+            snapshot_download(repo_id=target_model, allow_patterns=HF_ALLOW_PATTERNS)
             print(f"{FG_GREEN}✅ Model downloaded successfully!{RESET}\n")
-            del _model, _tokenizer
         except Exception as e:
-            spinner.stop()
             print(f"{FG_RED}❌ Download failed: {e}{RESET}\n")
 
 
@@ -2202,7 +3216,7 @@ def cmd_cd(parts: List[str], state: AppState) -> None:
         print(f"{FG_RED}Usage: /cd <path>{RESET}")
         return
     target = resolve_path(" ".join(parts[1:]), state.cwd)
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot cd outside sandbox{RESET}")
         return
     if not os.path.isdir(target):
@@ -2219,6 +3233,8 @@ def cmd_cd(parts: List[str], state: AppState) -> None:
     if project_cfg:
         if "auto_context" in project_cfg:
             state.session.auto_context_enabled = bool(project_cfg["auto_context"])
+        if project_cfg.get("semantic_cache"):
+            state.session.enable_semantic_cache()
         print(f"{FG_CYAN}📋 Loaded project config from .mlx-code.json{RESET}")
 
     print_status(state.model_name, state.cwd, state.project_type, state.session)
@@ -2226,19 +3242,23 @@ def cmd_cd(parts: List[str], state: AppState) -> None:
 
 def cmd_ls(parts: List[str], state: AppState) -> None:
     target = resolve_path(" ".join(parts[1:]) if len(parts) > 1 else "", state.cwd)
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot list outside sandbox{RESET}")
         return
     if not os.path.isdir(target):
         print(f"{FG_RED}No such directory{RESET}")
         return
-    entries = sorted(os.listdir(target))
-    for name in entries:
-        full = os.path.join(target, name)
-        if os.path.isdir(full):
-            print(FG_BLUE + name + "/" + RESET)
-        else:
-            print(name)
+    # DirEntry.is_dir() reuses the type from the directory read
+    with os.scandir(target) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    out = [f"{FG_BLUE}{e.name}/{RESET}" if e.is_dir() else e.name for e in entries]
+    if out:
+        out.append("")
+    sys.stdout.write("\n".join(out))
+
+
+# "<file>:<start>[-<end>]"; the greedy file group splits on the last colon
+_OPEN_RANGE_RE = re.compile(r'^(.*):(\d+)(?:-(\d+))?$')
 
 
 def cmd_open(parts: List[str], state: AppState) -> None:
@@ -2255,28 +3275,15 @@ def cmd_open(parts: List[str], state: AppState) -> None:
     line_start = None
     line_end = None
 
-    # Parse line range (file.py:10-50 or file.py:100)
-    if ":" in raw_arg:
-        last_colon = raw_arg.rfind(":")
-        range_part = raw_arg[last_colon + 1:]
-        file_part = raw_arg[:last_colon]
-
-        # Check if it looks like a line range (not a Windows path like C:\...)
-        if re.match(r'^\d+(-\d+)?$', range_part):
-            if "-" in range_part:
-                try:
-                    line_start, line_end = map(int, range_part.split("-", 1))
-                except ValueError:
-                    pass
-            else:
-                try:
-                    line_start = int(range_part)
-                except ValueError:
-                    pass
-            raw_arg = file_part
+    # Parse line range (file.py:10-50 or file.py:100), not a Windows path like C:\...
+    m = _OPEN_RANGE_RE.match(raw_arg)
+    if m:
+        raw_arg, start, end = m.groups()
+        line_start = int(start)
+        line_end = int(end) if end else None
 
     target = resolve_path(raw_arg, state.cwd)
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot open outside sandbox{RESET}")
         return
     if not os.path.isfile(target):
@@ -2286,37 +3293,38 @@ def cmd_open(parts: List[str], state: AppState) -> None:
     try:
         if is_image_file(target):
             desc = describe_image(target)
-            state.session.opened_files[target] = desc
+            state.session.set_opened_file(target, desc)
             print(f"{FG_GREEN}✓ Loaded image: {desc}{RESET}")
             return
 
         file_size = os.path.getsize(target)
-        rel = os.path.relpath(target, ROOT_DIR)
-
-        with open(target, "r", encoding="utf-8") as f:
-            all_lines = f.readlines()
+        rel = rel_to_root(target)
 
-        total_lines = len(all_lines)
-
-        # Apply line range
         if line_start is not None:
+            # Only the lines up to the range are read; the total is known only if it reached EOF
             start_idx = max(0, line_start - 1)  # Convert to 0-based
-            end_idx = line_end if line_end else total_lines
-            end_idx = min(end_idx, total_lines)
+            selected, at_eof = read_line_range(target, start_idx, line_end)
+            if not selected:
+                print(f"{FG_YELLOW}No lines in that range of {rel}{RESET}")
+                return
+            end_idx = start_idx + len(selected)
+            total_lines = end_idx if at_eof else None
+            of_total = f" of {total_lines}" if total_lines is not None else ""
 
-            selected = all_lines[start_idx:end_idx]
             # Add line numbers for context
             numbered = []
             for i, line in enumerate(selected, start=start_idx + 1):
                 numbered.append(f"{i:4d} | {line.rstrip()}")
-            content = f"[Lines {start_idx + 1}-{end_idx} of {total_lines} in {rel}]\n" + "\n".join(numbered)
-            range_str = f" (lines {start_idx + 1}-{end_idx} of {total_lines})"
+            content = f"[Lines {start_idx + 1}-{end_idx}{of_total} in {rel}]\n" + "\n".join(numbered)
+            range_str = f" (lines {start_idx + 1}-{end_idx}{of_total})"
         else:
-            content = "".join(all_lines)
+            content = read_text_cached(target)
+            total_lines = content.count("\n") + (1 if content and not content.endswith("\n") else 0)
             range_str = ""
 
-        state.session.opened_files[target] = content
-        print(f"{FG_GREEN}✓ Loaded {rel}{range_str} — {len(content)} chars, {total_lines} total lines, {file_size / 1024:.1f}KB{RESET}")
+        state.session.set_opened_file(target, content)
+        lines_str = f", {total_lines} total lines" if total_lines is not None else ""
+        print(f"{FG_GREEN}✓ Loaded {rel}{range_str} — {len(content)} chars{lines_str}, {file_size / 1024:.1f}KB{RESET}")
 
     except Exception as e:
         print(f"{FG_RED}Error: {e}{RESET}")
@@ -2335,7 +3343,7 @@ def cmd_undo(parts: List[str], state: AppState) -> None:
         return
 
     last_file = state.session.last_modified_files[-1]
-    rel_display = os.path.relpath(last_file, ROOT_DIR)
+    rel_display = rel_to_root(last_file)
     backups = list_backups(last_file)
 
     if not backups:
@@ -2353,8 +3361,7 @@ def cmd_undo(parts: List[str], state: AppState) -> None:
             state.session.last_modified_files.pop()
             log_operation("UNDO", rel_display)
             try:
-                with open(last_file, 'r', encoding='utf-8', errors='ignore') as f:
-                    state.session.opened_files[last_file] = f.read(10000)
+                state.session.set_opened_file(last_file, read_file_head(last_file)[0])
             except Exception:
                 pass
         else:
@@ -2363,33 +3370,62 @@ def cmd_undo(parts: List[str], state: AppState) -> None:
         print(f"{FG_CYAN}Undo cancelled.{RESET}")
 
 
+def _write_session_export(out_path: str, header: str, history: List[Tuple[str, str]]) -> None:
+    """Write a /save export atomically via a temp file (runs on the I/O pool)."""
+    # Stream the export through a large buffer instead of joining it in memory
+    tmp_path = f"{out_path}.mlx-tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(tmp_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+            w = f.write
+            w(header)
+            for role, txt in history:
+                emoji = "👤" if role == "user" else "🤖"
+                w(f"## {emoji} {role.title()}\n\n")
+                w(txt)
+                w("\n\n---\n\n")
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 def cmd_save(parts: List[str], state: AppState) -> None:
     out_path_raw = " ".join(parts[1:]) if len(parts) > 1 else f"mlx-session-{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
     out_path = resolve_path(out_path_raw, state.cwd)
-    if not is_safe_path(out_path):
+    if not in_sandbox(out_path):
         print(f"{FG_RED}Cannot save outside sandbox{RESET}")
         return
 
-    lines = [
-        f"# MLX-CODE-PRO Session\n",
-        f"**Model:** {state.model_name}\n",
-        f"**Date:** {datetime.now().isoformat()}\n",
-        f"**Project:** {state.project_type or 'Unknown'}\n",
-        "\n---\n\n",
-    ]
-    for role, txt in state.session.history:
-        emoji = "👤" if role == "user" else "🤖"
-        lines.append(f"## {emoji} {role.title()}\n\n")
-        lines.append(txt)
-        lines.append("\n\n---\n\n")
+    header = (
+        "# MLX-CODE-PRO Session\n"
+        f"**Model:** {state.model_name}\n"
+        f"**Date:** {datetime.now().isoformat()}\n"
+        f"**Project:** {state.project_type or 'Unknown'}\n"
+        "\n---\n\n"
+    )
+    rel = rel_to_root(out_path)
     try:
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write("".join(lines))
-        rel = os.path.relpath(out_path, ROOT_DIR)
-        print(f"{FG_GREEN}✓ Saved to {rel}{RESET}")
-    except Exception as e:
+    except OSError as e:
         print(f"{FG_RED}Error: {e}{RESET}")
+        return
+
+    def report(fut):
+        # Runs on the pool thread; the main loop prints it before the next prompt
+        e = fut.exception()
+        if e is not None:
+            state.notices.append(f"{FG_RED}Error saving {rel}: {e}{RESET}")
+        else:
+            state.notices.append(f"{FG_GREEN}✓ Saved to {rel}{RESET}")
+
+    # The write runs in the background so a slow disk doesn't block the prompt; the
+    # history snapshot is taken here. Pool threads are joined at exit, so it always lands.
+    print(f"{DIM}Saving to {rel}...{RESET}")
+    fut = _io_pool().submit(_write_session_export, out_path, header, state.session.history[:])
+    fut.add_done_callback(report)
 
 
 def cmd_last(parts: List[str], state: AppState) -> None:
@@ -2525,7 +3561,7 @@ def cmd_replace(parts: List[str], state: AppState) -> None:
     replace_all = "--all" in parts
 
     target = resolve_path(file_arg, state.cwd)
-    if not is_safe_path(target):
+    if not in_sandbox(target):
         print(f"{FG_RED}Cannot modify outside sandbox{RESET}")
         return
     if not os.path.isfile(target):
@@ -2533,8 +3569,7 @@ def cmd_replace(parts: List[str], state: AppState) -> None:
         return
 
     try:
-        with open(target, "r", encoding="utf-8") as f:
-            content = f.read()
+        content = read_text_cached(target)
     except Exception as e:
         print(f"{FG_RED}Error reading file: {e}{RESET}")
         return
@@ -2544,7 +3579,7 @@ def cmd_replace(parts: List[str], state: AppState) -> None:
         print(f"{FG_YELLOW}Text not found in {file_arg}{RESET}")
         return
 
-    rel = os.path.relpath(target, ROOT_DIR)
+    rel = rel_to_root(target)
     if replace_all:
         new_content = content.replace(old_text, new_text)
         print(f"{FG_CYAN}Found {count} occurrence(s) in {rel}{RESET}")
@@ -2560,13 +3595,12 @@ def cmd_replace(parts: List[str], state: AppState) -> None:
         backup = create_backup(target)
         if backup:
             print(f"{FG_BLUE}  💾 Backup created{RESET}")
-        with open(target, "w", encoding="utf-8") as f:
-            f.write(new_content)
+        replace_file(target, new_content)
         replaced = count if replace_all else 1
         print(f"{FG_GREEN}✅ Replaced {replaced} occurrence(s) in {rel}{RESET}")
         state.session.last_modified_files.append(target)
         state.session.stats["files_modified"] += 1
-        state.session.opened_files[target] = new_content
+        state.session.set_opened_file(target, new_content)
         log_operation("REPLACE", f"{rel}: '{old_text}' -> '{new_text}'")
     else:
         print(f"{FG_CYAN}Replacement cancelled.{RESET}")
@@ -2718,8 +3752,7 @@ def cmd_copy(parts: List[str], state: AppState) -> None:
         return
 
     # Extract code blocks
-    blocks = extract_code_blocks(last_response)
-    file_blocks = extract_file_blocks(last_response)
+    file_blocks, blocks = extract_blocks(last_response)
     all_blocks = file_blocks + blocks
 
     if not all_blocks:
@@ -2846,6 +3879,8 @@ def main():
     session = ChatSession(model_name, max_tokens, ctx_chars)
     if "auto_context" in config:
         session.auto_context_enabled = bool(config["auto_context"])
+    if config.get("semantic_cache"):
+        session.enable_semantic_cache()
     state = AppState(model_name, max_tokens, ctx_chars, ROOT_DIR, session)
     session.load_project_context(state.cwd)
 
@@ -2857,8 +3892,7 @@ def main():
         print(f"\n{FG_YELLOW}💾 Found autosaved conversation ({n_msgs} messages, from {ts}){RESET}")
         restore = input(f"{FG_YELLOW}Restore previous conversation? [y/N] {RESET}").strip().lower()
         if restore == 'y':
-            for msg in autosave["history"]:
-                session.history.append((msg["role"], msg["content"]))
+            session.set_history((msg["role"], msg["content"]) for msg in autosave["history"])
             print(f"{FG_GREEN}✓ Restored {n_msgs} messages{RESET}")
         else:
             clear_autosave()
@@ -2867,6 +3901,13 @@ def main():
 
     # Setup advanced input with prompt_toolkit (if available)
     if HAS_PROMPT_TOOLKIT:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.history import FileHistory
+        from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+        from prompt_toolkit.completion import WordCompleter
+        from prompt_toolkit.styles import Style
+        from prompt_toolkit.formatted_text import HTML
+
         history_file = os.path.join(LOG_DIR, "command_history.txt")
         commands = sorted(set(
             list(COMMAND_DISPATCH.keys()) +
@@ -2887,6 +3928,8 @@ def main():
         prompt_session = None
 
     while True:
+        while state.notices:
+            print(state.notices.pop(0))
         try:
             if HAS_PROMPT_TOOLKIT and prompt_session:
                 line = prompt_session.prompt(HTML(f'<ansigreen>></ansigreen> '))
@@ -2917,11 +3960,11 @@ def main():
                 response = state.session.ask(user_message, state.cwd)
 
                 # Handle file changes
-                blocks = extract_file_blocks(response)
-                if blocks:
-                    apply_file_changes(blocks, state.cwd, state.session)
+                file_blocks, code_blocks = extract_blocks(response)
+                if file_blocks:
+                    apply_file_changes(file_blocks, state.cwd, state.session)
                 else:
-                    maybe_save_code_block(response, state.cwd, state.session)
+                    maybe_save_code_block(code_blocks, state.cwd, state.session)
 
                 print()
             continue